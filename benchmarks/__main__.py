@@ -0,0 +1,78 @@
+'''
+Generate a synthetic dataset in a temporary database, run the CRUD
+micro-benchmarks and the HTTP load test against it and print the results as
+JSON. Compare runs with the same sizes and seed:
+
+    python -m fastingapi.benchmarks --users 100 --fasts 365 --output before.json
+'''
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+
+from fastingapi import config
+
+from . import crud, dataset, load
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(data: dataset.Dataset, iterations: int, requests: int, concurrency: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, sessions = dataset.create_database(f"{tmp}/benchmark.db")
+        try:
+            started = time.perf_counter()
+            db = sessions()
+            try:
+                user_ids = dataset.generate(db, data)
+            finally:
+                db.close()
+            generate_seconds = time.perf_counter() - started
+
+            crud_results = crud.run(sessions, user_ids, iterations, seed=data.seed)
+            with dataset.app_database(sessions) as app:
+                load_results = load.run(app, user_ids, requests, concurrency, seed=data.seed)
+        finally:
+            engine.dispose()
+    return dict(
+        run=dict(started=datetime.utcnow().isoformat(), revision=git_revision(),
+            python=platform.python_version(), settings=config.settings.dict()),
+        dataset=dict(asdict(data), generate_seconds=generate_seconds),
+        crud=crud_results,
+        load=load_results,
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the benchmark suite on a synthetic dataset.")
+    parser.add_argument('--users', type=int, default=dataset.Dataset.users)
+    parser.add_argument('--fasts', type=int, default=dataset.Dataset.fasts_per_user,
+        help="completed fasts per user, one a day")
+    parser.add_argument('--weights-per-day', type=int, default=dataset.Dataset.weights_per_day)
+    parser.add_argument('--seed', type=int, default=dataset.Dataset.seed)
+    parser.add_argument('--iterations', type=int, default=1000, help="calls per CRUD helper")
+    parser.add_argument('--requests', type=int, default=2000, help="HTTP requests in the load test")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    data = dataset.Dataset(users=args.users, fasts_per_user=args.fasts,
+        weights_per_day=args.weights_per_day, seed=args.seed)
+    results = run(data, args.iterations, args.requests, args.concurrency)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,61 @@
+'''
+Micro-benchmarks of the CRUD helpers, called directly on one session.
+'''
+import random
+import time
+from datetime import datetime, timedelta
+
+from fastingapi.modules import fasts, weights
+
+from .timing import measure, summarize
+
+
+def create_and_end_fasts(db, user_ids: list, iterations: int):
+    # Users need to be idle before each create, so fasts are created for all
+    # of them and then ended, round after round.
+    created, ended = [], []
+    while user_ids and len(created) < iterations:
+        round_users = user_ids[:iterations - len(created)]
+        active_fasts = []
+        for user_id in round_users:
+            start_time = datetime.utcnow() - timedelta(hours=16)
+            started = time.perf_counter()
+            active_fasts.append(fasts.create_user_fast(db, fasts.FastCreate(start_time=start_time),
+                user_id=user_id))
+            created.append(time.perf_counter() - started)
+        for active_fast in active_fasts:
+            started = time.perf_counter()
+            fasts.end_user_fast(db, fasts.FastEnd(end_time=datetime.utcnow()), user_id=active_fast.user_id)
+            ended.append(time.perf_counter() - started)
+    return summarize(created), summarize(ended)
+
+
+def run(sessions, user_ids: list, iterations: int = 1000, seed: int = 0):
+    rng = random.Random(seed)
+    picks = [rng.choice(user_ids) for _ in range(iterations)]
+    # The generator starts a fast for every other user.
+    idle_user_ids = user_ids[1::2]
+    db = sessions()
+    try:
+        first_pages = {}
+
+        def first_page(i):
+            first_pages[picks[i]] = fasts.get_fasts(db, user_id=picks[i])
+
+        def next_page(i):
+            last = first_pages[picks[i]][-1]
+            fasts.get_fasts(db, user_id=picks[i], after=(last.start_time, last.id))
+
+        results = {
+            'get_active_fast': measure(lambda i: fasts.get_active_fast(db, user_id=picks[i]), iterations),
+            'get_fasts': measure(first_page, iterations),
+            'get_fasts_cursor': measure(next_page, iterations),
+        }
+        results['create_user_fast'], results['end_user_fast'] = create_and_end_fasts(
+            db, idle_user_ids, iterations)
+        results['user_weight_in'] = measure(lambda i: weights.user_weight_in(db,
+            weights.WeightBase(weight=80 + rng.random(), weight_time=datetime.utcnow()),
+            user_id=picks[i]), iterations, warmup=0)
+        return results
+    finally:
+        db.close()
@@ -0,0 +1,109 @@
+'''
+Seeded synthetic data for the benchmarks: users with a long fast history,
+dense weight logs and, for every other user, a fast in progress. The same
+seed and sizes always give the same rows, so runs can be compared.
+'''
+import random
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import sessionmaker
+
+from fastingapi import config, main
+from fastingapi.database import database, migrations
+from fastingapi.database.database import DBUser
+from fastingapi.dependencies import SyncDatabase, get_db, get_read_db
+from fastingapi.modules import fasts, weights
+
+# Rows per insert, like bulk imports.
+BATCH_SIZE = 5000
+
+
+@dataclass
+class Dataset:
+    users: int = 100
+    fasts_per_user: int = 365
+    weights_per_day: int = 3
+    seed: int = 0
+
+
+def create_database(path: str, settings: config.Settings = None):
+    engine = database.make_engine(f"sqlite:///{path}", settings or config.settings)
+    migrations.upgrade(engine)
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def batches(rows, size: int = BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def fast_rows(rng: random.Random, start: datetime, days: int):
+    rows = []
+    for day in range(days):
+        start_time = start + timedelta(days=day, hours=rng.uniform(18, 22))
+        duration = timedelta(hours=min(max(rng.gauss(16, 3), 12), 24))
+        planned_duration = rng.choice([16, 18, 20, 23])
+        rows.append(dict(start_time=start_time, end_time=start_time + duration, duration=duration,
+            planned_duration=planned_duration,
+            planned_end_time=start_time + timedelta(hours=planned_duration),
+            completed=True, deleted=False))
+    return rows
+
+
+def weight_rows(rng: random.Random, start: datetime, days: int, per_day: int, weight: float,
+        goal_weight: float):
+    rows = []
+    loss_per_reading = (weight - goal_weight) / max(days * per_day, 1)
+    for reading in range(days * per_day):
+        weight_time = start + timedelta(days=reading / per_day, minutes=rng.uniform(0, 60))
+        value = weight - loss_per_reading * reading + rng.gauss(0, 0.4)
+        rows.append(dict(weight_time=weight_time, weight=value, unit='metric',
+            bmi=weights.calculate_bmi(weights.WeightBase.construct(weight=value))))
+    return rows
+
+
+def generate(db, dataset: Dataset):
+    '''
+    Fill an empty database through the same insert helpers as the bulk
+    imports, so user_stats is kept up to date. Returns the user ids.
+    '''
+    rng = random.Random(dataset.seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    start = now - timedelta(days=dataset.fasts_per_user + 1)
+    user_ids = []
+    for i in range(dataset.users):
+        weight = rng.uniform(60, 120)
+        db_user = DBUser(email=f"user{i}@example.com", hashed_password="x", weight=weight,
+            height=rng.uniform(150, 195), goal_weight=weight - rng.uniform(5, 20), unit='metric',
+            is_active=True)
+        db.add(db_user)
+        db.commit()
+        user_ids.append(db_user.id)
+        for rows in batches(fast_rows(rng, start, dataset.fasts_per_user)):
+            fasts.import_fasts(db, db_user.id, rows)
+        for rows in batches(weight_rows(rng, start, dataset.fasts_per_user, dataset.weights_per_day,
+                weight, db_user.goal_weight)):
+            weights.import_weights(db, db_user.id, rows)
+        if i % 2 == 0:
+            fasts.create_user_fast(db, fasts.FastCreate(start_time=now - timedelta(hours=rng.uniform(1, 20))),
+                user_id=db_user.id)
+    return user_ids
+
+
+@contextmanager
+def app_database(sessions):
+    # Serve main.app from the benchmark database.
+    async def override_get_db():
+        session = sessions()
+        try:
+            yield SyncDatabase(session)
+        finally:
+            session.close()
+
+    main.app.dependency_overrides[get_db] = main.app.dependency_overrides[get_read_db] = override_get_db
+    try:
+        yield main.app
+    finally:
+        main.app.dependency_overrides.clear()
@@ -0,0 +1,103 @@
+'''
+Readings per second through POST /weight/{user_id}/fasts/, written right
+away or through the write-behind queue, and of the storage alone: one
+user_weight_in per reading against write_weights group commits. In process
+the HTTP client and the framework cap the write-behind route, the storage
+numbers show what the disk does. Prints the results as JSON.
+
+    python -m fastingapi.benchmarks.ingest --readings 5000 --synchronous FULL
+'''
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+from fastingapi import config, main
+from fastingapi.modules import weights
+
+from . import dataset
+
+
+async def post_readings(app, user_ids: list, readings: int, concurrency: int):
+    start_time = datetime(2021, 1, 1)
+
+    async def client_loop(client, offset: int):
+        for i in range(offset, readings, concurrency):
+            response = await client.post(f"/weight/{user_ids[i % len(user_ids)]}/fasts/", json={
+                "weight": 80 - i / readings, "weight_time": (start_time + timedelta(minutes=i)).isoformat()})
+            assert response.status_code in (200, 202)
+
+    # Shutdown is timed too, it writes what is still queued.
+    started = time.perf_counter()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            await asyncio.gather(*(client_loop(client, offset) for offset in range(concurrency)))
+        answered = time.perf_counter() - started
+    stored = time.perf_counter() - started
+    return dict(answered_per_second=readings / answered, stored_per_second=readings / stored)
+
+
+def store_readings(sessions, user_ids: list, readings: int, batch_size: int):
+    start_time = datetime(2021, 1, 1)
+    rows = [dict(weights.weight_row(weights.WeightBase(weight=80 - i / readings,
+        weight_time=start_time + timedelta(minutes=i))), user_id=user_ids[i % len(user_ids)])
+        for i in range(readings)]
+    db = sessions()
+    try:
+        started = time.perf_counter()
+        for row in rows:
+            weights.user_weight_in(db, weights.WeightBase(**row), user_id=row['user_id'])
+        one_by_one = time.perf_counter() - started
+        started = time.perf_counter()
+        for batch in dataset.batches(rows, batch_size):
+            weights.write_weights(db, batch)
+        grouped = time.perf_counter() - started
+    finally:
+        db.close()
+    return dict(one_by_one_per_second=readings / one_by_one, group_commit_per_second=readings / grouped,
+        speedup=one_by_one / grouped)
+
+
+def run(readings: int, concurrency: int, synchronous: str):
+    settings = config.settings
+    results = {}
+    try:
+        for write_behind in (False, True):
+            with tempfile.TemporaryDirectory() as tmp:
+                engine, sessions = dataset.create_database(f"{tmp}/benchmark.db")
+                db = sessions()
+                user_ids = dataset.generate(db, dataset.Dataset(users=10, fasts_per_user=0))
+                db.close()
+                engine.dispose()
+                app = main.create_app(config.Settings(database_url=f"sqlite:///{tmp}/benchmark.db",
+                    weight_write_behind=write_behind, sqlite_synchronous=synchronous, metrics=False))
+                results['write_behind' if write_behind else 'direct'] = asyncio.run(
+                    post_readings(app, user_ids, readings, concurrency))
+    finally:
+        config.settings = settings
+    results['speedup'] = results['write_behind']['stored_per_second'] / results['direct']['stored_per_second']
+    with tempfile.TemporaryDirectory() as tmp:
+        storage_settings = config.Settings(sqlite_synchronous=synchronous)
+        engine, sessions = dataset.create_database(f"{tmp}/benchmark.db", storage_settings)
+        db = sessions()
+        user_ids = dataset.generate(db, dataset.Dataset(users=10, fasts_per_user=0))
+        db.close()
+        results['storage'] = store_readings(sessions, user_ids, readings,
+            storage_settings.write_behind_batch_size)
+        engine.dispose()
+    return dict(readings=readings, concurrency=concurrency, synchronous=synchronous, **results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark weight ingestion.")
+    parser.add_argument('--readings', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32, help="concurrent clients")
+    parser.add_argument('--synchronous', default=config.settings.sqlite_synchronous,
+        help="SQLite synchronous pragma, FULL fsyncs every commit")
+    args = parser.parse_args()
+    print(json.dumps(run(args.readings, args.concurrency, args.synchronous), indent=2))
@@ -0,0 +1,59 @@
+'''
+In-process HTTP load test: concurrent clients send a weighted mix of requests
+through the ASGI app, no network or server in between.
+'''
+import asyncio
+import random
+import time
+from datetime import datetime
+
+import httpx
+
+from .timing import summarize
+
+# (name, weight, method, url, body) with {user_id} filled in per request. The
+# dashboard is what the front end polls, so it dominates the mix.
+ROUTES = [
+    ('GET /users/{user_id}', 10, 'GET', '/users/{user_id}', None),
+    ('GET /fast/{user_id}/fasts/', 4, 'GET', '/fast/{user_id}/fasts/', None),
+    ('GET /users/', 1, 'GET', '/users/', None),
+    ('GET /weight/{user_id}/trend', 2, 'GET', '/weight/{user_id}/trend', None),
+    ('POST /weight/{user_id}/fasts/', 2, 'POST', '/weight/{user_id}/fasts/', {'weight': 80}),
+]
+
+
+async def client_loop(client, rng: random.Random, user_ids: list, requests: int, timings: dict,
+        errors: dict):
+    picks = rng.choices(ROUTES, weights=[route[1] for route in ROUTES], k=requests)
+    for name, _, method, url, body in picks:
+        url = url.format(user_id=rng.choice(user_ids))
+        if body is not None:
+            body = dict(body, weight_time=datetime.utcnow().isoformat())
+        started = time.perf_counter()
+        response = await client.request(method, url, json=body)
+        timings[name].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            errors[name] += 1
+
+
+async def load_test(app, user_ids: list, requests: int = 2000, concurrency: int = 8, seed: int = 0):
+    timings = {route[0]: [] for route in ROUTES}
+    errors = {route[0]: 0 for route in ROUTES}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+        rng = random.Random(seed)
+        per_client = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, random.Random(rng.random()), user_ids, count,
+            timings, errors) for count in per_client))
+        elapsed = time.perf_counter() - started
+
+    routes = {name: dict(summarize(route_timings), errors=errors[name])
+        for name, route_timings in timings.items()}
+    all_timings = [timing for route_timings in timings.values() for timing in route_timings]
+    return dict(concurrency=concurrency, seconds=elapsed, requests_per_second=requests / elapsed,
+        errors=sum(errors.values()), latency=summarize(all_timings), routes=routes)
+
+
+def run(app, user_ids: list, requests: int = 2000, concurrency: int = 8, seed: int = 0):
+    return asyncio.run(load_test(app, user_ids, requests, concurrency, seed))
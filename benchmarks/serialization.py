@@ -0,0 +1,60 @@
+'''
+Compare the response-model path of the list routes with the orjson fast path
+(settings.fast_json) on 100-row pages. Prints the results as JSON.
+
+    python -m fastingapi.benchmarks.serialization --requests 200
+'''
+import argparse
+import json
+import statistics
+import tempfile
+import time
+
+from fastapi.testclient import TestClient
+from fastingapi import config
+
+from . import dataset
+
+PAGE = 100
+
+
+def time_requests(client, url: str, requests: int):
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200
+    return dict(mean_ms=statistics.mean(timings) * 1000, p50_ms=statistics.median(timings) * 1000)
+
+
+def run(requests: int):
+    results = {}
+    fast_json = config.settings.fast_json
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, sessions = dataset.create_database(f"{tmp}/benchmark.db")
+        db = sessions()
+        dataset.generate(db, dataset.Dataset(users=PAGE, fasts_per_user=PAGE, weights_per_day=1))
+        db.close()
+        try:
+            with dataset.app_database(sessions) as app:
+                client = TestClient(app)
+                for url in (f"/fast/1/fasts/?limit={PAGE}", f"/users/?limit={PAGE}"):
+                    results[url] = {}
+                    for mode in (False, True):
+                        config.settings.fast_json = mode
+                        time_requests(client, url, 10)
+                        results[url]['fast_json' if mode else 'response_model'] = time_requests(
+                            client, url, requests)
+                    path = results[url]
+                    path['speedup'] = path['response_model']['mean_ms'] / path['fast_json']['mean_ms']
+        finally:
+            config.settings.fast_json = fast_json
+            engine.dispose()
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark list response serialization.")
+    parser.add_argument('--requests', type=int, default=200, help="requests per route and mode")
+    args = parser.parse_args()
+    print(json.dumps(run(args.requests), indent=2))
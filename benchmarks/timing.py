@@ -0,0 +1,28 @@
+import statistics
+import time
+
+
+def summarize(timings: list):
+    '''Latency percentiles in milliseconds of timings in seconds.'''
+    if not timings:
+        return dict(count=0)
+    milliseconds = sorted(timing * 1000 for timing in timings)
+    if len(milliseconds) > 1:
+        percentiles = statistics.quantiles(milliseconds, n=100, method='inclusive')
+    else:
+        percentiles = milliseconds * 99
+    return dict(count=len(milliseconds), mean_ms=statistics.mean(milliseconds),
+        p50_ms=percentiles[49], p95_ms=percentiles[94], p99_ms=percentiles[98],
+        max_ms=milliseconds[-1])
+
+
+def measure(fn, iterations: int, warmup: int = 5):
+    '''Call fn(i) for i in range(iterations) and summarize the timings.'''
+    for i in range(min(warmup, iterations)):
+        fn(i)
+    timings = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        fn(i)
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
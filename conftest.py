@@ -0,0 +1,79 @@
+import pytest
+import asyncio
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
+
+from fastapi.testclient import TestClient
+from fastingapi import config, main
+from fastingapi.database import database, migrations
+from fastingapi.dependencies import AsyncDatabase, SyncDatabase, get_db, get_read_db
+from fastingapi.modules import cache
+
+
+@pytest.fixture(autouse=True)
+def clear_dashboards():
+    # Every test database starts its ids at 1.
+    cache.dashboards.clear()
+
+
+@pytest.fixture(autouse=True)
+def cheap_password_hashing(monkeypatch):
+    # Production costs would make every signup in the tests take a while.
+    monkeypatch.setattr(config.settings, 'password_time_cost', 1)
+    monkeypatch.setattr(config.settings, 'password_memory_cost', 1024)
+
+
+@pytest.fixture
+def db_engine(tmp_path):
+    engine = database.make_engine(f"sqlite:///{tmp_path / 'fastingapi.db'}")
+    migrations.upgrade(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db_sessionmaker(db_engine):
+    return sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+
+
+@pytest.fixture
+def db(db_sessionmaker):
+    session = db_sessionmaker()
+    yield session
+    session.close()
+
+
+def sync_get_db(db_engine):
+    sessions = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+
+    async def override_get_db():
+        session = sessions()
+        try:
+            yield SyncDatabase(session)
+        finally:
+            session.close()
+
+    return override_get_db, lambda: None
+
+
+def async_get_db(db_engine):
+    # TestClient runs every request on a new event loop, so connections can't be pooled.
+    engine = database.make_async_engine(str(db_engine.url), pool_class=NullPool)
+    sessions = sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    async def override_get_db():
+        async with sessions() as session:
+            yield AsyncDatabase(session)
+
+    return override_get_db, lambda: asyncio.run(engine.dispose())
+
+
+@pytest.fixture(params=[sync_get_db, async_get_db], ids=["sync", "async"])
+def client(request, db_engine):
+    override_get_db, dispose = request.param(db_engine)
+    main.app.dependency_overrides[get_db] = main.app.dependency_overrides[get_read_db] = override_get_db
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
+    dispose()
@@ -1,17 +1,221 @@
-from sqlalchemy import create_engine
+from datetime import datetime
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.dialects.postgresql.base import PGCompiler
+from sqlalchemy.dialects.sqlite.base import SQLiteCompiler
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Boolean, Interval, Float
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey, Date, DateTime, Boolean, Interval, Float, Index
+
+from .. import config
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
+
+
+def async_database_url(url: str):
+    scheme, rest = url.split("://", 1)
+    return ASYNC_DRIVERS.get(scheme.split("+")[0], scheme) + "://" + rest
+
+
+def is_sqlite(url: str):
+    return url.startswith("sqlite")
+
+
+class elapsed(FunctionElement):
+    '''
+    The Interval from the second datetime argument to the first, computed by
+    the database so an UPDATE can set a duration from the row's own start.
+    '''
+    type = Interval()
+    name = "elapsed"
+    inherit_cache = True
+
+
+@compiles(elapsed)
+def compile_elapsed(element, compiler, **kw):
+    end, start = element.clauses
+    return f"({compiler.process(end, **kw)} - {compiler.process(start, **kw)})"
+
+
+@compiles(elapsed, "sqlite")
+def compile_sqlite_elapsed(element, compiler, **kw):
+    # SQLite has no interval type, see sqlite_elapsed().
+    return f"elapsed({compiler.process(element.clauses, **kw)})"
+
+
+# SQLite stores an Interval as the DateTime of the epoch plus the interval.
+SQLITE_EPOCH = datetime.utcfromtimestamp(0)
+
+
+def sqlite_elapsed(end: str, start: str):
+    if end is None or start is None:
+        return None
+    interval = datetime.fromisoformat(end) - datetime.fromisoformat(start)
+    return (SQLITE_EPOCH + interval).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class SQLiteReturningCompiler(SQLiteCompiler):
+    # SQLite runs INSERT/UPDATE ... RETURNING since 3.35, SQLAlchemy 1.4 only
+    # compiles it for server databases.
+    returning_clause = PGCompiler.returning_clause
+
+
+def set_sqlite_pragmas(settings: config.Settings, read_only: bool = False):
+    # WAL lets readers run alongside the single writer and synchronous=NORMAL
+    # only fsyncs at checkpoints. busy_timeout makes a writer wait for the lock
+    # instead of failing right away with "database is locked".
+    pragmas = {
+        # Before journal_mode, which writes the header of a new file.
+        "auto_vacuum": settings.sqlite_auto_vacuum,
+        "journal_mode": settings.sqlite_journal_mode,
+        "synchronous": settings.sqlite_synchronous,
+        "busy_timeout": settings.sqlite_busy_timeout,
+        "mmap_size": settings.sqlite_mmap_size,
+        "cache_size": settings.sqlite_cache_size,
+    }
+    if read_only:
+        # The primary's connections set up the file, these only read it.
+        del pragmas["auto_vacuum"], pragmas["journal_mode"]
+        pragmas["query_only"] = "ON"
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+        dbapi_connection.create_function("elapsed", 2, sqlite_elapsed, deterministic=True)
+
+    return on_connect
+
+
+def engine_options(url: str, settings: config.Settings, pool_class):
+    options = {
+        "poolclass": pool_class,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+        "pool_recycle": settings.db_pool_recycle,
+    }
+    if pool_class is not NullPool:
+        options.update(pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow)
+    if is_sqlite(url):
+        if ":memory:" in url or url.endswith("://"):
+            return {"connect_args": {"check_same_thread": False}}
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+# SQLAlchemy opens a new connection per checkout for SQLite files by default,
+# which would also re-run the pragmas on every request, so files get a
+# QueuePool like server databases.
+def make_engine(url: str, settings: config.Settings = config.settings, pool_class=QueuePool,
+        read_only: bool = False):
+    engine = create_engine(url, **engine_options(url, settings, pool_class))
+    if is_sqlite(url):
+        event.listen(engine, "connect", set_sqlite_pragmas(settings, read_only))
+        engine.dialect.statement_compiler = SQLiteReturningCompiler
+    return engine
+
+
+def make_async_engine(url: str, settings: config.Settings = config.settings,
+        pool_class=AsyncAdaptedQueuePool, read_only: bool = False):
+    from sqlalchemy.ext.asyncio import create_async_engine
+    url = async_database_url(url)
+    engine = create_async_engine(url, **engine_options(url, settings, pool_class))
+    if is_sqlite(url):
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragmas(settings, read_only))
+        engine.sync_engine.dialect.statement_compiler = SQLiteReturningCompiler
+    return engine
+
+
+def read_database_url(settings: config.Settings):
+    '''
+    Where read-only endpoints read from: the replica, or the SQLite file itself
+    through a pool of its own. None when they share the primary's engine.
+    '''
+    if settings.read_database_url:
+        return settings.read_database_url
+    url = settings.database_url
+    if settings.sqlite_read_pool and is_sqlite(url) and ":memory:" not in url and not url.endswith("://"):
+        return url
+    return None
+
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///database/fastingapi.db"
+SQLALCHEMY_DATABASE_URL = config.settings.database_url
+READ_DATABASE_URL = None
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+engine = make_engine(SQLALCHEMY_DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 session = SessionLocal()
 
+# Until startup creates the read engine, reads go to the primary as well.
+read_engine = engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# The asyncio engine is only created when async mode is switched on, so the
+# sync path doesn't need aiosqlite/asyncpg installed.
+async_engine = None
+AsyncSessionLocal = None
+async_read_engine = None
+AsyncReadSessionLocal = None
+
+
+def init_async_engine(settings: config.Settings = None):
+    global async_engine, AsyncSessionLocal, async_read_engine, AsyncReadSessionLocal
+    if async_engine is None:
+        from sqlalchemy.ext.asyncio import AsyncSession
+        settings = settings or config.settings
+        async_engine = make_async_engine(SQLALCHEMY_DATABASE_URL, settings)
+        async_read_engine = async_engine
+        if READ_DATABASE_URL:
+            async_read_engine = make_async_engine(READ_DATABASE_URL, settings, read_only=True)
+        # Objects are used after commit while serializing the response, where
+        # an expired attribute can't be lazy loaded without a greenlet.
+        AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession,
+            autoflush=False, expire_on_commit=False)
+        AsyncReadSessionLocal = sessionmaker(async_read_engine, class_=AsyncSession,
+            autoflush=False, expire_on_commit=False)
+    return async_engine
+
+
+def init_engines(settings: config.Settings):
+    '''
+    Create the engines of this process from `settings`. Called at startup in
+    every worker, so no pooled connection is ever shared between processes.
+    '''
+    global SQLALCHEMY_DATABASE_URL, READ_DATABASE_URL, engine, read_engine, async_engine, \
+        AsyncSessionLocal, async_read_engine, AsyncReadSessionLocal
+    SQLALCHEMY_DATABASE_URL = settings.database_url
+    READ_DATABASE_URL = read_database_url(settings)
+    engine = make_engine(SQLALCHEMY_DATABASE_URL, settings)
+    SessionLocal.configure(bind=engine)
+    read_engine = engine
+    if READ_DATABASE_URL:
+        read_engine = make_engine(READ_DATABASE_URL, settings, read_only=True)
+    ReadSessionLocal.configure(bind=read_engine)
+    async_engine = AsyncSessionLocal = async_read_engine = AsyncReadSessionLocal = None
+    if settings.async_db:
+        init_async_engine(settings)
+    return engine
+
+
+async def dispose_engines():
+    # aiosqlite keeps a non-daemon thread per pooled connection, which would
+    # keep the process alive after the server stops.
+    engine.dispose()
+    if read_engine is not engine:
+        read_engine.dispose()
+    if async_engine is not None:
+        await async_engine.dispose()
+    if async_read_engine is not None and async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
 
 class DBUser(Base):
     __tablename__ = "users"
@@ -24,8 +228,12 @@ class DBUser(Base):
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
     unit = Column(String)
+    # Bumped by every write to the user's fasts and weights, for conditional GETs.
+    version = Column(Integer, default=0, nullable=False)
+    modified_at = Column(DateTime)
     fasts = relationship("DBFast", back_populates="user")
     weights = relationship("DBWeight", back_populates="user")
+    stats = relationship("DBUserStats", back_populates="user", uselist=False)
 
 
 class DBFast(Base):
@@ -41,6 +249,35 @@ class DBFast(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     user = relationship("DBUser", back_populates="fasts")
 
+    __table_args__ = (
+        Index('ix_fasts_user_id_completed', 'user_id', 'completed'),
+        Index('ix_fasts_user_id_start_time', 'user_id', 'start_time'),
+        # At most one fast in progress per user, whatever requests race.
+        Index('ix_fasts_user_id_active', 'user_id', unique=True, sqlite_where=text('NOT completed'),
+            postgresql_where=text('NOT completed')),
+        # Ids aren't reused once the newest fast is archived.
+        {'sqlite_autoincrement': True},
+    )
+
+class DBArchivedFast(Base):
+    # Fasts moved out of the hot table by modules.archive: soft-deleted ones,
+    # and completed ones past the archive horizon. Ids are kept, and never
+    # handed out to a new fast again.
+    __tablename__ = 'fasts_archive'
+    id = Column(Integer, primary_key = True)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)
+    deleted = Column(Boolean)
+    completed = Column(Boolean)
+    duration = Column(Interval)
+    planned_end_time = Column(DateTime)
+    planned_duration = Column(Float)
+    user_id = Column(Integer, ForeignKey("users.id"))
+
+    __table_args__ = (
+        Index('ix_fasts_archive_user_id_start_time', 'user_id', 'start_time'),
+    )
+
 class DBWeight(Base):
     __tablename__ = 'weight'
     id = Column(Integer, primary_key = True)
@@ -51,6 +288,56 @@ class DBWeight(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     user = relationship("DBUser", back_populates="weights")
 
+    __table_args__ = (
+        Index('ix_weight_user_id_weight_time', 'user_id', 'weight_time'),
+    )
+
+
+class DBUserStats(Base):
+    # Running totals kept up to date by the fast and weight write paths, so the
+    # dashboard never has to aggregate a user's whole history.
+    __tablename__ = 'user_stats'
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key = True)
+    number_of_fasts = Column(Integer, default=0, nullable=False)
+    total_hours_fasted = Column(Float, default=0, nullable=False)
+    longest_fast = Column(Float, default=0, nullable=False)
+    start_weight = Column(Float)
+    start_weight_time = Column(DateTime)
+    weight = Column(Float)
+    weight_time = Column(DateTime)
+    bmi = Column(Float)
+    # Latest end time of the user's archived fasts that are still shown. Reads
+    # of the history only look at the archive for times before it.
+    archived_until = Column(DateTime)
+    user = relationship("DBUser", back_populates="stats")
+
+
+class DBFastingRollup(Base):
+    # Hours fasted per user and UTC day, week (from Monday) and month, kept up
+    # to date by the fast write paths. The leaderboards read the index.
+    __tablename__ = 'fasting_rollups'
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key = True)
+    period = Column(String, primary_key = True)
+    period_start = Column(Date, primary_key = True)
+    hours = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index('ix_fasting_rollups_period_hours', 'period', 'period_start', 'hours', 'user_id'),
+    )
+
+
+class DBUserStreak(Base):
+    # Consecutive days with fasting, up to last_day.
+    __tablename__ = 'user_streaks'
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key = True)
+    current_streak = Column(Integer, nullable=False)
+    longest_streak = Column(Integer, nullable=False)
+    last_day = Column(Date, nullable=False)
+
+    __table_args__ = (
+        Index('ix_user_streaks_longest_streak', 'longest_streak', 'user_id'),
+    )
+
 if __name__ == '__main__':
    user = session.query(DBUser).filter(DBUser.id == 1).first()
    print(user.fasts)
\ No newline at end of file
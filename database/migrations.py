@@ -0,0 +1,267 @@
+from sqlalchemy import (Boolean, Column, Date, DateTime, Float, ForeignKey, Integer, Interval,
+    MetaData, String, Table, func, inspect, select)
+from sqlalchemy.engine import Connection, Engine
+
+from . import database
+from ..modules import stats
+
+# Applied migrations are recorded here, one row per version.
+schema_version = Table('schema_version', MetaData(), Column('version', Integer, primary_key=True))
+
+# Tables as they were when their migration was written. Migrations never look
+# at the ORM models in database.py, so changing a model can't change what an
+# old migration does; a schema change is a new migration appended below.
+schema = MetaData()
+
+users_v1 = Table(
+    'users', schema,
+    Column('id', Integer, primary_key=True, index=True),
+    Column('email', String, unique=True, index=True),
+    Column('weight', Float),
+    Column('goal_weight', Float),
+    Column('height', Float),
+    Column('hashed_password', String),
+    Column('is_active', Boolean),
+    Column('unit', String),
+)
+
+fasts_v1 = Table(
+    'fasts', schema,
+    Column('id', Integer, primary_key=True),
+    Column('start_time', DateTime),
+    Column('end_time', DateTime),
+    Column('deleted', Boolean),
+    Column('completed', Boolean),
+    Column('duration', Interval),
+    Column('planned_end_time', DateTime),
+    Column('planned_duration', Float),
+    Column('user_id', Integer, ForeignKey('users.id')),
+)
+
+weight_v1 = Table(
+    'weight', schema,
+    Column('id', Integer, primary_key=True),
+    Column('weight_time', DateTime),
+    Column('weight', Float),
+    Column('unit', String),
+    Column('bmi', Float),
+    Column('user_id', Integer, ForeignKey('users.id')),
+)
+
+user_stats_v2 = Table(
+    'user_stats', schema,
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('number_of_fasts', Integer, nullable=False),
+    Column('total_hours_fasted', Float, nullable=False),
+    Column('longest_fast', Float, nullable=False),
+    Column('start_weight', Float),
+    Column('start_weight_time', DateTime),
+    Column('weight', Float),
+    Column('weight_time', DateTime),
+    Column('bmi', Float),
+)
+
+fasting_rollups_v4 = Table(
+    'fasting_rollups', schema,
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('period', String, primary_key=True),
+    Column('period_start', Date, primary_key=True),
+    Column('hours', Float, nullable=False),
+)
+
+user_streaks_v4 = Table(
+    'user_streaks', schema,
+    Column('user_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('current_streak', Integer, nullable=False),
+    Column('longest_streak', Integer, nullable=False),
+    Column('last_day', Date, nullable=False),
+)
+
+fasts_archive_v6 = Table(
+    'fasts_archive', schema,
+    Column('id', Integer, primary_key=True),
+    Column('start_time', DateTime),
+    Column('end_time', DateTime),
+    Column('deleted', Boolean),
+    Column('completed', Boolean),
+    Column('duration', Interval),
+    Column('planned_end_time', DateTime),
+    Column('planned_duration', Float),
+    Column('user_id', Integer, ForeignKey('users.id')),
+)
+
+# fasts again, with ids that SQLite never hands out twice (AUTOINCREMENT), so
+# a fast created after the newest one was archived can't take its id. Created
+# under this name and renamed, SQLite can't change a table's key in place.
+fasts_v8 = Table(
+    'fasts_v8', schema,
+    Column('id', Integer, primary_key=True),
+    Column('start_time', DateTime),
+    Column('end_time', DateTime),
+    Column('deleted', Boolean),
+    Column('completed', Boolean),
+    Column('duration', Interval),
+    Column('planned_end_time', DateTime),
+    Column('planned_duration', Float),
+    Column('user_id', Integer, ForeignKey('users.id')),
+    sqlite_autoincrement=True,
+)
+
+
+# Migration steps are idempotent so that databases created by the old
+# Base.metadata.create_all() call can be brought under version control.
+def create_table(conn: Connection, table: Table):
+    table.create(conn, checkfirst=True)
+
+
+def create_index(conn: Connection, name: str, table: Table, *columns: str, unique: bool = False,
+        where: str = None):
+    # Plain DDL rather than an Index object, which would attach itself to the
+    # frozen table and be created by an earlier migration on a fresh database.
+    conn.exec_driver_sql(f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {name} "
+        f"ON {table.name} ({', '.join(columns)})" + (f" WHERE {where}" if where else ""))
+
+
+def add_column(conn: Connection, table: Table, column: str, definition: str):
+    if column not in {existing['name'] for existing in inspect(conn).get_columns(table.name)}:
+        conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column} {definition}")
+
+
+def column_type(conn: Connection, type_):
+    # The DDL name of the type on this database, DATETIME on SQLite, TIMESTAMP
+    # WITHOUT TIME ZONE on PostgreSQL.
+    return type_.compile(dialect=conn.dialect)
+
+
+def initial_schema(conn: Connection):
+    for table in (users_v1, fasts_v1, weight_v1):
+        create_table(conn, table)
+
+
+def user_stats(conn: Connection):
+    create_table(conn, user_stats_v2)
+    # Count the history that is already there; from now on the write paths
+    # keep the totals up to date.
+    fasts = select(fasts_v1.c.user_id, fasts_v1.c.start_time, fasts_v1.c.end_time).where(
+        fasts_v1.c.completed == True, fasts_v1.c.deleted == False, fasts_v1.c.end_time != None)
+    weights = select(weight_v1.c.user_id, weight_v1.c.weight_time, weight_v1.c.weight,
+        weight_v1.c.bmi).order_by(weight_v1.c.user_id, weight_v1.c.weight_time, weight_v1.c.id)
+    streamed = conn.execution_options(stream_results=True)
+    rows = stats.aggregate_stats(streamed.execute(fasts), streamed.execute(weights))
+    conn.execute(user_stats_v2.delete())
+    if rows:
+        conn.execute(user_stats_v2.insert(), list(rows.values()))
+
+
+def fast_and_weight_indexes(conn: Connection):
+    create_index(conn, 'ix_fasts_user_id_completed', fasts_v1, 'user_id', 'completed')
+    create_index(conn, 'ix_fasts_user_id_start_time', fasts_v1, 'user_id', 'start_time')
+    create_index(conn, 'ix_weight_user_id_weight_time', weight_v1, 'user_id', 'weight_time')
+
+
+def fasting_rollups(conn: Connection):
+    create_table(conn, fasting_rollups_v4)
+    create_table(conn, user_streaks_v4)
+    create_index(conn, 'ix_fasting_rollups_period_hours', fasting_rollups_v4, 'period', 'period_start',
+        'hours', 'user_id')
+    create_index(conn, 'ix_user_streaks_longest_streak', user_streaks_v4, 'longest_streak', 'user_id')
+    fasts = select(fasts_v1.c.user_id, fasts_v1.c.start_time, fasts_v1.c.end_time).where(
+        fasts_v1.c.completed == True, fasts_v1.c.deleted == False, fasts_v1.c.end_time != None
+    ).order_by(fasts_v1.c.user_id)
+    conn.execute(fasting_rollups_v4.delete())
+    conn.execute(user_streaks_v4.delete())
+    for rows, streak in stats.aggregate_rollups(conn.execution_options(stream_results=True).execute(fasts)):
+        conn.execute(fasting_rollups_v4.insert(), rows)
+        conn.execute(user_streaks_v4.insert(), streak)
+
+
+def user_versions(conn: Connection):
+    add_column(conn, users_v1, 'version', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, users_v1, 'modified_at', column_type(conn, DateTime()))
+
+
+def fasts_archive(conn: Connection):
+    create_table(conn, fasts_archive_v6)
+    create_index(conn, 'ix_fasts_archive_user_id_start_time', fasts_archive_v6, 'user_id', 'start_time')
+    add_column(conn, user_stats_v2, 'archived_until', column_type(conn, DateTime()))
+
+
+def active_fast_index(conn: Connection):
+    # Racing requests could start a second fast before, the API only ever
+    # showed the oldest one as active. The others are deleted like
+    # delete_user_fast does, they never counted in the stats.
+    oldest = select(func.min(fasts_v1.c.id)).where(fasts_v1.c.completed == False).group_by(
+        fasts_v1.c.user_id)
+    conn.execute(fasts_v1.update().where(fasts_v1.c.completed == False, fasts_v1.c.id.not_in(oldest))
+        .values(deleted=True, completed=True))
+    create_index(conn, 'ix_fasts_user_id_active', fasts_v1, 'user_id', unique=True, where='NOT completed')
+
+
+
+def fasts_autoincrement(conn: Connection):
+    # Server databases take ids from sequences, which never go back.
+    if conn.dialect.name != 'sqlite':
+        return
+    table_sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'fasts'")
+    if 'AUTOINCREMENT' not in table_sql.scalar().upper():
+        create_table(conn, fasts_v8)
+        conn.execute(fasts_v8.insert().from_select(list(fasts_v1.c.keys()), select(fasts_v1)))
+        conn.exec_driver_sql("DROP TABLE fasts")
+        conn.exec_driver_sql("ALTER TABLE fasts_v8 RENAME TO fasts")
+        fast_and_weight_indexes(conn)
+        create_index(conn, 'ix_fasts_user_id_active', fasts_v1, 'user_id', unique=True, where='NOT completed')
+    # Nor the ids of fasts that were archived before.
+    conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'fasts'")
+    conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) SELECT 'fasts', "
+        "max(coalesce((SELECT max(id) FROM fasts), 0), coalesce((SELECT max(id) FROM fasts_archive), 0))")
+
+
+MIGRATIONS = [
+    (1, initial_schema),
+    (2, user_stats),
+    (3, fast_and_weight_indexes),
+    (4, fasting_rollups),
+    (5, user_versions),
+    (6, fasts_archive),
+    (7, active_fast_index),
+    (8, fasts_autoincrement),
+]
+
+
+def current_version(conn: Connection):
+    schema_version.create(conn, checkfirst=True)
+    version = conn.execute(schema_version.select().order_by(schema_version.c.version.desc())).first()
+    return version.version if version else 0
+
+
+def upgrade(engine: Engine, target: int = None):
+    '''
+    Apply the migrations that are missing from the database, up to `target` or
+    the latest, each one in its own transaction. Returns the applied versions.
+    '''
+    applied = []
+    with engine.begin() as conn:
+        version = current_version(conn)
+    for number, migration in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(schema_version.insert().values(version=number))
+        applied.append(number)
+    return applied
+
+
+def check(engine: Engine):
+    '''Raise when the database is missing migrations, without applying them.'''
+    with engine.begin() as conn:
+        version = current_version(conn)
+    latest = MIGRATIONS[-1][0]
+    if version < latest:
+        raise RuntimeError(f"Database schema is at version {version}, {latest} is required. "
+            "Run python -m fastingapi.database.migrations")
+
+
+if __name__ == '__main__':
+    applied = upgrade(database.engine)
+    print(f"Applied migrations: {applied}" if applied else "Database is up to date")
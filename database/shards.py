@@ -0,0 +1,311 @@
+'''
+Users spread over several databases, the shards, so SQLite's single writer
+per file is no longer one writer for everyone. Each shard has the whole
+schema and all the rows of its users. database_url then only holds the
+directory: the email and shard of every user, which also hands out the user
+ids so they stay unique across shards.
+
+Requests find the shard of their user in the directory, see
+dependencies.ShardedDatabase. Users are moved between shards with
+
+    python -m fastingapi.database.shards rebalance
+    python -m fastingapi.database.shards move --user-id 42 --to 3
+'''
+import argparse
+import zlib
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, Index, event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+from .. import config
+from . import database, migrations
+
+directory_schema = MetaData()
+
+user_directory = Table(
+    'user_directory', directory_schema,
+    Column('id', Integer, primary_key=True),
+    Column('email', String, nullable=False, unique=True),
+    Column('shard', Integer, nullable=False),
+    Index('ix_user_directory_shard', 'shard'),
+)
+
+# Rows per statement when a user's history is copied to another shard.
+MOVE_BATCH_SIZE = 1000
+
+
+def enforce_foreign_keys(dbapi_connection, connection_record):
+    # A write that looked up the shard just before its user moved away then
+    # fails instead of leaving rows behind that no one can reach.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+class Shard:
+    '''
+    The engines and session factories of one shard, with a read-only pool
+    for SQLite files like the unsharded database has.
+    '''
+
+    def __init__(self, url: str, settings: config.Settings):
+        self.url = url
+        self.settings = settings
+        read_url = database.read_database_url(settings.copy(update={'database_url': url,
+            'read_database_url': None}))
+        self.engine = self.make_engine(url)
+        self.read_engine = self.make_engine(read_url, read_only=True) if read_url else self.engine
+        self.sessions = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.read_sessions = sessionmaker(autocommit=False, autoflush=False, bind=self.read_engine)
+        self.async_engine = self.async_read_engine = None
+        if settings.async_db:
+            from sqlalchemy.ext.asyncio import AsyncSession
+            self.async_engine = self.make_engine(url, make=database.make_async_engine)
+            self.async_read_engine = self.async_engine
+            if read_url:
+                self.async_read_engine = self.make_engine(read_url, read_only=True,
+                    make=database.make_async_engine)
+            # Like database.AsyncSessionLocal, objects are used after commit.
+            self.async_sessions = sessionmaker(self.async_engine, class_=AsyncSession, autoflush=False,
+                expire_on_commit=False)
+            self.async_read_sessions = sessionmaker(self.async_read_engine, class_=AsyncSession,
+                autoflush=False, expire_on_commit=False)
+
+    def make_engine(self, url: str, read_only: bool = False, make=database.make_engine):
+        engine = make(url, self.settings, read_only=read_only)
+        if database.is_sqlite(url):
+            event.listen(getattr(engine, 'sync_engine', engine), "connect", enforce_foreign_keys)
+        return engine
+
+    def session_factory(self, read: bool = False):
+        if self.settings.async_db:
+            return self.async_read_sessions if read else self.async_sessions
+        return self.read_sessions if read else self.sessions
+
+    async def dispose(self):
+        for engine in {self.engine, self.read_engine}:
+            engine.dispose()
+        for engine in {self.async_engine, self.async_read_engine} - {None}:
+            await engine.dispose()
+
+
+class Shards:
+    '''
+    The directory, on `directory_engine`, and the shards at `urls`, in the
+    order of their numbers in the directory. Only append to the list, then
+    rebalance.
+    '''
+
+    def __init__(self, directory_engine: Engine, urls: List[str], settings: config.Settings):
+        self.directory = directory_engine
+        self.shards = [Shard(url, settings) for url in urls]
+
+    def __len__(self):
+        return len(self.shards)
+
+    def shard_of(self, user_id: int) -> Optional[int]:
+        with self.directory.connect() as conn:
+            return conn.execute(select(user_directory.c.shard).where(user_directory.c.id == user_id)).scalar()
+
+    def shards_of(self, user_ids: Iterable[int]) -> Dict[int, int]:
+        # Users that aren't in the directory are left out.
+        with self.directory.connect() as conn:
+            return dict(conn.execute(select(user_directory.c.id, user_directory.c.shard).where(
+                user_directory.c.id.in_(set(user_ids)))).all())
+
+    def user_id_of(self, email: str) -> Optional[int]:
+        with self.directory.connect() as conn:
+            return conn.execute(select(user_directory.c.id).where(user_directory.c.email == email)).scalar()
+
+    def register(self, email: str):
+        '''
+        Reserve an id for a new user and pick their shard, spread by the hash of
+        the email. Raises IntegrityError when the email is taken. Returns the
+        id and the shard.
+        '''
+        shard = zlib.crc32(email.encode()) % len(self.shards)
+        with self.directory.begin() as conn:
+            user_id = conn.execute(user_directory.insert().values(email=email, shard=shard)
+                .returning(user_directory.c.id)).scalar()
+        return user_id, shard
+
+    def unregister(self, user_id: int):
+        # Gives the email back when the user's row couldn't be written.
+        with self.directory.begin() as conn:
+            conn.execute(user_directory.delete().where(user_directory.c.id == user_id))
+
+    def user_counts(self):
+        counts = [0] * len(self.shards)
+        with self.directory.connect() as conn:
+            for shard, count in conn.execute(select(user_directory.c.shard, func.count()).group_by(
+                    user_directory.c.shard)):
+                counts[shard] = count
+        return counts
+
+    def move_user(self, user_id: int, target: int):
+        '''
+        Copy the user's rows to the `target` shard, point the directory there
+        and delete them from the old shard. Writes to the old shard wait until
+        the move is done, reads keep going. Fasts and weights get new ids on
+        the target, theirs may be taken there. Returns False when the user is
+        already there.
+        '''
+        source = self.shard_of(user_id)
+        if source is None:
+            raise LookupError(f"No user {user_id} in the directory")
+        if source == target:
+            return False
+        # Parents first: users, then the tables that point at them. The
+        # archive before the hot fasts, see below.
+        users, fasts = database.DBUser.__table__, database.DBFast.__table__
+        archive = database.DBArchivedFast.__table__
+        tables = [users, archive] + [table for table in database.Base.metadata.sorted_tables
+            if 'user_id' in table.c and table is not archive]
+        owned = lambda table: (table.c.id if table is users else table.c.user_id) == user_id
+        with self.shards[source].engine.begin() as source_conn:
+            # A write first takes the old shard's write lock, so its other
+            # writes wait for the move. The new version goes with the copy.
+            source_conn.execute(users.update().where(users.c.id == user_id).values(version=users.c.version + 1))
+            with self.shards[target].engine.begin() as target_conn:
+                # Left over from a move that stopped halfway.
+                for table in reversed(tables):
+                    target_conn.execute(table.delete().where(owned(table)))
+                for table in tables:
+                    # Archived fasts take their new ids from the target's
+                    # fasts, so no new fast gets them later. They are all
+                    # completed, the active fast index doesn't mind them.
+                    into = fasts if table is archive else table
+                    result = source_conn.execute(table.select().where(owned(table)))
+                    for rows in result.mappings().partitions(MOVE_BATCH_SIZE):
+                        target_conn.execute(into.insert(), [{key: value for key, value in row.items()
+                            if table is users or key != 'id'} for row in rows])
+                    if table is archive:
+                        target_conn.execute(archive.insert().from_select(list(fasts.c.keys()),
+                            select(fasts).where(owned(fasts))))
+                        target_conn.execute(fasts.delete().where(owned(fasts)))
+            with self.directory.begin() as conn:
+                conn.execute(user_directory.update().where(user_directory.c.id == user_id).values(shard=target))
+            for table in reversed(tables):
+                source_conn.execute(table.delete().where(owned(table)))
+        return True
+
+    def rebalance(self, limit: Optional[int] = None):
+        '''
+        Move users from the fullest shards to the emptiest ones until they
+        differ by at most one user, or `limit` users were moved. Returns the
+        moves as (user_id, source, target).
+        '''
+        counts = self.user_counts()
+        moves = []
+        while limit is None or len(moves) < limit:
+            source = max(range(len(counts)), key=counts.__getitem__)
+            target = min(range(len(counts)), key=counts.__getitem__)
+            if counts[source] - counts[target] <= 1:
+                break
+            # The newest users of a shard have the least history to copy.
+            with self.directory.connect() as conn:
+                user_id = conn.execute(select(func.max(user_directory.c.id)).where(
+                    user_directory.c.shard == source)).scalar()
+            self.move_user(user_id, target)
+            counts[source] -= 1
+            counts[target] += 1
+            moves.append((user_id, source, target))
+        return moves
+
+    async def dispose(self):
+        for shard in self.shards:
+            await shard.dispose()
+
+
+def create_directory(engine: Engine):
+    directory_schema.create_all(engine, checkfirst=True)
+
+
+def upgrade(settings: config.Settings):
+    '''
+    Bring every database with users' data up to date and create the
+    directory, like migrations.upgrade() for a single database. Returns the
+    migrations applied to each.
+    '''
+    applied = []
+    for url in settings.shard_database_urls or [settings.database_url]:
+        engine = database.make_engine(url, settings)
+        try:
+            applied.append(migrations.upgrade(engine))
+        finally:
+            engine.dispose()
+    if settings.shard_database_urls:
+        engine = database.make_engine(settings.database_url, settings)
+        try:
+            create_directory(engine)
+        finally:
+            engine.dispose()
+    return applied
+
+
+# Set at startup when settings.shard_database_urls is not empty.
+current: Optional[Shards] = None
+
+
+def init_shards(settings: config.Settings):
+    # After database.init_engines(), the directory is on its engine.
+    global current
+    current = Shards(database.engine, settings.shard_database_urls, settings) \
+        if settings.shard_database_urls else None
+    return current
+
+
+async def dispose_shards():
+    global current
+    if current is not None:
+        await current.dispose()
+    current = None
+
+
+def user_engines():
+    # Every database with users' data, for jobs that go through all users.
+    if current is None:
+        return [database.engine]
+    return [shard.engine for shard in current.shards]
+
+
+def user_sessions():
+    if current is None:
+        return [database.SessionLocal]
+    return [shard.sessions for shard in current.shards]
+
+
+def sessions_for(user_id: int):
+    # The session factory of the user's database.
+    if current is None:
+        return database.SessionLocal
+    shard = current.shard_of(user_id)
+    if shard is None:
+        raise LookupError(f"No user {user_id} in the directory")
+    return current.shards[shard].sessions
+
+
+if __name__ == '__main__':
+    settings = config.settings
+    parser = argparse.ArgumentParser(description="Move users between shards.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    rebalance = commands.add_parser('rebalance', help="even out the number of users per shard")
+    rebalance.add_argument('--limit', type=int, help="move at most this many users")
+    move = commands.add_parser('move', help="move one user")
+    move.add_argument('--user-id', type=int, required=True)
+    move.add_argument('--to', type=int, required=True, help="number of the shard")
+    args = parser.parse_args()
+    if not settings.shard_database_urls:
+        parser.error("FASTINGAPI_SHARD_DATABASE_URLS is not set")
+    database.init_engines(settings)
+    init_shards(settings)
+    if args.command == 'move':
+        print("Moved" if current.move_user(args.user_id, args.to) else "Already there")
+    else:
+        for user_id, source, target in current.rebalance(args.limit):
+            print(f"Moved user {user_id} from shard {source} to {target}")
+        print(f"Users per shard: {current.user_counts()}")
+    # Snapshots keep the rows of moved users in their old shard's files.
+    print("Run python -m fastingapi.modules.snapshots --full to rewrite the snapshots")
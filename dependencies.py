@@ -1,9 +1,210 @@
-from .database import database
+import asyncio
+from collections import defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Protocol
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from .database import database, shards
+from .modules import versions
+from . import config
+
+
+class Database(Protocol):
+    '''
+    Request scoped database handle. CRUD helpers are plain functions taking a
+    Session; run() executes one of them without blocking the event loop.
+    With shards, run() goes to the shard of its user_id or email argument,
+    run_all() to every shard and run_split() splits a list between them.
+    '''
+    shard_count: int
+
+    async def run(self, fn, *args, **kwargs):
+        ...
+
+    async def run_all(self, fn, *args, **kwargs):
+        ...
+
+    async def run_split(self, fn, name: str, values: list, user_id_of=None, **kwargs):
+        ...
+
+    async def new_user_id(self, email: str):
+        ...
+
+    async def release_user_id(self, user_id: int):
+        ...
+
+
+class SingleDatabase:
+    # All users in one database.
+    shard_count = 1
+
+    async def run_all(self, fn, *args, **kwargs):
+        return [await self.run(fn, *args, **kwargs)]
+
+    async def run_split(self, fn, name: str, values: list, user_id_of=None, **kwargs):
+        return [await self.run(fn, **{name: values}, **kwargs)]
+
+    async def new_user_id(self, email: str):
+        # The database picks it.
+        return None
+
+    async def release_user_id(self, user_id: int):
+        pass
+
+
+class SyncDatabase(SingleDatabase):
+    # Blocking session, helpers run in the threadpool.
+    def __init__(self, session):
+        self.session = session
+
+    async def run(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.session, *args, **kwargs)
+
+
+class AsyncDatabase(SingleDatabase):
+    # AsyncSession, helpers run as greenlets on the async driver.
+    def __init__(self, session):
+        self.session = session
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.session.run_sync(fn, *args, **kwargs)
+
+
+@asynccontextmanager
+async def open_session(sessions):
+    if config.settings.async_db:
+        async with sessions() as session:
+            yield AsyncDatabase(session)
+    else:
+        db = sessions()
+        try:
+            yield SyncDatabase(db)
+        finally:
+            db.close()
+
+
+class ShardedDatabase:
+    '''
+    Users spread over shards.current. A session is opened on a shard the first
+    time the request needs it, and all of them are closed with the request.
+    '''
+
+    def __init__(self, sharding: shards.Shards, read: bool = False):
+        self.sharding = sharding
+        self.read = read
+        self.shard_count = len(sharding)
+        self.sessions = {}
+        self.routes = {}
+        self.stack = AsyncExitStack()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stack.aclose()
+
+    async def shard(self, shard: int, read: bool):
+        if (shard, read) not in self.sessions:
+            sessions = self.sharding.shards[shard].session_factory(read)
+            self.sessions[shard, read] = await self.stack.enter_async_context(open_session(sessions))
+        return self.sessions[shard, read]
+
+    async def route(self, user_id: int):
+        if user_id not in self.routes:
+            self.routes[user_id] = await run_in_threadpool(self.sharding.shard_of, user_id)
+        if self.routes[user_id] is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return self.routes[user_id]
+
+    async def run(self, fn, *args, **kwargs):
+        if 'user_id' in kwargs:
+            user_id = kwargs['user_id']
+        elif 'email' in kwargs:
+            user_id = await run_in_threadpool(self.sharding.user_id_of, kwargs['email'])
+            if user_id is None:
+                return None
+        else:
+            raise TypeError(f"{fn.__name__} needs a user_id or email argument to find its shard")
+        read = self.read and not versions.wrote_recently(user_id)
+        db = await self.shard(await self.route(user_id), read)
+        return await db.run(fn, *args, **kwargs)
+
+    async def run_all(self, fn, *args, **kwargs):
+        # One result per shard, in the order of the shards.
+        dbs = [await self.shard(shard, self.read) for shard in range(self.shard_count)]
+        return await asyncio.gather(*(db.run(fn, *args, **kwargs) for db in dbs))
+
+    async def run_split(self, fn, name: str, values: list, user_id_of=None, **kwargs):
+        '''
+        Run `fn` on every shard with the `values` of its users as the `name`
+        argument. `user_id_of` gives the user of a value, the value is the id
+        without it. Values of unknown users are left out.
+        '''
+        user_id_of = user_id_of or (lambda value: value)
+        routes = await run_in_threadpool(self.sharding.shards_of, map(user_id_of, values))
+        split = defaultdict(list)
+        for value in values:
+            if user_id_of(value) in routes:
+                split[routes[user_id_of(value)]].append(value)
+        dbs = [await self.shard(shard, self.read) for shard in split]
+        return await asyncio.gather(*(db.run(fn, **{name: split[shard]}, **kwargs)
+            for db, shard in zip(dbs, split)))
+
+    async def new_user_id(self, email: str):
+        # Raises IntegrityError when the email is taken.
+        user_id, shard = await run_in_threadpool(self.sharding.register, email)
+        self.routes[user_id] = shard
+        return user_id
+
+    async def release_user_id(self, user_id: int):
+        # For a new_user_id() whose user wasn't created after all.
+        await run_in_threadpool(self.sharding.unregister, user_id)
+        self.routes.pop(user_id, None)
+
+
+@asynccontextmanager
+async def open_db(read: bool = False):
+    if shards.current is not None:
+        async with ShardedDatabase(shards.current, read) as db:
+            yield db
+    elif config.settings.async_db:
+        database.init_async_engine()
+        async with open_session(database.AsyncReadSessionLocal if read else database.AsyncSessionLocal) as db:
+            yield db
+    else:
+        async with open_session(database.ReadSessionLocal if read else database.SessionLocal) as db:
+            yield db
+
+
+def reads_from_primary(user_id: str):
+    # Path parameters are still strings here.
+    return user_id.isdigit() and versions.wrote_recently(int(user_id))
+
+
+def read_engine(user_id: int):
+    # The engine get_read_db would pick, for reads outside a session.
+    primary = versions.wrote_recently(user_id)
+    if shards.current is None:
+        return database.engine if primary else database.read_engine
+    shard = shards.current.shard_of(user_id)
+    if shard is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    shard = shards.current.shards[shard]
+    return shard.engine if primary else shard.read_engine
+
 
 # Dependency
-def get_db():
-    db = database.SessionLocal()
-    try:
+async def get_db():
+    async with open_db() as db:
+        yield db
+
+
+async def get_read_db(request: Request):
+    '''
+    For endpoints that only read. Their sessions come from the read engine,
+    except for a user who just wrote, who reads from the primary.
+    '''
+    async with open_db(read=not reads_from_primary(request.path_params.get('user_id', ''))) as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
@@ -1,37 +1,88 @@
-from typing import List
+import time
 
-import uvicorn
+# Cold start is measured from here to the end of the startup in lifespan().
+IMPORT_STARTED = time.perf_counter()
 
-from fastapi import Depends, FastAPI, HTTPException, Request, Header, Security
-from fastapi.responses import JSONResponse
-from fastapi.security.api_key import APIKeyHeader
-
-from sqlalchemy.orm import Session
-
-import sys
+import logging
 import os
+from contextlib import asynccontextmanager
 
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-sys.path.append(os.path.dirname(SCRIPT_DIR))
+from fastapi import FastAPI
 
-from fastingapi.modules import users, fasts, weights
-from fastingapi.database import database
+from fastingapi.modules import users, fasts, weights, leaderboards, live, metrics, cache, passwords, versions
+from fastingapi.database import database, migrations, shards
 from fastingapi import config
 
-database.Base.metadata.create_all(bind=database.engine)
+logger = logging.getLogger(__name__)
+
+
+def lifespan(settings: config.Settings):
+    @asynccontextmanager
+    async def run(app: FastAPI):
+        # Runs in every worker process, after it was started.
+        database.init_engines(settings)
+        shards.init_shards(settings)
+        for engine in shards.user_engines():
+            if settings.auto_migrate:
+                migrations.upgrade(engine)
+            else:
+                migrations.check(engine)
+        if shards.current is not None and settings.auto_migrate:
+            shards.create_directory(database.engine)
+        cache.dashboards = cache.TTLCache(settings.dashboard_cache_size, settings.dashboard_cache_ttl)
+        versions.recent_writers = cache.TTLCache(versions.RECENT_WRITERS_SIZE, settings.read_your_writes_seconds)
+        passwords.pool = passwords.HashingPool(settings.password_workers, settings.password_max_pending)
+        if settings.weight_write_behind:
+            weights.start_write_behind(settings)
+        fasts.live_fasts = live.LiveFasts(fasts.read_active_fasts, settings.live_tick_interval,
+            settings.live_sync_interval, settings.live_max_queued)
+        fasts.live_fasts.start()
+        startup_seconds = time.perf_counter() - IMPORT_STARTED
+        metrics.STARTUP_SECONDS.set(startup_seconds)
+        logger.info("Worker %d ready %.3f s after import", os.getpid(), startup_seconds)
+        yield
+        await fasts.live_fasts.stop()
+        await weights.stop_write_behind()
+        passwords.pool.shutdown()
+        await shards.dispose_shards()
+        await database.dispose_engines()
+        metrics.mark_process_dead()
+
+    return run
+
+
+def create_app(settings: config.Settings = None):
+    '''
+    Build the application. Nothing touches the database until startup, which
+    runs in each worker. `settings` become the settings of the whole process.
+    '''
+    if settings is not None:
+        config.settings = settings
+    settings = config.settings
+
+    app = FastAPI(
+        title=config.title,
+        description=config.description,
+        version=config.version,
+        openapi_tags=config.tags_metadata,
+        lifespan=lifespan(settings),
+    )
+
+    app.include_router(fasts.router, prefix="/fast", tags=["fasts"])
+    app.include_router(weights.router, prefix="/weight", tags=["weight"])
+    app.include_router(users.router, prefix="/users", tags=['users'])
+    app.include_router(leaderboards.router, prefix="/leaderboard", tags=['leaderboards'])
+
+    if settings.metrics:
+        metrics.instrument_engines()
+        app.add_middleware(metrics.MetricsMiddleware)
+        app.include_router(metrics.router)
 
-app = FastAPI(
-    title=config.title,
-    description=config.description,
-    version=config.version,
-    openapi_tags=config.tags_metadata
-)
+    @app.get("/")
+    def root():
+        return {"message": "what"}
 
-app.include_router(fasts.router, prefix="/fast", tags=["fasts"])
-app.include_router(weights.router, prefix="/weight", tags=["weight"])
-app.include_router(users.router, prefix="/users", tags=['users'])
+    return app
 
 
-@app.get("/")
-def root():
-    return {"message": "what"}
+app = create_app()
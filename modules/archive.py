@@ -0,0 +1,118 @@
+'''
+Hot/cold split of the fast history. The compaction job moves soft-deleted
+fasts, and completed fasts that ended before a horizon, from fasts to
+fasts_archive, so the table behind the dashboard and active fast queries only
+holds recent history. Reads of a user's history look at the archive only for
+times before the user's user_stats.archived_until.
+
+    python -m fastingapi.modules.archive --after-days 365
+'''
+import argparse
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database import database, shards
+from ..database.database import DBArchivedFast, DBFast, DBUserStats
+from . import stats
+
+FASTS = DBFast.__table__
+ARCHIVE = DBArchivedFast.__table__
+
+
+def needs_archive(db: Session, user_id: int, since: Optional[datetime] = None):
+    # Whether archived fasts of the user can end after `since`, or at all.
+    archived_until = db.query(DBUserStats.archived_until).filter(DBUserStats.user_id == user_id).scalar()
+    return archived_until is not None and (since is None or archived_until >= since)
+
+
+def compact(db: Session, horizon: Optional[datetime] = None, batch_size: int = 1000):
+    '''
+    Move soft-deleted fasts, and completed ones that ended before `horizon`,
+    to the archive in batches of `batch_size`, each in its own transaction.
+    Stats don't change, the archived fasts still count. Returns the number of
+    fasts moved.
+    '''
+    movable = DBFast.deleted == True
+    if horizon is not None:
+        movable = or_(movable, and_(DBFast.completed == True, DBFast.end_time < horizon))
+    moved, last_id = 0, 0
+    while True:
+        # Walking the primary key reads the table once for the whole job.
+        ids = [fast_id for fast_id, in db.query(DBFast.id).filter(DBFast.id > last_id, movable)
+            .order_by(DBFast.id).limit(batch_size)]
+        if not ids:
+            return moved
+        last_id = ids[-1]
+        db.execute(ARCHIVE.insert().from_select(list(FASTS.c.keys()),
+            select(FASTS).where(FASTS.c.id.in_(ids))))
+        shown = db.query(DBFast.user_id, func.max(DBFast.end_time)).filter(DBFast.id.in_(ids),
+            DBFast.deleted == False).group_by(DBFast.user_id)
+        for user_id, end_time in shown.all():
+            stats.record_archived(db, user_id, end_time)
+        db.query(DBFast).filter(DBFast.id.in_(ids)).delete(synchronize_session=False)
+        db.commit()
+        moved += len(ids)
+
+
+def incremental_vacuum(engine: Engine, pages: int = 1000):
+    '''
+    Give the pages freed by compaction back to the file system, `pages` per
+    transaction so writers only wait briefly. Only SQLite files with
+    auto_vacuum=INCREMENTAL can, see enable_incremental_vacuum(). Returns the
+    number of pages freed, None when it can't.
+    '''
+    if not database.is_sqlite(str(engine.url)):
+        return None
+    freed = 0
+    with engine.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            return None
+        while True:
+            free_pages = conn.exec_driver_sql("PRAGMA freelist_count").scalar()
+            if not free_pages:
+                return freed
+            # Through executescript(), a plain execute() frees a single page.
+            conn.connection.executescript(f"PRAGMA incremental_vacuum({min(pages, free_pages)})")
+            freed += min(pages, free_pages)
+
+
+def enable_incremental_vacuum(engine: Engine):
+    # Rewrites the whole file once, for files created before auto_vacuum was set.
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+
+if __name__ == '__main__':
+    settings = config.settings
+    parser = argparse.ArgumentParser(description="Move deleted and old fasts to the archive table.")
+    parser.add_argument('--after-days', type=int, default=settings.archive_after_days,
+        help="also archive completed fasts that ended more than this many days ago")
+    parser.add_argument('--batch-size', type=int, default=settings.archive_batch_size)
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+        help="switch an older SQLite file to auto_vacuum=INCREMENTAL first, rewrites the file")
+    args = parser.parse_args()
+    horizon = None
+    if args.after_days is not None:
+        horizon = datetime.utcnow() - timedelta(days=args.after_days)
+    # Every shard in turn.
+    shards.init_shards(settings)
+    for engine, sessions in zip(shards.user_engines(), shards.user_sessions()):
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum(engine)
+        db = sessions()
+        try:
+            print(f"Archived {compact(db, horizon, args.batch_size)} fasts in {engine.url.database}")
+        finally:
+            db.close()
+        freed = incremental_vacuum(engine, settings.archive_vacuum_pages)
+        if freed is None:
+            print("Incremental vacuum is off for this database, see --enable-incremental-vacuum")
+        else:
+            print(f"Freed {freed} pages")
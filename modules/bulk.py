@@ -0,0 +1,212 @@
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import AsyncIterator, Callable, Iterable, List
+from pydantic import BaseModel, ValidationError
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+
+from fastapi.responses import StreamingResponse
+
+from .. import config
+from ..database import database, shards
+
+# Rows are written with one executemany and one commit per batch.
+BATCH_SIZE = 5000
+# Only the first errors are kept so a broken file can't grow the report
+# without bound; `failed` still counts all of them.
+MAX_REPORTED_ERRORS = 100
+# Rows fetched from the cursor and written to the response at a time.
+EXPORT_CHUNK_SIZE = 1000
+
+
+class FileFormat(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+MEDIA_TYPES = {
+    FileFormat.ndjson: 'application/x-ndjson',
+    FileFormat.csv: 'text/csv',
+}
+
+
+class RowError(BaseModel):
+    line: int
+    error: str
+
+
+class ImportReport(BaseModel):
+    imported: int = 0
+    failed: int = 0
+    errors: List[RowError] = []
+
+
+def describe_error(error: Exception):
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+    return str(error)
+
+
+class Importer:
+    '''
+    Parses and validates one line at a time and hands out full batches of
+    table rows. `convert` turns a parsed record into a row dict, or raises.
+    '''
+
+    def __init__(self, convert: Callable[[dict], dict], format: FileFormat):
+        self.convert = convert
+        self.format = format
+        self.report = ImportReport()
+        self.batch = []
+        self.header = None
+        self.line_number = 0
+
+    def parse(self, line: str):
+        if self.format == FileFormat.ndjson:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("expected a JSON object")
+            return record
+        # One record per line, quoted fields can't contain newlines.
+        values = next(csv.reader([line]))
+        if self.header is None:
+            self.header = values
+            return None
+        if len(values) != len(self.header):
+            raise ValueError(f"expected {len(self.header)} fields, got {len(values)}")
+        return {key: value for key, value in zip(self.header, values) if value != ''}
+
+    def feed(self, line: str):
+        self.line_number += 1
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            return None
+        try:
+            record = self.parse(line)
+            if record is None:
+                return None
+            self.batch.append(self.convert(record))
+        except (ValueError, TypeError, ValidationError) as e:
+            self.report.failed += 1
+            if len(self.report.errors) < MAX_REPORTED_ERRORS:
+                self.report.errors.append(RowError(line=self.line_number, error=describe_error(e)))
+            return None
+        if len(self.batch) >= BATCH_SIZE:
+            return self.take_batch()
+        return None
+
+    def take_batch(self):
+        batch, self.batch = self.batch, []
+        self.report.imported += len(batch)
+        return batch
+
+
+async def aiter_lines(chunks: AsyncIterator[bytes]):
+    pending = b''
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield line.decode('utf-8-sig')
+    if pending:
+        yield pending.decode('utf-8-sig')
+
+
+async def import_stream(db, chunks: AsyncIterator[bytes], format: FileFormat,
+        convert: Callable[[dict], dict], insert: Callable, user_id: int):
+    '''
+    Import a request body as it arrives. Memory use is bounded by the batch
+    size, whatever the size of the upload.
+    '''
+    importer = Importer(convert, format)
+    async for line in aiter_lines(chunks):
+        batch = importer.feed(line)
+        if batch:
+            await db.run(insert, user_id=user_id, rows=batch)
+    batch = importer.take_batch()
+    if batch:
+        await db.run(insert, user_id=user_id, rows=batch)
+    return importer.report
+
+
+def import_lines(db, lines: Iterable[str], format: FileFormat,
+        convert: Callable[[dict], dict], insert: Callable, user_id: int):
+    importer = Importer(convert, format)
+    for line in lines:
+        batch = importer.feed(line)
+        if batch:
+            insert(db, user_id=user_id, rows=batch)
+    batch = importer.take_batch()
+    if batch:
+        insert(db, user_id=user_id, rows=batch)
+    return importer.report
+
+
+def export_value(value):
+    # Same encoding as the JSON API: ISO datetimes and durations in seconds.
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return value
+
+
+def export_rows(statement: Select, format: FileFormat, engine: Engine = None):
+    '''
+    Yield the result of `statement` encoded chunk by chunk. Rows come from a
+    streaming cursor as plain tuples, no ORM objects or response models are
+    built, so memory stays flat for any history length.
+    '''
+    with (engine or database.engine).connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_CHUNK_SIZE).execute(statement)
+        keys = list(result.keys())
+        if format == FileFormat.csv:
+            yield ','.join(keys) + '\n'
+        for rows in result.partitions():
+            out = io.StringIO()
+            if format == FileFormat.csv:
+                writer = csv.writer(out, lineterminator='\n')
+                writer.writerows([export_value(value) for value in row] for row in rows)
+            else:
+                for row in rows:
+                    out.write(json.dumps(dict(zip(keys, map(export_value, row)))))
+                    out.write('\n')
+            yield out.getvalue()
+
+
+def export_response(statement: Select, format: FileFormat, filename: str, engine: Engine = None):
+    # A sync generator, so Starlette reads the cursor in the threadpool.
+    return StreamingResponse(export_rows(statement, format, engine), media_type=MEDIA_TYPES[format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}.{format.value}"'})
+
+
+if __name__ == '__main__':
+    from . import fasts, weights
+
+    kinds = {
+        'fasts': (fasts.fast_import_row, fasts.import_fasts),
+        'weights': (weights.weight_import_row, weights.import_weights),
+    }
+    parser = argparse.ArgumentParser(description="Import fast or weight history from NDJSON or CSV.")
+    parser.add_argument('kind', choices=kinds)
+    parser.add_argument('path', help="file to import, - for stdin")
+    parser.add_argument('--user-id', type=int, required=True)
+    parser.add_argument('--format', type=FileFormat, choices=list(FileFormat),
+        default=FileFormat.ndjson)
+    args = parser.parse_args()
+
+    convert, insert = kinds[args.kind]
+    source = sys.stdin if args.path == '-' else open(args.path, encoding='utf-8-sig')
+    shards.init_shards(config.settings)
+    db = shards.sessions_for(args.user_id)()
+    try:
+        report = import_lines(db, source, args.format, convert, insert, args.user_id)
+        print(report.json(indent=2))
+    finally:
+        db.close()
+        source.close()
@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .. import config
+
+
+class TTLCache:
+    '''
+    Bounded LRU cache whose entries also expire after `ttl` seconds. Safe to
+    use from the threadpool. Each worker process has its own copy, so the TTL
+    bounds how stale an entry can get when another worker did the write.
+    '''
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped by every invalidation, see set().
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, generation: int):
+        '''
+        Store a value read from the database when the cache was at `generation`.
+        If anything was invalidated since, the value may predate that write
+        and is dropped.
+        '''
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def counters(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+            invalidations=self.invalidations, size=len(self.entries))
+
+
+# Assembled GET /users/{user_id} payloads with the user's version they were
+# read at, keyed by user id. Anything that changes a user's fasts, weights or
+# stats must invalidate their entry after committing.
+dashboards = TTLCache(config.settings.dashboard_cache_size, config.settings.dashboard_cache_ttl)
+
+
+def invalidate_dashboard(user_id: int):
+    dashboards.invalidate(user_id)
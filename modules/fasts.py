@@ -1,13 +1,21 @@
+import heapq
 import re
+from sqlalchemy import DateTime, String, insert, literal, or_, select, tuple_, type_coerce, union_all, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from pydantic import BaseModel, ValidationError, validator
 
-from fastapi import Depends, APIRouter, HTTPException
+from fastapi import Depends, APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
-from ..database.database import DBFast
-from ..dependencies import get_db
+from .. import config
+from ..database import database
+from ..database.database import DBArchivedFast, DBFast
+from ..dependencies import Database, get_db, get_read_db, read_engine
+from . import archive, bulk, cache, live, pagination, responses, stats, versions
 
 router = APIRouter()
 
@@ -15,14 +23,17 @@ class FastBase(BaseModel):
     pass
 
 
+DEFAULT_DURATION = 23
+
+
 class FastCreate(FastBase):
     '''
     Create fast by sending start time and one of the planned duration (in hours) or planned end date
     information in the message body. 
     '''
     start_time: datetime
-    planned_duration: Optional[float] = 23
-    planned_end_time: Optional[datetime] = start_time + timedelta(hours=23)
+    planned_duration: Optional[float] = DEFAULT_DURATION
+    planned_end_time: Optional[datetime] = None
 
     @validator('start_time')
     def future_date(cls, dt):
@@ -56,51 +67,283 @@ class FastEnd(FastBase):
         return dt
 
 
-def get_fasts(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(DBFast).filter(DBFast.user_id == user_id).offset(skip).limit(limit).all()
+class FastImport(BaseModel):
+    '''
+    One completed fast of an imported history. Planned duration defaults to the
+    actual one.
+    '''
+    start_time: datetime
+    end_time: datetime
+    planned_duration: Optional[float] = None
+
+    @validator('end_time')
+    def after_start(cls, dt, values):
+        if 'start_time' in values and dt < values['start_time']:
+            raise ValueError("End time can't be before start time")
+        return dt
+
+
+def fast_import_row(record: dict):
+    fast = FastImport(**record)
+    duration = fast.end_time - fast.start_time
+    planned_duration = fast.planned_duration or duration.total_seconds() / 3600
+    return dict(start_time=fast.start_time, end_time=fast.end_time, duration=duration,
+        planned_duration=planned_duration,
+        planned_end_time=fast.start_time + timedelta(hours=planned_duration),
+        completed=True, deleted=False)
+
+
+def import_fasts(db: Session, user_id: int, rows: List[dict]):
+    for row in rows:
+        row['user_id'] = user_id
+    db.execute(DBFast.__table__.insert(), rows)
+    hours = [row['duration'].total_seconds() / 3600 for row in rows]
+    stats.record_fasts(db, user_id, len(rows), sum(hours), max(hours))
+    stats.record_fast_days(db, user_id, [(row['start_time'], row['end_time']) for row in rows])
+    versions.bump(db, [user_id])
+    db.commit()
+    cache.invalidate_dashboard(user_id)
+
+
+class FastCalendar(BaseModel):
+    '''
+    Hours fasted on each day from `start` to `end`, both included: `hours[0]`
+    is the `start` day.
+    '''
+    start: date
+    end: date
+    tz: Optional[str] = None
+    total_hours: float
+    hours: List[float]
+
+
+# Twenty years of days.
+MAX_CALENDAR_DAYS = 7305
+
+
+# numpy is imported where it is used, like for the weight trend.
+def day_boundaries(start: date, end: date, tz: Optional[ZoneInfo] = None):
+    '''
+    The UTC midnights from `start` to the day after `end`, which fasts are
+    stored in. With `tz`, the midnights of that time zone in UTC, so
+    days around a DST change are 23 or 25 hours long.
+    '''
+    import numpy as np
+    days = np.arange(np.datetime64(start, 'D'), np.datetime64(end, 'D') + 2)
+    if tz is None:
+        return days.astype('datetime64[s]')
+
+    def offset(day: date):
+        midnight = datetime.combine(day, time(), tz).astimezone(timezone.utc).replace(tzinfo=None)
+        return (midnight - datetime.combine(day, time())) // timedelta(seconds=1)
+
+    # Offsets only change at DST changes, which are months apart: take them
+    # weekly and day by day only in the weeks they change in.
+    sampled = np.append(np.arange(0, len(days) - 1, 7), len(days) - 1)
+    sampled_offsets = [offset(day) for day in days[sampled].tolist()]
+    offsets = np.repeat(sampled_offsets[:-1], np.diff(sampled)).tolist() + sampled_offsets[-1:]
+    for i in np.flatnonzero(np.diff(sampled_offsets)):
+        for day in range(sampled[i] + 1, sampled[i + 1]):
+            offsets[day] = offset(days[day].item())
+    return days.astype('datetime64[s]') + np.array(offsets, dtype='timedelta64[s]')
+
+
+def hours_per_day(starts: 'np.ndarray', ends: 'np.ndarray', boundaries: 'np.ndarray'):
+    '''
+    Split the fasts from `starts` to `ends` at the sorted `boundaries` and sum
+    the hours of each day between two boundaries. Parts outside the first and
+    last boundary are dropped.
+    '''
+    import numpy as np
+    edges = boundaries.astype('int64')
+    days = len(edges) - 1
+    starts = np.clip(starts.astype('int64'), edges[0], edges[-1])
+    ends = np.clip(ends.astype('int64'), edges[0], edges[-1])
+    inside = ends > starts
+    starts, ends = starts[inside], ends[inside]
+    first = np.searchsorted(edges, starts, side='right') - 1
+    # A fast ending at midnight ends on the day before.
+    last = np.searchsorted(edges, ends, side='left') - 1
+
+    # Every day from the first to the last is counted whole, less the part
+    # before the start on the first day and after the end on the last day.
+    covering = np.cumsum(np.bincount(first, minlength=days + 1) - np.bincount(last + 1, minlength=days + 1))
+    seconds = covering[:days] * np.diff(edges).astype(float)
+    seconds -= np.bincount(first, starts - edges[first], days)
+    seconds -= np.bincount(last, edges[last + 1] - ends, days)
+    return seconds / 3600
+
+
+def get_fast_calendar(db: Session, user_id: int, start: date, end: date, tz: Optional[ZoneInfo] = None):
+    import numpy as np
+    boundaries = day_boundaries(start, end, tz)
+    range_start, range_end = boundaries[0].item(), boundaries[-1].item()
+    # SQLite stores ISO strings, numpy parses them many times faster than
+    # the DateTime type and numpy from datetime objects.
+    models = (DBFast, DBArchivedFast) if archive.needs_archive(db, user_id, range_start) else (DBFast,)
+    rows = [row for model in models for row in db.execute(select(type_coerce(model.start_time, String),
+        type_coerce(model.end_time, String), model.completed).where(model.user_id == user_id,
+        model.deleted == False, model.start_time < range_end,
+        or_(model.completed == False, model.end_time > range_start)))]
+    starts, ends, completed = zip(*rows) if rows else ((), (), ())
+    starts = np.array(starts, dtype='datetime64[us]').astype('datetime64[s]')
+    ends = np.array(ends, dtype='datetime64[us]').astype('datetime64[s]')
+    # A fast in progress counts up to now, on the clock of end_user_fast.
+    ends = np.where(np.array(completed, dtype=bool), ends, np.datetime64(datetime.now(), 's'))
+    hours = hours_per_day(starts, ends, boundaries)
+    return FastCalendar(start=start, end=end, tz=tz and tz.key, total_hours=hours.sum(),
+        hours=hours.tolist())
+
+
+def export_fasts_statement(user_id: int):
+    # The archive too, export and import again must give the whole history.
+    history = union_all(*(select(model.id, model.start_time, model.end_time, model.completed,
+        model.duration, model.planned_end_time, model.planned_duration).where(
+        model.user_id == user_id, model.deleted == False) for model in (DBFast, DBArchivedFast))).subquery()
+    return select(history).order_by(history.c.start_time, history.c.id)
+
+
+# The fields of Fast, for queries that skip the ORM.
+FAST_COLUMNS = (DBFast.id, DBFast.user_id, DBFast.start_time, DBFast.end_time, DBFast.completed,
+    DBFast.duration, DBFast.planned_end_time, DBFast.planned_duration)
+
+
+def query_fasts(db: Session, model, user_id: int, limit: int, after: Optional[Tuple[datetime, int]] = None,
+        columns: bool = False):
+    query = db.query(*(getattr(model, column.key) for column in FAST_COLUMNS)) if columns else db.query(model)
+    query = query.filter(model.user_id == user_id, model.deleted == False).order_by(model.start_time, model.id)
+    if after:
+        query = query.filter(tuple_(model.start_time, model.id) > tuple_(*after))
+    return query.limit(limit)
+
+
+def get_fasts(db: Session, user_id: int, skip: int = 0, limit: int = 100,
+        after: Optional[Tuple[datetime, int]] = None, columns: bool = False):
+    '''
+    With columns, rows of FAST_COLUMNS instead of DBFast objects. Archived
+    fasts are merged in only when the page can reach back to them.
+    '''
+    if not archive.needs_archive(db, user_id, after[0] if after else None):
+        query = query_fasts(db, DBFast, user_id, limit, after, columns)
+        return (query.offset(skip) if skip and not after else query).all()
+    skip = 0 if after else skip
+    merged = heapq.merge(*(query_fasts(db, model, user_id, skip + limit, after, columns)
+        for model in (DBArchivedFast, DBFast)), key=lambda fast: (fast.start_time, fast.id))
+    return list(merged)[skip:skip + limit]
+
+
+def decode_fast_cursor(cursor: str):
+    key = pagination.decode_cursor(cursor)
+    try:
+        start_time, fast_id = key
+        return datetime.fromisoformat(start_time), int(fast_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 
 def get_active_fast(db: Session, user_id: int):
     return db.query(DBFast).filter(DBFast.user_id == user_id, 
-        DBFast.completed == False).first()
+        DBFast.completed == False).order_by(DBFast.id).first()
+
+
+def get_active_fasts(db: Session, user_ids: List[int], columns: bool = False):
+    # Same pick as get_active_fast when a user somehow has several: the oldest.
+    active_fasts = {}
+    query = db.query(*FAST_COLUMNS) if columns else db.query(DBFast)
+    for fast in query.filter(DBFast.user_id.in_(user_ids),
+            DBFast.completed == False).order_by(DBFast.id):
+        active_fasts.setdefault(fast.user_id, fast)
+    return active_fasts
+
+
+def get_live_fast(db: Session, user_id: int):
+    active_fast = get_active_fast(db, user_id)
+    fast = active_fast and Fast.from_orm(active_fast)
+    # The stream outlives the request, its connection goes back to the pool now.
+    db.rollback()
+    return fast
+
+
+def read_active_fasts(db: Session, user_ids: List[int]):
+    return {user_id: Fast.from_orm(fast) for user_id, fast in get_active_fasts(db, user_ids).items()}
+
+
+# Replaced at startup with one made from the settings, which also starts the ticks.
+live_fasts = live.LiveFasts(read_active_fasts, config.settings.live_tick_interval,
+    config.settings.live_sync_interval, config.settings.live_max_queued)
 
 
 def create_user_fast(db: Session, fast: FastCreate, user_id: int):
+    if not fast.planned_duration and not fast.planned_end_time:
+        fast.planned_duration = DEFAULT_DURATION
     if fast.planned_duration:
         fast.planned_end_time = fast.start_time + timedelta(hours=fast.planned_duration)
     if not fast.planned_duration:
-        fast.planned_duration = (fast.planned_end_time - fast.start_time).seconds / 3600
+        fast.planned_duration = (fast.planned_end_time - fast.start_time).total_seconds() / 3600
 
-    db_fast = DBFast(**fast.dict(), user_id=user_id, deleted = False,
-    completed = False)
-    db.add(db_fast)
+    # The unique index on active fasts decides between racing requests, there
+    # is no check beforehand. Returns a row of FAST_COLUMNS, None when the
+    # user already has a fast in progress.
+    try:
+        created = db.execute(insert(DBFast).values(**fast.dict(), user_id=user_id, deleted=False,
+            completed=False).returning(*FAST_COLUMNS)).one()
+    except IntegrityError as error:
+        db.rollback()
+        if not violates_active_fast_index(error):
+            raise
+        return None
+    versions.bump(db, [user_id])
     db.commit()
-    db.refresh(db_fast)
-    return db_fast
+    cache.invalidate_dashboard(user_id)
+    return created
+
 
+def violates_active_fast_index(error: IntegrityError):
+    # SQLite names the indexed column, server databases the index.
+    message = str(error.orig)
+    return 'ix_fasts_user_id_active' in message or 'fasts.user_id' in message
 
-def end_user_fast(db: Session, fast: FastEnd, active_fast):
-    if fast.end_time:
-        active_fast.end_time = fast.end_time
-    else:
-        active_fast.end_time = datetime.now()
-    active_fast.completed = True
-    active_fast.duration = active_fast.end_time - active_fast.start_time
+
+def end_user_fast(db: Session, fast: FastEnd, user_id: int):
+    '''
+    End the user's fast in progress in one UPDATE, which also checks it
+    started before the end time. Returns a row of FAST_COLUMNS, None when
+    there is no such fast.
+    '''
+    end_time = fast.end_time or datetime.now()
+    ended = db.execute(update(DBFast).where(DBFast.user_id == user_id, DBFast.completed == False,
+        DBFast.start_time <= end_time).values(end_time=end_time, completed=True,
+        duration=database.elapsed(literal(end_time, DateTime), DBFast.start_time))
+        .returning(*FAST_COLUMNS).execution_options(synchronize_session=False)).first()
+    if ended is None:
+        db.rollback()
+        return None
+    stats.record_fast(db, ended)
+    versions.bump(db, [user_id])
     db.commit()
-    db.refresh(active_fast)
-    return active_fast
+    cache.invalidate_dashboard(user_id)
+    return ended
 
 def delete_user_fast(db: Session, user_id:int, fast_id: int):
     fast = db.query(DBFast).filter(DBFast.user_id == user_id, 
         DBFast.id == fast_id).first()
+    if fast is None:
+        fast = db.query(DBArchivedFast).filter(DBArchivedFast.user_id == user_id,
+            DBArchivedFast.id == fast_id).first()
+    if fast is None:
+        return None
+    if fast.completed and not fast.deleted:
+        stats.remove_fast(db, fast)
     fast.deleted = True
     fast.completed = True
+    versions.bump(db, [user_id])
     db.commit()
+    cache.invalidate_dashboard(user_id)
     return fast
 
 @router.post("/{user_id}/fasts/", response_model=Fast)
-def create_fast_for_user(
-    user_id: int, fast: FastCreate, db: Session = Depends(get_db)
+async def create_fast_for_user(
+    user_id: int, fast: FastCreate, db: Database = Depends(get_db)
 ):
     '''
     Creates a new fast for the active user either with planned end time (without 
@@ -108,32 +351,130 @@ def create_fast_for_user(
     If both parameters are present, planned duration wins. If none of them specified,
     default is 23 hours.
     '''
-    active_fast = get_active_fast(db, user_id=user_id)
-    if active_fast:
-        raise HTTPException(status_code=400, detail="Already a fast is in progress")
-    if fast.planned_end_time < fast.start_time:
+    if fast.planned_end_time and fast.planned_end_time < fast.start_time:
         raise HTTPException(status_code=400, detail="End time can't be before start time")
-    return create_user_fast(db=db, fast=fast, user_id=user_id)
+    created = await db.run(create_user_fast, fast=fast, user_id=user_id)
+    if created is None:
+        raise HTTPException(status_code=400, detail="Already a fast is in progress")
+    created_fast = Fast.from_orm(created)
+    live_fasts.publish(user_id, 'started', created_fast)
+    return created_fast
 
 
 @router.post("/{user_id}/end_fast/", response_model=Fast)
-def end_fast_for_user(
-    user_id: int, fast: FastEnd, db: Session = Depends(get_db)
+async def end_fast_for_user(
+    user_id: int, fast: FastEnd, db: Database = Depends(get_db)
+):
+    ended = await db.run(end_user_fast, fast=fast, user_id=user_id)
+    if ended is None:
+        # Only failed requests read the fast to tell why.
+        if not await db.run(get_active_fast, user_id=user_id):
+            raise HTTPException(status_code=400, detail="There is no fast is in progress")
+        raise HTTPException(status_code=400, detail="End date cannnot be before start date.")
+    ended_fast = Fast.from_orm(ended)
+    live_fasts.publish(user_id, 'ended', ended_fast)
+    return ended_fast
+
+
+@router.get("/{user_id}/fasts/", response_model=List[Fast], responses=pagination.NEXT_CURSOR_RESPONSES)
+async def read_fasts(request: Request, response: Response, user_id: int, skip: int = 0,
+    limit: int = 100, cursor: Optional[str] = None, db: Database = Depends(get_read_db)
+):
+    '''
+    Fasts of the user ordered by start time, without deleted ones. When there are more, the X-Next-Cursor
+    response header holds the `cursor` for the next page. Paging with `skip`
+    still works but gets slower the further you go. Send the ETag back in
+    If-None-Match to get an empty 304 when nothing changed.
+    '''
+    pagination.check_paging(skip, cursor)
+    after = decode_fast_cursor(cursor) if cursor else None
+    # Read before the fasts, so a write in between makes the ETag older, not newer.
+    version = await db.run(versions.get_version, user_id=user_id)
+    not_modified = versions.not_modified(request, version)
+    if not_modified:
+        return not_modified
+    fast_json = config.settings.fast_json
+    all_fasts = await db.run(get_fasts, user_id=user_id, skip=skip, limit=limit, after=after,
+        columns=fast_json)
+    next_cursor = pagination.next_cursor(all_fasts, limit, lambda fast: (fast.start_time, fast.id))
+    if fast_json:
+        # Headers set on the injected response don't apply to a returned one.
+        response = responses.RowsResponse([fast._asdict() for fast in all_fasts])
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    if version:
+        response.headers.update(versions.validators(version))
+    return response if fast_json else all_fasts
+
+@router.get("/{user_id}/calendar", response_model=FastCalendar)
+async def read_fast_calendar(user_id: int, start: Optional[date] = Query(None, alias='from'),
+    end: Optional[date] = Query(None, alias='to'), tz: Optional[str] = None,
+    db: Database = Depends(get_read_db)
 ):
-    active_fast = get_active_fast(db, user_id=user_id)
-    if not active_fast:
-        raise HTTPException(status_code=400, detail="There is no fast is in progress")
-    if fast.end_time < active_fast.start_time:
+    '''
+    Hours fasted on each day from `from` to `to`, both included, for a calendar
+    heatmap. Without them, the year up to today. Fasts are split at the
+    midnights of `tz`, a time zone name like Europe/Istanbul, or UTC when it
+    isn't given. A fast in progress counts up to now, deleted fasts don't
+    count.
+    '''
+    try:
+        zone = ZoneInfo(tz) if tz else None
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(status_code=400, detail="Unknown time zone")
+    end = end or datetime.now(zone or timezone.utc).date()
+    start = start or end - timedelta(days=364)
+    if end < start:
         raise HTTPException(status_code=400, detail="End date cannnot be before start date.")
-    return end_user_fast(db=db, fast=fast, active_fast=active_fast)
+    if (end - start).days >= MAX_CALENDAR_DAYS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_CALENDAR_DAYS} days at a time")
+    return await db.run(get_fast_calendar, user_id=user_id, start=start, end=end, tz=zone)
+
+
+@router.get("/{user_id}/live", response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}})
+async def stream_fast(user_id: int, db: Database = Depends(get_read_db)):
+    '''
+    Server-sent events instead of polling the dashboard for the live duration:
+    first a `fast` event with the active fast or null, then `tick` events with
+    the `duration` in seconds so far, and `started`, `ended` and `deleted`
+    events with the fast when it changes. A `fast` event can come again when
+    the fast was changed through another worker. Browsers reconnect by
+    themselves when a worker restarts.
+    '''
+    return StreamingResponse(live_fasts.stream(user_id, lambda: db.run(get_live_fast, user_id=user_id)),
+        media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.post("/{user_id}/import", response_model=bulk.ImportReport)
+async def import_fasts_for_user(
+    user_id: int, request: Request, format: bulk.FileFormat = bulk.FileFormat.ndjson,
+    db: Database = Depends(get_db)
+):
+    '''
+    Bulk import completed fasts from a request body of NDJSON objects or CSV with
+    a header row, with start_time, end_time and optionally planned_duration.
+    Invalid rows are skipped and reported with their line number.
+    '''
+    return await bulk.import_stream(db, request.stream(), format, fast_import_row,
+        import_fasts, user_id)
+
 
+@router.get("/{user_id}/export")
+def export_fasts_for_user(user_id: int, format: bulk.FileFormat = bulk.FileFormat.ndjson):
+    '''
+    Download the whole fast history as NDJSON or CSV, streamed as it is read.
+    The CSV can be imported again with the import endpoint.
+    '''
+    return bulk.export_response(export_fasts_statement(user_id), format, f"fasts-{user_id}",
+        read_engine(user_id))
 
-@router.get("/{user_id}/fasts/", response_model=List[Fast])
-def read_fasts(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    all_fasts = get_fasts(db, user_id=user_id, skip=skip, limit=limit)
-    return all_fasts
 
 @router.get("/{user_id}/delete_fast/{fast_id}", response_model=Fast)
-def delete_fast(user_id:int,fast_id:int,db:Session=Depends(get_db)):
-    deleted_fast = delete_user_fast(db,user_id=user_id,fast_id=fast_id)
+async def delete_fast(user_id:int,fast_id:int,db:Database=Depends(get_db)):
+    deleted_fast = await db.run(delete_user_fast,user_id=user_id,fast_id=fast_id)
+    if deleted_fast is None:
+        raise HTTPException(status_code=404, detail="Fast not found")
+    deleted_fast = Fast.from_orm(deleted_fast)
+    live_fasts.publish(user_id, 'deleted', deleted_fast)
     return deleted_fast
\ No newline at end of file
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Callable, List, Optional
+
+from ..dependencies import get_db
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Put on the queue by stop(), the flusher writes what it has and exits.
+STOP = object()
+
+
+class WriteBehind:
+    '''
+    Rows are queued in memory and a background task writes them in group
+    commits of up to `batch_size` rows, at most `max_delay` seconds after the
+    first row of a batch was queued. `write(db, rows)` inserts and commits a
+    batch, with shards the part of it on each shard. A full queue makes
+    callers wait. Rows still queued are lost if the process dies without
+    going through stop().
+    '''
+
+    def __init__(self, name: str, write: Callable[..., None], batch_size: int, max_delay: float,
+            max_queued: int):
+        self.name = name
+        self.write = write
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue(max_queued)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def put(self, row: dict):
+        await self.queue.put(row)
+        metrics.WRITE_BEHIND_QUEUED.labels(self.name).inc()
+
+    async def stop(self):
+        await self.queue.put(STOP)
+        await self.task
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_delay
+        while batch[-1] is not STOP and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            stopping = batch[-1] is STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                await self.flush(batch)
+            if stopping:
+                return
+
+    async def flush(self, rows: List[dict]):
+        metrics.WRITE_BEHIND_QUEUED.labels(self.name).dec(len(rows))
+        metrics.WRITE_BEHIND_BATCH.labels(self.name).observe(len(rows))
+        try:
+            async with asynccontextmanager(get_db)() as db:
+                await db.run_split(self.write, 'rows', rows, lambda row: row['user_id'])
+        except Exception:
+            metrics.WRITE_BEHIND_LOST.labels(self.name).inc(len(rows))
+            logger.exception("Could not write %d queued %s rows", len(rows), self.name)
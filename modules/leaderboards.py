@@ -0,0 +1,168 @@
+'''
+Leaderboards and rankings across users. They are read from the rollups and
+streaks that the fast write paths keep (see stats), through indexes ordered by
+hours and by streak length, so no request aggregates the fasts table. With
+shards, each one answers for its users and the answers are merged.
+'''
+import heapq
+from datetime import date, datetime
+from itertools import islice
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, Query
+from pydantic import BaseModel
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from ..database.database import DBFastingRollup, DBUserStreak
+from ..dependencies import Database, get_read_db
+from . import stats
+
+router = APIRouter()
+
+
+class HoursEntry(BaseModel):
+    rank: int
+    user_id: int
+    hours: float
+
+
+class StreakEntry(BaseModel):
+    rank: int
+    user_id: int
+    longest_streak: int
+
+
+class Ranking(BaseModel):
+    '''
+    Where a user stands: hours fasted in the month against the users who
+    fasted in it, and the longest streak against all users with one. The
+    percentile is the share of those users with less.
+    '''
+    user_id: int
+    month: date
+    month_hours: float
+    month_rank: int
+    month_percentile: float
+    current_streak: int
+    longest_streak: int
+    streak_rank: int
+    streak_percentile: float
+
+
+def ranked(rows: list, value):
+    # Ties share a rank and the next one is skipped: 1, 2, 2, 4.
+    rank, previous = 0, None
+    for position, row in enumerate(rows, 1):
+        if value(row) != previous:
+            rank, previous = position, value(row)
+        yield rank, row
+
+
+def counts(query, column, value: float):
+    '''
+    Rows of `query` above, below and level with `value`. Each count is a range
+    of the index on `column`.
+    '''
+    count = query.with_entities(func.count())
+    return (count.filter(column > value).scalar(), count.filter(column < value).scalar(),
+        count.filter(column == value).scalar())
+
+
+def standing(shard_counts):
+    # Rank and percentile from the counts of every shard.
+    above, below, level = (sum(column) for column in zip(*shard_counts))
+    total = above + below + level
+    return above + 1, 100 * below / total if total else 0
+
+
+def rollup_query(db: Session, period: str, period_start: date):
+    return db.query(DBFastingRollup).filter(DBFastingRollup.period == period,
+        DBFastingRollup.period_start == period_start)
+
+
+def get_top_hours(db: Session, period: str, period_start: date, limit: int):
+    rows = rollup_query(db, period, period_start).with_entities(DBFastingRollup.user_id,
+        DBFastingRollup.hours).order_by(DBFastingRollup.hours.desc(),
+        DBFastingRollup.user_id.desc()).limit(limit)
+    return [HoursEntry(rank=rank, user_id=row.user_id, hours=row.hours)
+        for rank, row in ranked(rows, lambda row: row.hours)]
+
+
+def get_top_streaks(db: Session, limit: int):
+    rows = db.query(DBUserStreak.user_id, DBUserStreak.longest_streak).order_by(
+        DBUserStreak.longest_streak.desc(), DBUserStreak.user_id.desc()).limit(limit)
+    return [StreakEntry(rank=rank, user_id=row.user_id, longest_streak=row.longest_streak)
+        for rank, row in ranked(rows, lambda row: row.longest_streak)]
+
+
+def merge_top(pages: list, value, limit: int):
+    # The top lists of the shards as one, in the same order and ranked again.
+    entries = list(islice(heapq.merge(*pages, key=lambda entry: (-value(entry), -entry.user_id)), limit))
+    return [entry.copy(update={'rank': rank}) for rank, entry in ranked(entries, value)]
+
+
+def get_user_totals(db: Session, user_id: int, month: date):
+    # The user's side of the Ranking, from their own shard.
+    month_hours = rollup_query(db, 'month', month).filter(DBFastingRollup.user_id == user_id).with_entities(
+        DBFastingRollup.hours).scalar() or 0
+    streak = db.query(DBUserStreak).get(user_id)
+    # A streak is current while its last day is today or yesterday.
+    current = streak and (datetime.utcnow().date() - streak.last_day).days <= 1
+    return dict(user_id=user_id, month=month, month_hours=month_hours,
+        current_streak=streak.current_streak if current else 0,
+        longest_streak=streak.longest_streak if streak else 0)
+
+
+def get_standing_counts(db: Session, month: date, month_hours: float, longest_streak: int):
+    # Everyone else's side, from one shard.
+    return (counts(rollup_query(db, 'month', month), DBFastingRollup.hours, month_hours),
+        counts(db.query(DBUserStreak), DBUserStreak.longest_streak, longest_streak))
+
+
+def build_ranking(totals: dict, shard_counts: list):
+    month_rank, month_percentile = standing(month for month, streak in shard_counts)
+    streak_rank, streak_percentile = standing(streak for month, streak in shard_counts)
+    return Ranking(**totals, month_rank=month_rank, month_percentile=month_percentile,
+        streak_rank=streak_rank, streak_percentile=streak_percentile)
+
+
+def get_ranking(db: Session, user_id: int, month: date):
+    totals = get_user_totals(db, user_id, month)
+    return build_ranking(totals, [get_standing_counts(db, month, totals['month_hours'],
+        totals['longest_streak'])])
+
+
+@router.get("/weekly", response_model=List[HoursEntry])
+async def read_weekly_leaderboard(week: Optional[date] = None, limit: int = Query(10, ge=1, le=100),
+    db: Database = Depends(get_read_db)
+):
+    '''
+    The users who fasted the most hours in the week (from Monday, in UTC) that
+    contains `week`, by default this week.
+    '''
+    week = stats.period_starts(week or datetime.utcnow().date())['week']
+    pages = await db.run_all(get_top_hours, period='week', period_start=week, limit=limit)
+    return merge_top(pages, lambda entry: entry.hours, limit)
+
+
+@router.get("/streaks", response_model=List[StreakEntry])
+async def read_streak_leaderboard(limit: int = Query(10, ge=1, le=100), db: Database = Depends(get_read_db)):
+    '''
+    The users with the longest streaks of consecutive days with fasting.
+    '''
+    pages = await db.run_all(get_top_streaks, limit=limit)
+    return merge_top(pages, lambda entry: entry.longest_streak, limit)
+
+
+@router.get("/{user_id}/ranking", response_model=Ranking)
+async def read_ranking(user_id: int, month: Optional[date] = None, db: Database = Depends(get_read_db)):
+    '''
+    The user's rank and percentile in hours fasted in the month that contains
+    `month`, by default this month, and in longest streak.
+    '''
+    month = stats.period_starts(month or datetime.utcnow().date())['month']
+    totals = await db.run(get_user_totals, user_id=user_id, month=month)
+    shard_counts = await db.run_all(get_standing_counts, month=month, month_hours=totals['month_hours'],
+        longest_streak=totals['longest_streak'])
+    return build_ranking(totals, shard_counts)
@@ -0,0 +1,148 @@
+'''
+Server-sent events with the state of a user's fast, so clients don't have to
+poll the dashboard for the live duration.
+'''
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+
+from ..dependencies import get_db
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Put on a stream's queue to end it, the client reconnects and starts over.
+CLOSE = object()
+
+# Users per query when reading the active fasts of all streams.
+SYNC_BATCH_SIZE = 500
+
+
+def event(name: str, data: str):
+    return f"event: {name}\ndata: {data}\n\n"
+
+
+class LiveFasts:
+    '''
+    The open streams of each user and the active fast of those users. The
+    fasts routes publish their changes. Every `tick_interval` a single task
+    sends each stream the duration so far, which also keeps idle connections
+    open through proxies, so an idle stream costs a queue and a suspended
+    coroutine. Changes made by other worker processes are picked up every
+    `sync_interval` by `read_active(db, user_ids)`, one query for the users
+    of all streams. A stream that falls `max_queued` events behind is closed.
+    '''
+
+    def __init__(self, read_active: Callable[[Session, List[int]], Dict[int, BaseModel]],
+            tick_interval: float, sync_interval: float, max_queued: int):
+        self.read_active = read_active
+        self.tick_interval = tick_interval
+        self.sync_interval = sync_interval
+        self.max_queued = max_queued
+        self.streams: Dict[int, Set[asyncio.Queue]] = {}
+        self.active: Dict[int, Optional[BaseModel]] = {}
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.tick())]
+        if self.sync_interval:
+            self.tasks.append(asyncio.create_task(self.sync()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for queues in self.streams.values():
+            for queue in queues:
+                self.close(queue)
+
+    def close(self, queue: asyncio.Queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(CLOSE)
+
+    def send(self, user_id: int, message: str):
+        for queue in self.streams.get(user_id, ()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.close(queue)
+
+    def publish(self, user_id: int, name: str, fast: BaseModel):
+        '''
+        Send a started, ended or deleted event with the fast to the user's
+        streams.
+        '''
+        if user_id not in self.streams:
+            return
+        if name == 'started':
+            self.active[user_id] = fast
+        elif getattr(self.active.get(user_id), 'id', None) == fast.id:
+            self.active[user_id] = None
+        self.send(user_id, event(name, fast.json()))
+
+    async def stream(self, user_id: int, read_fast: Callable[[], Awaitable[Optional[BaseModel]]]):
+        '''
+        Events for one client: the active fast (or null), then ticks and
+        changes until the client goes away.
+        '''
+        queue = asyncio.Queue(self.max_queued)
+        self.streams.setdefault(user_id, set()).add(queue)
+        metrics.LIVE_STREAMS.inc()
+        try:
+            # Read after subscribing, so no change falls in between.
+            fast = self.active[user_id] = await read_fast()
+            yield event('fast', fast.json() if fast else 'null')
+            while True:
+                message = await queue.get()
+                if message is CLOSE:
+                    return
+                yield message
+        finally:
+            metrics.LIVE_STREAMS.dec()
+            queues = self.streams[user_id]
+            queues.discard(queue)
+            if not queues:
+                del self.streams[user_id]
+                self.active.pop(user_id, None)
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            # The clock end_user_fast and the dashboard measure durations on.
+            now = datetime.now()
+            for user_id in list(self.streams):
+                fast = self.active.get(user_id)
+                duration = (now - fast.start_time).total_seconds() if fast else None
+                self.send(user_id, event('tick', json.dumps({'duration': duration})))
+
+    async def sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            user_ids = list(self.streams)
+            try:
+                async with asynccontextmanager(get_db)() as db:
+                    for start in range(0, len(user_ids), SYNC_BATCH_SIZE):
+                        batch = user_ids[start:start + SYNC_BATCH_SIZE]
+                        active = {}
+                        for shard_active in await db.run_split(self.read_active, 'user_ids', batch):
+                            active.update(shard_active)
+                        self.update(batch, active)
+            except Exception:
+                logger.exception("Could not read the active fasts of %d live streams", len(user_ids))
+
+    def update(self, user_ids: List[int], active: Dict[int, BaseModel]):
+        # Changed elsewhere: the streams get the whole state again.
+        for user_id in user_ids:
+            fast = active.get(user_id)
+            if user_id in self.streams and getattr(fast, 'id', None) != getattr(
+                    self.active.get(user_id), 'id', None):
+                self.active[user_id] = fast
+                self.send(user_id, event('fast', fast.json() if fast else 'null'))
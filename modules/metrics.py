@@ -0,0 +1,181 @@
+import logging
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+    Histogram, generate_latest, multiprocess)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from fastapi import APIRouter, Response
+
+from .. import config
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# Routes are labelled with their path template, so the number of series stays
+# bounded whatever ids the clients send.
+UNMATCHED_ROUTE = 'unmatched'
+
+REQUEST_SECONDS = Histogram('fastingapi_request_duration_seconds',
+    'Request latency by route.', ['method', 'route'])
+REQUESTS = Counter('fastingapi_requests',
+    'Requests by route and status code.', ['method', 'route', 'status'])
+IN_PROGRESS = Gauge('fastingapi_requests_in_progress', 'Requests being served.',
+    multiprocess_mode='livesum')
+REQUEST_QUERIES = Histogram('fastingapi_request_queries',
+    'SQL statements per request.', ['method', 'route'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+REQUEST_SQL_SECONDS = Histogram('fastingapi_request_sql_seconds',
+    'Time spent executing SQL per request.', ['method', 'route'])
+OVER_QUERY_BUDGET = Counter('fastingapi_requests_over_query_budget',
+    'Requests that ran more SQL statements than settings.query_budget.', ['method', 'route'])
+WRITE_BEHIND_QUEUED = Gauge('fastingapi_write_behind_queued',
+    'Rows waiting to be written.', ['queue'], multiprocess_mode='livesum')
+WRITE_BEHIND_BATCH = Histogram('fastingapi_write_behind_batch_rows',
+    'Rows per group commit.', ['queue'], buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+WRITE_BEHIND_LOST = Counter('fastingapi_write_behind_lost_rows',
+    'Queued rows that could not be written.', ['queue'])
+PASSWORD_JOBS_PENDING = Gauge('fastingapi_password_jobs_pending',
+    'Password hashes and verifies queued or running in the pool.', multiprocess_mode='livesum')
+PASSWORD_REHASHES = Counter('fastingapi_password_rehashes',
+    'Stored password hashes replaced after a successful verify.')
+LIVE_STREAMS = Gauge('fastingapi_live_streams', 'Open live fast streams.',
+    multiprocess_mode='livesum')
+STARTUP_SECONDS = Gauge('fastingapi_startup_seconds',
+    'Time from importing the app to serving requests.', multiprocess_mode='liveall')
+
+# Set by the runner when there are several workers. Every worker then writes
+# its samples to files in this directory and /metrics adds them all up.
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+
+@dataclass
+class RequestQueries:
+    count: int = 0
+    seconds: float = 0
+
+
+# Set for the duration of a request. Context variables follow the request into
+# the threadpool and into the async session's greenlets.
+current_queries: ContextVar = ContextVar('current_queries', default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current_queries.get() is not None:
+        context._query_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    queries = current_queries.get()
+    started = getattr(context, '_query_started', None)
+    if queries is not None and started is not None:
+        queries.count += 1
+        queries.seconds += time.perf_counter() - started
+
+
+def instrument_engines():
+    '''
+    Count the statements of every engine, including the ones created later
+    and the sync engine behind the async one. Safe to call more than once.
+    '''
+    for name, listener in (('before_cursor_execute', before_cursor_execute),
+            ('after_cursor_execute', after_cursor_execute)):
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+
+class MetricsMiddleware:
+    '''
+    Plain ASGI middleware, so streamed responses are timed until their last
+    chunk and nothing is buffered.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        queries = RequestQueries()
+        token = current_queries.set(queries)
+        IN_PROGRESS.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            IN_PROGRESS.dec()
+            current_queries.reset(token)
+            # The router stores the matched route in the scope.
+            route = scope.get('route')
+            observe(scope['method'], getattr(route, 'path', UNMATCHED_ROUTE), status, elapsed, queries)
+
+
+def observe(method: str, route: str, status: int, elapsed: float, queries: RequestQueries):
+    REQUEST_SECONDS.labels(method, route).observe(elapsed)
+    REQUESTS.labels(method, route, str(status)).inc()
+    REQUEST_QUERIES.labels(method, route).observe(queries.count)
+    REQUEST_SQL_SECONDS.labels(method, route).observe(queries.seconds)
+    if queries.count > config.settings.query_budget:
+        OVER_QUERY_BUDGET.labels(method, route).inc()
+        logger.warning("%s %s ran %d SQL statements in %.1f ms, the budget is %d", method, route,
+            queries.count, queries.seconds * 1000, config.settings.query_budget)
+
+
+class DashboardCacheCollector:
+    '''
+    Reads the counters of cache.dashboards at scrape time. Each worker has its
+    own cache, with several workers they are labelled with the worker's pid.
+    '''
+
+    def __init__(self, pid: int = None):
+        self.labels = {'pid': str(pid)} if pid else {}
+
+    def collect(self):
+        counters = cache.dashboards.counters()
+        for name in ('hits', 'misses', 'evictions', 'invalidations'):
+            family = CounterMetricFamily(f'fastingapi_dashboard_cache_{name}',
+                f'Dashboard cache {name}.', labels=list(self.labels))
+            family.add_metric(list(self.labels.values()), counters[name])
+            yield family
+        family = GaugeMetricFamily('fastingapi_dashboard_cache_entries',
+            'Dashboards in the cache.', labels=list(self.labels))
+        family.add_metric(list(self.labels.values()), counters['size'])
+        yield family
+
+
+if not MULTIPROCESS:
+    REGISTRY.register(DashboardCacheCollector())
+
+
+def mark_process_dead():
+    # Drops the live gauges of a stopped worker.
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+@router.get("/metrics", include_in_schema=False)
+def read_metrics():
+    ''' Prometheus text format. '''
+    registry = REGISTRY
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(DashboardCacheCollector(os.getpid()))
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,67 @@
+import base64
+import binascii
+import heapq
+import json
+from datetime import datetime
+from itertools import islice
+
+from fastapi import HTTPException
+
+# Keyset pagination: a cursor holds the sort key of the last row of a page, so
+# the next page is an index range lookup instead of an OFFSET scan. The cursor
+# is handed to clients in this header and is opaque to them. A front end served
+# from another origin can only read it if CORS lists it in expose_headers.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# OpenAPI documentation of the header for paged routes.
+NEXT_CURSOR_RESPONSES = {
+    200: {
+        "headers": {
+            NEXT_CURSOR_HEADER: {
+                "description": "Pass as `cursor` to get the next page. Missing on the last page.",
+                "schema": {"type": "string"},
+            }
+        }
+    }
+}
+
+
+def encode_cursor(*key):
+    data = json.dumps([value.isoformat() if isinstance(value, datetime) else value
+        for value in key])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        key = json.loads(data)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(key, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+def check_paging(skip: int, cursor: str):
+    if skip and cursor:
+        raise HTTPException(status_code=400, detail="Use either skip or cursor, not both")
+
+
+def next_cursor(rows: list, limit: int, key):
+    '''Cursor for the page after `rows`, or None when this was the last page.'''
+    if not rows or len(rows) < limit:
+        return None
+    return encode_cursor(*key(rows[-1]))
+
+
+async def gather_page(db, fn, key, skip: int, limit: int, **kwargs):
+    '''
+    A page of `fn`, a helper taking skip and limit that returns rows ordered by
+    `key`, across all shards of `db`. Every shard returns up to skip + limit
+    rows, so deep skips cost more with shards; cursors don't.
+    '''
+    if db.shard_count == 1:
+        return (await db.run_all(fn, skip=skip, limit=limit, **kwargs))[0]
+    pages = await db.run_all(fn, skip=0, limit=skip + limit, **kwargs)
+    return list(islice(heapq.merge(*pages, key=key), skip, skip + limit))
@@ -0,0 +1,28 @@
+# Runs in the processes of passwords.pool, which import nothing else of the app
+# and so start quickly.
+import hmac
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+# Passwords were stored as password + LEGACY_SUFFIX before hashing. Those are
+# replaced by a real hash on the next successful verify.
+LEGACY_SUFFIX = "notreallyhashed"
+
+
+def hash_in_worker(password: str, params: dict):
+    return PasswordHasher(**params).hash(password)
+
+
+def verify_in_worker(hashed_password: str, password: str, params: dict):
+    hasher = PasswordHasher(**params)
+    if hashed_password.endswith(LEGACY_SUFFIX):
+        if not hmac.compare_digest(hashed_password, password + LEGACY_SUFFIX):
+            return False, None
+        return True, hasher.hash(password)
+    try:
+        hasher.verify(hashed_password, password)
+    except (VerificationError, InvalidHashError):
+        return False, None
+    # Hashed with other cost parameters than the current ones.
+    return True, hasher.hash(password) if hasher.check_needs_rehash(hashed_password) else None
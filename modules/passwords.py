@@ -0,0 +1,66 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from .. import config
+from . import metrics
+from .password_hashing import LEGACY_SUFFIX, hash_in_worker, verify_in_worker
+
+
+def hasher_params(settings: config.Settings):
+    return dict(time_cost=settings.password_time_cost, memory_cost=settings.password_memory_cost,
+        parallelism=settings.password_parallelism)
+
+
+class HashingPool:
+    '''
+    Runs argon2 in a pool of processes, so signup bursts don't block the event
+    loop or take all threadpool threads. At most `max_pending` jobs are handed
+    to the pool, more callers wait for a slot.
+    '''
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.slots = asyncio.Semaphore(max_pending)
+        self.executor = None
+
+    async def run(self, fn, *args):
+        if self.executor is None:
+            # Forking would copy the threads and connections of a worker.
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        metrics.PASSWORD_JOBS_PENDING.inc()
+        try:
+            async with self.slots:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            metrics.PASSWORD_JOBS_PENDING.dec()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+pool = HashingPool(config.settings.password_workers, config.settings.password_max_pending)
+
+
+async def hash_password(password: str):
+    return await pool.run(hash_in_worker, password, hasher_params(config.settings))
+
+
+async def verify_password(hashed_password: Optional[str], password: str) -> Tuple[bool, Optional[str]]:
+    '''
+    Returns whether the password matches and, when the stored hash is of the
+    old format or weaker than the current settings, a new hash to store.
+    '''
+    if not hashed_password:
+        # The same work as a real verify, so unknown users can't be told
+        # apart by the response time.
+        await pool.run(hash_in_worker, password, hasher_params(config.settings))
+        return False, None
+    verified, new_hash = await pool.run(verify_in_worker, hashed_password, password,
+        hasher_params(config.settings))
+    if new_hash:
+        metrics.PASSWORD_REHASHES.inc()
+    return verified, new_hash
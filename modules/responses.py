@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+import orjson
+from fastapi.responses import Response
+
+
+def encode_extra(value):
+    # Same as the default encoder: durations in seconds.
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+class RowsResponse(Response):
+    '''
+    JSON response for content that is already plain dicts and lists of column
+    values, encoded with orjson. Used by list routes when settings.fast_json is
+    on, to skip validating and encoding every row through the response model.
+    The route keeps its response_model for the docs and the rows must match it.
+    '''
+    media_type = "application/json"
+
+    def render(self, content):
+        return orjson.dumps(content, default=encode_extra)
@@ -0,0 +1,200 @@
+'''
+Columnar snapshots of the fast and weight history for analytics, so heavy
+scans read Arrow files instead of the production database.
+
+Every run rewrites the partitions of the users whose data changed since the
+last one, found through users.modified_at (see modules.versions). Each
+partition is an uncompressed Arrow IPC file holding all the rows of
+settings.snapshot_partition_users consecutive user ids, archived fasts
+included, replaced atomically so readers never see half a file. With shards
+every shard has a directory of its own, shard-N. A user moved to another
+shard stays in the old shard's files until a --full run.
+
+    python -m fastingapi.modules.snapshots
+
+and then, for instance:
+
+    from fastingapi.modules import snapshots
+    fasts = snapshots.load('fasts')
+    snapshots.hours_per_user(fasts)
+'''
+import argparse
+import json
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from sqlalchemy import select, union_all
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database import database, shards
+from ..database.database import DBArchivedFast, DBFast, DBUser, DBWeight
+
+# Writes commit a little after they bump modified_at, so every run looks
+# back this far past the previous one. Rewriting a partition twice is harmless.
+OVERLAP = timedelta(minutes=5)
+
+STATE_FILE = '_state.json'
+
+SCHEMAS = {
+    'fasts': pa.schema([
+        ('id', pa.int64()),
+        ('user_id', pa.int64()),
+        ('start_time', pa.timestamp('us')),
+        ('end_time', pa.timestamp('us')),
+        ('completed', pa.bool_()),
+        ('deleted', pa.bool_()),
+        ('duration', pa.duration('us')),
+        ('planned_end_time', pa.timestamp('us')),
+        ('planned_duration', pa.float64()),
+    ]),
+    'weights': pa.schema([
+        ('id', pa.int64()),
+        ('user_id', pa.int64()),
+        ('weight_time', pa.timestamp('us')),
+        ('weight', pa.float64()),
+        ('unit', pa.string()),
+        ('bmi', pa.float64()),
+    ]),
+}
+
+
+def fasts_statement(first_user: int, last_user: int):
+    # Hot and archived fasts of the user id range, in the columns of SCHEMAS.
+    return union_all(*(select(*(getattr(model, name) for name in SCHEMAS['fasts'].names)).where(
+        model.user_id >= first_user, model.user_id <= last_user) for model in (DBFast, DBArchivedFast)))
+
+
+def weights_statement(first_user: int, last_user: int):
+    return select(*(getattr(DBWeight, name) for name in SCHEMAS['weights'].names)).where(
+        DBWeight.user_id >= first_user, DBWeight.user_id <= last_user)
+
+
+STATEMENTS = {'fasts': fasts_statement, 'weights': weights_statement}
+
+
+def partition_path(directory: Path, kind: str, partition: int):
+    return directory / kind / f"part-{partition:06d}.arrow"
+
+
+def read_partition(db: Session, kind: str, partition: int, partition_users: int):
+    first_user = partition * partition_users
+    rows = db.execute(STATEMENTS[kind](first_user, first_user + partition_users - 1)).all()
+    schema = SCHEMAS[kind]
+    columns = zip(*rows) if rows else [()] * len(schema)
+    table = pa.table([pa.array(column, field.type) for column, field in zip(columns, schema)],
+        schema=schema)
+    return table.sort_by([('user_id', 'ascending'), ('id', 'ascending')])
+
+
+def write_partition(directory: Path, kind: str, partition: int, table: pa.Table):
+    path = partition_path(directory, kind, partition)
+    if not table.num_rows:
+        path.unlink(missing_ok=True)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix('.tmp')
+    with pa.OSFile(str(temporary), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(temporary, path)
+
+
+def read_state(directory: Path):
+    try:
+        return json.loads((directory / STATE_FILE).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def changed_partitions(db: Session, since: Optional[datetime], partition_users: int):
+    '''
+    Partitions with a user who wrote after `since`. Without it every partition
+    that has rows, whether or not its users still exist.
+    '''
+    if since is not None:
+        user_ids = db.execute(select(DBUser.id).where(DBUser.modified_at > since)).scalars()
+    else:
+        user_ids = db.execute(union_all(*(select(model.user_id.distinct())
+            for model in (DBFast, DBArchivedFast, DBWeight)))).scalars()
+    return sorted({user_id // partition_users for user_id in user_ids if user_id is not None})
+
+
+def snapshot(db: Session, directory: Path, partition_users: int = 1000, full: bool = False,
+        now: Optional[datetime] = None):
+    '''
+    Bring the snapshots in `directory` up to date. A full run, or one with a
+    different partition size than the files, rewrites every partition.
+    Returns the number of partitions written.
+    '''
+    directory = Path(directory)
+    now = now or datetime.utcnow()
+    state = read_state(directory)
+    since = None
+    if not full and state.get('partition_users') == partition_users and state.get('watermark'):
+        since = datetime.fromisoformat(state['watermark']) - OVERLAP
+    partitions = changed_partitions(db, since, partition_users)
+    for partition in partitions:
+        for kind in SCHEMAS:
+            write_partition(directory, kind, partition, read_partition(db, kind, partition, partition_users))
+        # One partition at a time, so a long run doesn't hold a read transaction.
+        db.rollback()
+    if since is None:
+        # Files of another partition size, or of users that are gone.
+        written = {partition_path(directory, kind, partition) for kind in SCHEMAS for partition in partitions}
+        for path in set(directory.glob('*/part-*.arrow')) - written:
+            path.unlink()
+    # Written last, a run that fails halfway is repeated from the old watermark.
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / STATE_FILE).write_text(json.dumps({'watermark': now.isoformat(),
+        'partition_users': partition_users}))
+    return len(partitions)
+
+
+def load(kind: str, directory: Optional[Path] = None):
+    '''
+    All partitions of `kind`, fasts or weights, of every shard, as one table.
+    The files are memory-mapped and not copied, the OS pages them in as they
+    are scanned.
+    '''
+    directory = Path(directory or config.settings.snapshot_dir)
+    tables = [pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+        for path in sorted(directory.glob(f'**/{kind}/part-*.arrow'))]
+    return pa.concat_tables(tables) if tables else SCHEMAS[kind].empty_table()
+
+
+def hours_per_user(fasts: pa.Table):
+    '''
+    Number of fasts and hours fasted per user, counted like user_stats: only
+    completed fasts that weren't deleted.
+    '''
+    counted = fasts.filter(pc.and_(pc.equal(fasts['completed'], True), pc.invert(fasts['deleted'])))
+    seconds = pc.divide(pc.cast(pc.subtract(counted['end_time'], counted['start_time']), pa.int64()), 1e6)
+    hours = pa.table({'user_id': counted['user_id'], 'hours': pc.divide(seconds, 3600)})
+    totals = hours.group_by('user_id').aggregate([('hours', 'count'), ('hours', 'sum')])
+    return pa.table({'user_id': totals['user_id'], 'number_of_fasts': totals['hours_count'],
+        'total_hours_fasted': totals['hours_sum']}).sort_by('user_id')
+
+
+if __name__ == '__main__':
+    settings = config.settings
+    parser = argparse.ArgumentParser(description="Write Arrow snapshots of the fasts and weights.")
+    parser.add_argument('--dir', default=settings.snapshot_dir)
+    parser.add_argument('--partition-users', type=int, default=settings.snapshot_partition_users)
+    parser.add_argument('--full', action='store_true', help="rewrite every partition")
+    args = parser.parse_args()
+    # From the replica or the read-only pool when there is one.
+    database.init_engines(settings)
+    targets = [(Path(args.dir), database.ReadSessionLocal)]
+    if shards.init_shards(settings) is not None:
+        targets = [(Path(args.dir) / f"shard-{number}", shard.read_sessions)
+            for number, shard in enumerate(shards.current.shards)]
+    for directory, sessions in targets:
+        db = sessions()
+        try:
+            print(f"Wrote {snapshot(db, directory, args.partition_users, args.full)} partitions to {directory}")
+        finally:
+            db.close()
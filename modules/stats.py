@@ -0,0 +1,336 @@
+import argparse
+import heapq
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from itertools import chain, groupby
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import bindparam, case, func, or_
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database import shards
+from ..database.database import (DBArchivedFast, DBFast, DBFastingRollup, DBUserStats, DBUserStreak,
+    DBWeight)
+from . import cache, versions
+
+
+def fast_hours(fast: DBFast):
+    return (fast.end_time - fast.start_time).total_seconds() / 3600
+
+
+def get_user_stats(db: Session, user_id: int):
+    return db.query(DBUserStats).get(user_id)
+
+
+def get_users_stats(db: Session, user_ids: list, columns: bool = False):
+    # With columns, plain rows instead of DBUserStats objects.
+    query = db.query(DBUserStats.__table__ if columns else DBUserStats)
+    return query.filter(DBUserStats.user_id.in_(user_ids)).all()
+
+
+def _update_stats(db: Session, user_id: int, values: dict):
+    # Updates are written as SQL expressions so concurrent writers add to the
+    # stored totals instead of overwriting each other's read-modify-write.
+    query = db.query(DBUserStats).filter(DBUserStats.user_id == user_id)
+    if not query.update(values, synchronize_session=False):
+        db.add(DBUserStats(user_id=user_id, number_of_fasts=0,
+            total_hours_fasted=0, longest_fast=0))
+        db.flush()
+        query.update(values, synchronize_session=False)
+
+
+def record_fasts(db: Session, user_id: int, count: int, total_hours: float, longest: float):
+    '''
+    Add completed fasts to the user's stats. Doesn't commit, so the caller's
+    commit covers both the fasts and their stats.
+    '''
+    _update_stats(db, user_id, {
+        DBUserStats.number_of_fasts: DBUserStats.number_of_fasts + count,
+        DBUserStats.total_hours_fasted: DBUserStats.total_hours_fasted + total_hours,
+        DBUserStats.longest_fast: case(
+            (DBUserStats.longest_fast < longest, longest),
+            else_=DBUserStats.longest_fast),
+    })
+
+
+def record_fast(db: Session, fast: DBFast):
+    hours = fast_hours(fast)
+    record_fasts(db, fast.user_id, 1, hours, hours)
+    record_fast_days(db, fast.user_id, [(fast.start_time, fast.end_time)])
+
+
+def remove_fast(db: Session, fast: DBFast):
+    '''
+    Take a completed fast back out of the user's stats, e.g. when it is deleted.
+    Only when it was the longest one do we go back to the fasts and the archive.
+    '''
+    hours = fast_hours(fast)
+    _update_stats(db, fast.user_id, {
+        DBUserStats.number_of_fasts: DBUserStats.number_of_fasts - 1,
+        DBUserStats.total_hours_fasted: DBUserStats.total_hours_fasted - hours,
+    })
+    stats = get_user_stats(db, fast.user_id)
+    db.refresh(stats)
+    if hours >= stats.longest_fast:
+        # Measured from start/end like everywhere else, older rows may have no duration.
+        others = chain(*(completed_fasts(db, model, fast.user_id).filter(model.id != fast.id)
+            for model in (DBFast, DBArchivedFast)))
+        stats.longest_fast = max((fast_hours(other) for other in others), default=0)
+    rollups = fast_rollups(fast.start_time, fast.end_time)
+    record_rollups(db, fast.user_id, {key: -hours for key, hours in rollups.items()})
+    # Rounding leaves a little on days that are now empty.
+    db.query(DBFastingRollup).filter(DBFastingRollup.user_id == fast.user_id,
+        DBFastingRollup.hours < 1 / 3600).delete(synchronize_session=False)
+    rebuild_streak(db, fast.user_id)
+
+
+PERIODS = ('day', 'week', 'month')
+
+
+def period_starts(day: date):
+    return dict(day=day, week=day - timedelta(days=day.weekday()), month=day.replace(day=1))
+
+
+def fast_rollups(start_time: datetime, end_time: datetime, rollups: Optional[dict] = None):
+    '''
+    Split a fast at UTC midnights and add its hours to `rollups`, keyed by
+    period and the first day of the period. Returns `rollups`.
+    '''
+    if rollups is None:
+        rollups = defaultdict(float)
+    day_start = datetime.combine(start_time.date(), time())
+    while day_start < end_time:
+        day_end = day_start + timedelta(days=1)
+        hours = (min(end_time, day_end) - max(start_time, day_start)).total_seconds() / 3600
+        if hours > 0:
+            for period, period_start in period_starts(day_start.date()).items():
+                rollups[period, period_start] += hours
+        day_start = day_end
+    return rollups
+
+
+def record_rollups(db: Session, user_id: int, rollups: Dict[Tuple[str, date], float]):
+    # Adds to the stored hours like _update_stats, rows that aren't there yet
+    # are inserted.
+    if not rollups:
+        return
+    table = DBFastingRollup.__table__
+    starts = [period_start for _, period_start in rollups]
+    existing = set(db.query(DBFastingRollup.period, DBFastingRollup.period_start).filter(
+        DBFastingRollup.user_id == user_id,
+        DBFastingRollup.period_start.between(min(starts), max(starts))))
+    updates = [dict(key_period=period, key_start=period_start, added=hours)
+        for (period, period_start), hours in rollups.items() if (period, period_start) in existing]
+    if updates:
+        db.execute(table.update().where(table.c.user_id == user_id,
+            table.c.period == bindparam('key_period'), table.c.period_start == bindparam('key_start')
+        ).values(hours=table.c.hours + bindparam('added')), updates)
+    inserts = [dict(user_id=user_id, period=period, period_start=period_start, hours=hours)
+        for (period, period_start), hours in rollups.items() if (period, period_start) not in existing]
+    if inserts:
+        db.execute(table.insert(), inserts)
+
+
+def count_streaks(days: Iterable[date], current: int = 0, longest: int = 0, last_day: date = None):
+    '''
+    Continue the streak of `current` days up to `last_day` with sorted days
+    that have fasting. Returns the current and the longest streak and the last
+    day.
+    '''
+    for day in days:
+        if last_day is not None and day <= last_day:
+            continue
+        current = current + 1 if last_day is not None and day == last_day + timedelta(days=1) else 1
+        longest = max(longest, current)
+        last_day = day
+    return current, longest, last_day
+
+
+def rebuild_streak(db: Session, user_id: int):
+    days = db.query(DBFastingRollup.period_start).filter(DBFastingRollup.user_id == user_id,
+        DBFastingRollup.period == 'day').order_by(DBFastingRollup.period_start)
+    current, longest, last_day = count_streaks(day for day, in days)
+    # In place, record_fast_days may have the row in the session already.
+    streak = db.query(DBUserStreak).get(user_id)
+    if last_day is None:
+        if streak is not None:
+            db.delete(streak)
+    elif streak is None:
+        db.add(DBUserStreak(user_id=user_id, current_streak=current, longest_streak=longest,
+            last_day=last_day))
+    else:
+        streak.current_streak, streak.longest_streak, streak.last_day = current, longest, last_day
+    db.flush()
+
+
+def record_fast_days(db: Session, user_id: int, intervals: List[Tuple[datetime, datetime]]):
+    '''
+    Add completed fasts, as (start_time, end_time), to the user's rollups and
+    streak. Doesn't commit.
+    '''
+    rollups = defaultdict(float)
+    for start_time, end_time in intervals:
+        fast_rollups(start_time, end_time, rollups)
+    record_rollups(db, user_id, rollups)
+    days = sorted(period_start for period, period_start in rollups if period == 'day')
+    if not days:
+        return
+    streak = db.query(DBUserStreak).get(user_id)
+    if streak is None or days[0] < streak.last_day:
+        # Fasts entered for the past can join or split older streaks.
+        rebuild_streak(db, user_id)
+    else:
+        streak.current_streak, streak.longest_streak, streak.last_day = count_streaks(days,
+            streak.current_streak, streak.longest_streak, streak.last_day)
+
+
+def aggregate_rollups(fasts):
+    '''
+    Compute rollup and streak rows from (user_id, start_time, end_time) rows of
+    completed fasts ordered by user. Yields them one user at a time.
+    '''
+    for user_id, user_fasts in groupby(fasts, key=lambda fast: fast.user_id):
+        rollups = defaultdict(float)
+        for fast in user_fasts:
+            fast_rollups(fast.start_time, fast.end_time, rollups)
+        if not rollups:
+            continue
+        rows = [dict(user_id=user_id, period=period, period_start=period_start, hours=hours)
+            for (period, period_start), hours in rollups.items()]
+        current, longest, last_day = count_streaks(sorted(
+            period_start for period, period_start in rollups if period == 'day'))
+        yield rows, dict(user_id=user_id, current_streak=current, longest_streak=longest,
+            last_day=last_day)
+
+
+def record_archived(db: Session, user_id: int, end_time: datetime):
+    # Fasts that ended up to end_time were moved to the archive.
+    _update_stats(db, user_id, {DBUserStats.archived_until: case(
+        (or_(DBUserStats.archived_until == None, DBUserStats.archived_until < end_time), end_time),
+        else_=DBUserStats.archived_until)})
+
+
+def record_weight(db: Session, weight: DBWeight):
+    '''
+    Keep the first and the latest reading of the user. Readings can be entered
+    for the past, so both ends are compared on weight_time.
+    '''
+    is_first = or_(DBUserStats.start_weight_time == None,
+        DBUserStats.start_weight_time > weight.weight_time)
+    is_latest = or_(DBUserStats.weight_time == None,
+        DBUserStats.weight_time <= weight.weight_time)
+    _update_stats(db, weight.user_id, {
+        DBUserStats.start_weight: case((is_first, weight.weight), else_=DBUserStats.start_weight),
+        DBUserStats.start_weight_time: case((is_first, weight.weight_time),
+            else_=DBUserStats.start_weight_time),
+        DBUserStats.weight: case((is_latest, weight.weight), else_=DBUserStats.weight),
+        DBUserStats.bmi: case((is_latest, weight.bmi), else_=DBUserStats.bmi),
+        DBUserStats.weight_time: case((is_latest, weight.weight_time), else_=DBUserStats.weight_time),
+    })
+
+
+def aggregate_stats(fasts, weights):
+    '''
+    Compute stats rows from (user_id, start_time, end_time) rows of completed
+    fasts and (user_id, weight_time, weight, bmi) rows of readings ordered by
+    user and weight_time. Returns the column values keyed by user id.
+    '''
+    stats = {}
+
+    def user_stats(user_id):
+        if user_id not in stats:
+            stats[user_id] = dict(user_id=user_id, number_of_fasts=0, total_hours_fasted=0,
+                longest_fast=0, start_weight=None, start_weight_time=None, weight=None,
+                weight_time=None, bmi=None)
+        return stats[user_id]
+
+    for fast in fasts:
+        row = user_stats(fast.user_id)
+        hours = fast_hours(fast)
+        row['number_of_fasts'] += 1
+        row['total_hours_fasted'] += hours
+        row['longest_fast'] = max(row['longest_fast'], hours)
+
+    for weight in weights:
+        row = user_stats(weight.user_id)
+        if row['start_weight_time'] is None:
+            row['start_weight'] = weight.weight
+            row['start_weight_time'] = weight.weight_time
+        row['weight'] = weight.weight
+        row['weight_time'] = weight.weight_time
+        row['bmi'] = weight.bmi
+    return stats
+
+
+def completed_fasts(db: Session, model=DBFast, user_id: int = None):
+    # Fasts that count in the stats, of the hot table or of the archive.
+    query = db.query(model.user_id, model.start_time, model.end_time).filter(
+        model.completed == True, model.deleted == False, model.end_time != None)
+    if user_id is not None:
+        query = query.filter(model.user_id == user_id)
+    return query
+
+
+def rebuild_rollups(db: Session, fasts, user_id: int = None):
+    # `fasts` are rows of completed fasts ordered by user.
+    old_rollups = db.query(DBFastingRollup)
+    old_streaks = db.query(DBUserStreak)
+    if user_id is not None:
+        old_rollups = old_rollups.filter(DBFastingRollup.user_id == user_id)
+        old_streaks = old_streaks.filter(DBUserStreak.user_id == user_id)
+    old_rollups.delete(synchronize_session=False)
+    old_streaks.delete(synchronize_session=False)
+    for rows, streak in aggregate_rollups(fasts):
+        db.execute(DBFastingRollup.__table__.insert(), rows)
+        db.execute(DBUserStreak.__table__.insert(), streak)
+
+
+def rebuild_stats(db: Session, user_id: int = None):
+    '''
+    Recompute the stats, rollups and streaks of one or all users from the fasts,
+    the archive and the weight table to fix any drift in the running totals.
+    Returns the number of stats rows written.
+    '''
+    models = (DBFast, DBArchivedFast)
+    weights = db.query(DBWeight.user_id, DBWeight.weight_time, DBWeight.weight,
+        DBWeight.bmi).order_by(DBWeight.user_id, DBWeight.weight_time, DBWeight.id)
+    archived = db.query(DBArchivedFast.user_id, func.max(DBArchivedFast.end_time)).filter(
+        DBArchivedFast.deleted == False).group_by(DBArchivedFast.user_id)
+    old_stats = db.query(DBUserStats)
+    if user_id is not None:
+        weights = weights.filter(DBWeight.user_id == user_id)
+        archived = archived.filter(DBArchivedFast.user_id == user_id)
+        old_stats = old_stats.filter(DBUserStats.user_id == user_id)
+
+    stats = aggregate_stats(chain(*(completed_fasts(db, model, user_id).yield_per(1000) for model in models)),
+        weights.yield_per(1000))
+    for archived_user_id, archived_until in archived:
+        if archived_user_id in stats:
+            stats[archived_user_id]['archived_until'] = archived_until
+    old_stats.delete(synchronize_session=False)
+    db.add_all(DBUserStats(**values) for values in stats.values())
+    rebuild_rollups(db, heapq.merge(*(completed_fasts(db, model, user_id).order_by(model.user_id)
+        .yield_per(1000) for model in models), key=lambda fast: fast.user_id), user_id)
+    versions.bump(db, None if user_id is None else [user_id])
+    db.commit()
+    if user_id is None:
+        cache.dashboards.clear()
+    else:
+        cache.invalidate_dashboard(user_id)
+    return len(stats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recompute user stats from the fast and weight history.")
+    parser.add_argument('--user-id', type=int, help="only rebuild the stats of this user")
+    args = parser.parse_args()
+    shards.init_shards(config.settings)
+    count = 0
+    for sessions in ([shards.sessions_for(args.user_id)] if args.user_id else shards.user_sessions()):
+        db = sessions()
+        try:
+            count += rebuild_stats(db, user_id=args.user_id)
+        finally:
+            db.close()
+    print(f"Rebuilt stats for {count} users")
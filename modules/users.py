@@ -1,13 +1,15 @@
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import datetime
 from pydantic import BaseModel
 
-from fastapi import Depends, APIRouter, HTTPException
+from fastapi import Depends, APIRouter, HTTPException, Request, Response
 
 from ..database.database import DBUser
-from ..modules import fasts, weights
-from ..dependencies import get_db
+from .. import config
+from ..modules import fasts, weights, stats, pagination, cache, responses, passwords, versions
+from ..dependencies import Database, get_db, get_read_db
 
 router = APIRouter()
 
@@ -25,16 +27,20 @@ class UserBase(BaseModel):
 class UserCreate(UserBase):
     password: str
 
+class UserLogin(BaseModel):
+    email: str
+    password: str
+
 class UserStats(BaseModel):
     number_of_fasts: int
     total_hours_fasted: float
     longest_fast: float
-    weight: float
-    height: float
-    bmi: float
-    goal_weight: float
-    start_weight: float
-    weight_loss: float
+    weight: Optional[float]
+    height: Optional[float]
+    bmi: Optional[float]
+    goal_weight: Optional[float]
+    start_weight: Optional[float]
+    weight_loss: Optional[float]
 
 
 class User(UserBase):
@@ -46,14 +52,83 @@ class User(UserBase):
     user_stats: Optional[UserStats] = None
 
 
-# Get user information for dashboard/profile page
-def get_user(db: Session, user_id: int):
+def user_stats_values(user, user_stats):
+    # The fields of UserStats from a user and their user_stats row, if any.
+    if user_stats is None:
+        return dict(number_of_fasts=0, total_hours_fasted=0, longest_fast=0,
+            weight=user.weight, height=user.height, bmi=None, goal_weight=user.goal_weight,
+            start_weight=None, weight_loss=None)
+    weight = user_stats.weight if user_stats.weight is not None else user.weight
+    weight_loss = None
+    if user_stats.start_weight is not None and weight is not None:
+        weight_loss = user_stats.start_weight - weight
+    return dict(number_of_fasts=user_stats.number_of_fasts,
+        total_hours_fasted=user_stats.total_hours_fasted,
+        longest_fast=user_stats.longest_fast, weight=weight, height=user.height,
+        bmi=user_stats.bmi, goal_weight=user.goal_weight,
+        start_weight=user_stats.start_weight, weight_loss=weight_loss)
+
+
+def build_user_stats(user: DBUser, user_stats):
+    return UserStats(**user_stats_values(user, user_stats))
+
+
+def with_live_duration(fast: fasts.Fast, now: datetime.datetime):
+    # The live duration only goes on the response, the row keeps it empty
+    # until the fast is completed.
+    return fast.copy(update={'duration': now - fast.start_time})
+
+
+def load_dashboard(db: Session, users: List[DBUser]):
+    '''
+    Fill in active_fast and user_stats for a page of users with one query each,
+    however long the page is. Anything that returns User should go through here.
+    '''
+    if not users:
+        return users
+    user_ids = [user.id for user in users]
+    active_fasts = fasts.get_active_fasts(db, user_ids)
+    users_stats = {row.user_id: row for row in stats.get_users_stats(db, user_ids)}
+    now = datetime.datetime.now()
+    for user in users:
+        user.active_fast = None
+        if user.id in active_fasts:
+            user.active_fast = with_live_duration(fasts.Fast.from_orm(active_fasts[user.id]), now)
+        user.user_stats = build_user_stats(user, users_stats.get(user.id))
+    return users
+
+
+def load_user(db: Session, user_id: int):
     user: User = db.query(DBUser).filter(DBUser.id == user_id).first()
-    user.active_fast = fasts.get_active_fast(db, user_id)
-    # calculate the duration but don't write it to database until fast is completed.
-    if user.active_fast:
-        user.active_fast.duration = datetime.datetime.now() - user.active_fast.start_time
-    return user
+    if user is None:
+        return None
+    return load_dashboard(db, [user])[0]
+
+
+# Get user information for dashboard/profile page
+def get_user(db: Session, user_id: int, version: Optional[int] = None):
+    '''
+    Served from cache.dashboards when enabled, only the live duration of the
+    active fast is recomputed on a hit. The write paths invalidate the entry
+    in their worker. Entries are stored with the user's version, so given the
+    current `version` a write made in another worker is a miss too.
+    '''
+    if not config.settings.dashboard_cache:
+        return load_user(db, user_id)
+    generation = cache.dashboards.generation
+    entry = cache.dashboards.get(user_id)
+    if entry is not None and (version is None or entry[0] == version):
+        dashboard = entry[1]
+        if dashboard.active_fast is None:
+            return dashboard
+        active_fast = with_live_duration(dashboard.active_fast, datetime.datetime.now())
+        return dashboard.copy(update={'active_fast': active_fast})
+    user = load_user(db, user_id)
+    if user is None:
+        return None
+    dashboard = User.from_orm(user)
+    cache.dashboards.set(user_id, (user.version, dashboard), generation)
+    return dashboard
 
 
 def get_user_by_email(db: Session, email: str):
@@ -61,15 +136,59 @@ def get_user_by_email(db: Session, email: str):
     return db.query(DBUser).filter(DBUser.email == email).first()
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(DBUser).offset(skip).limit(limit).all()
+# The fields of User without the dashboard, for queries that skip the ORM.
+USER_COLUMNS = (DBUser.id, DBUser.email, DBUser.weight, DBUser.height, DBUser.goal_weight,
+    DBUser.unit, DBUser.is_active)
 
 
-def create_user_db(db: Session, user: UserCreate):
+def page_users(query, skip: int, limit: int, after: Optional[int]):
+    query = query.order_by(DBUser.id)
+    if after is not None:
+        query = query.filter(DBUser.id > after)
+    elif skip:
+        query = query.offset(skip)
+    return query.limit(limit).all()
+
+
+def get_users(db: Session, skip: int = 0, limit: int = 100, after: Optional[int] = None):
+    return load_dashboard(db, page_users(db.query(DBUser), skip, limit, after))
+
+
+def get_user_rows(db: Session, skip: int = 0, limit: int = 100, after: Optional[int] = None):
+    '''
+    The same page as get_users, as dicts of column values for
+    responses.RowsResponse. Same queries, no ORM objects or models.
+    '''
+    users = page_users(db.query(*USER_COLUMNS), skip, limit, after)
+    if not users:
+        return []
+    user_ids = [user.id for user in users]
+    active_fasts = fasts.get_active_fasts(db, user_ids, columns=True)
+    users_stats = {row.user_id: row for row in stats.get_users_stats(db, user_ids, columns=True)}
+    now = datetime.datetime.now()
+    rows = []
+    for user in users:
+        active_fast = active_fasts.get(user.id)
+        if active_fast is not None:
+            active_fast = dict(active_fast._asdict(), duration=now - active_fast.start_time)
+        rows.append(dict(user._asdict(), active_fast=active_fast,
+            user_stats=user_stats_values(user, users_stats.get(user.id))))
+    return rows
+
+
+def decode_user_cursor(cursor: str):
+    key = pagination.decode_cursor(cursor)
+    if len(key) != 1 or not isinstance(key[0], int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key[0]
+
+
+def create_user_db(db: Session, user: UserCreate, hashed_password: str, user_id: Optional[int] = None):
+    # user_id is the one the shard directory handed out, if any.
     user_dict = user.dict()
-    user_dict['hashed_password'] = user.password + "notreallyhashed"
+    user_dict['hashed_password'] = hashed_password
     user_dict.pop('password')
-    db_user = DBUser(**user_dict)
+    db_user = DBUser(id=user_id, **user_dict)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
@@ -77,28 +196,81 @@ def create_user_db(db: Session, user: UserCreate):
 
 
 @router.post("/", response_model=UserBase)
-def create_user(user: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: UserCreate, db: Database = Depends(get_db)):
     """Create a new user.
     """
-    db_user = get_user_by_email(db, email=user.email)
+    db_user = await db.run(get_user_by_email, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return create_user_db(db=db, user=user)
+    hashed_password = await passwords.hash_password(user.password)
+    try:
+        user_id = await db.new_user_id(user.email)
+    except IntegrityError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    try:
+        db_user = await db.run(create_user_db, user=user, hashed_password=hashed_password, user_id=user_id)
+    except Exception:
+        if user_id is not None:
+            await db.release_user_id(user_id)
+        raise
+    versions.wrote([db_user.id])
+    return db_user
+
+
+def update_password_hash(db: Session, user_id: int, hashed_password: str):
+    db.query(DBUser).filter(DBUser.id == user_id).update({DBUser.hashed_password: hashed_password},
+        synchronize_session=False)
+    db.commit()
+
+
+@router.post("/login", response_model=UserBase)
+async def login(credentials: UserLogin, db: Database = Depends(get_db)):
+    """Check the email and password of a user.
+    """
+    db_user = await db.run(get_user_by_email, email=credentials.email)
+    verified, new_hash = await passwords.verify_password(
+        db_user.hashed_password if db_user else None, credentials.password)
+    if not verified:
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
+    if new_hash:
+        await db.run(update_password_hash, user_id=db_user.id, hashed_password=new_hash)
+    return db_user
 
 
-@router.get("/", response_model=List[User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    """Get list of all users.
+@router.get("/", response_model=List[User], responses=pagination.NEXT_CURSOR_RESPONSES)
+async def read_users(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None,
+    db: Database = Depends(get_read_db)
+):
+    """Get list of all users ordered by id. Pass the X-Next-Cursor response header
+    as `cursor` to get the next page.
     """
-    all_users = get_users(db, skip=skip, limit=limit)
-    return all_users
+    pagination.check_paging(skip, cursor)
+    after = decode_user_cursor(cursor) if cursor else None
+    fast_json = config.settings.fast_json
+    key = (lambda user: user['id']) if fast_json else (lambda user: user.id)
+    all_users = await pagination.gather_page(db, get_user_rows if fast_json else get_users, key, skip=skip,
+        limit=limit, after=after)
+    next_cursor = pagination.next_cursor(all_users, limit, lambda user: (key(user),))
+    if fast_json:
+        # Headers set on the injected response don't apply to a returned one.
+        response = responses.RowsResponse(all_users)
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    return response if fast_json else all_users
 
 
 @router.get("/{user_id}", response_model=User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    """Get details of a specific user.
+async def read_user(request: Request, response: Response, user_id: int, db: Database = Depends(get_read_db)):
+    """Get details of a specific user. Send the ETag back in If-None-Match to
+    get an empty 304 when no fast or weight changed. The live duration of the
+    active fast isn't part of the version, count it from its start time.
     """
-    db_user = get_user(db, user_id=user_id)
-    if db_user is None:
+    version = await db.run(versions.get_version, user_id=user_id)
+    if version is None:
         raise HTTPException(status_code=404, detail="User not found")
+    not_modified = versions.not_modified(request, version)
+    if not_modified:
+        return not_modified
+    db_user = await db.run(get_user, user_id=user_id, version=version.version)
+    response.headers.update(versions.validators(version))
     return db_user
\ No newline at end of file
@@ -0,0 +1,96 @@
+'''
+Conditional GETs of a user's data. Every write to a user's fasts or weights
+bumps users.version in its transaction, so whether a client still has the
+current data is answered by a primary key lookup, without reading the fasts
+or weights. The writers are also remembered for a while, so their reads can
+go to the primary rather than a replica that may not have the write yet.
+'''
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterable, Optional
+
+from fastapi import Request, Response
+from sqlalchemy.orm import Session
+
+from .. import config
+from ..database.database import DBUser
+from . import cache
+
+RECENT_WRITERS_SIZE = 100000
+
+# Users that wrote in the last settings.read_your_writes_seconds, keyed by id.
+# Replaced at startup with one made from the settings.
+recent_writers = cache.TTLCache(RECENT_WRITERS_SIZE, config.settings.read_your_writes_seconds)
+
+
+def bump(db: Session, user_ids: Optional[Iterable[int]] = None):
+    '''
+    Mark the data of the users, or of all users, as changed. Doesn't commit,
+    so the caller's commit covers both the write and the new version.
+    '''
+    query = db.query(DBUser)
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        query = query.filter(DBUser.id.in_(user_ids))
+        wrote(user_ids)
+    query.update({DBUser.version: DBUser.version + 1, DBUser.modified_at: datetime.utcnow()},
+        synchronize_session=False)
+
+
+def wrote(user_ids: Iterable[int]):
+    for user_id in user_ids:
+        recent_writers.set(user_id, True, recent_writers.generation)
+
+
+def wrote_recently(user_id: int):
+    # Whether the user's reads should see the primary, see dependencies.get_read_db.
+    return recent_writers.get(user_id) is not None
+
+
+def get_version(db: Session, user_id: int):
+    # A row of id, version and modified_at, None for an unknown user.
+    return db.query(DBUser.id, DBUser.version, DBUser.modified_at).filter(DBUser.id == user_id).first()
+
+
+def etag(version):
+    return f'W/"{version.id}-{version.version}"'
+
+
+def validators(version):
+    '''
+    Response headers for the version. no-cache makes clients and caches ask
+    again every time, with If-None-Match.
+    '''
+    headers = {'ETag': etag(version), 'Cache-Control': 'private, no-cache'}
+    if version.modified_at is not None:
+        headers['Last-Modified'] = format_datetime(version.modified_at.replace(tzinfo=timezone.utc),
+            usegmt=True)
+    return headers
+
+
+def is_current(request: Request, version):
+    # If-None-Match wins over If-Modified-Since, weak comparison like nginx.
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        current = etag(version).removeprefix('W/')
+        return any(tag.strip() == '*' or tag.strip().removeprefix('W/') == current
+            for tag in if_none_match.split(','))
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since and version.modified_at is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        return version.modified_at.replace(microsecond=0, tzinfo=timezone.utc) <= since
+    return False
+
+
+def not_modified(request: Request, version):
+    '''
+    An empty 304 response when the client already has the version, else None.
+    '''
+    if version is not None and is_current(request, version):
+        return Response(status_code=304, headers=validators(version))
+    return None
@@ -1,13 +1,16 @@
+from sqlalchemy import String, select, type_coerce
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel, ValidationError, validator
 from enum import Enum
 
-from fastapi import Depends, APIRouter, HTTPException
+from fastapi import Depends, APIRouter, HTTPException, Request, Response
 
-from ..database.database import DBWeight
-from ..dependencies import get_db
+from ..database.database import DBUser, DBWeight
+from ..dependencies import Database, get_db, get_read_db, read_engine
+from .. import config
+from . import bulk, cache, ingest, stats, versions
 
 router = APIRouter()
 
@@ -27,6 +30,20 @@ class Weight(WeightBase):
     bmi: float
 
 
+class TrendPoint(BaseModel):
+    time: datetime
+    weight: float
+
+
+class WeightTrend(BaseModel):
+    readings: int
+    weight: Optional[float] = None
+    loss_per_week: Optional[float] = None
+    goal_weight: Optional[float] = None
+    goal_date: Optional[datetime] = None
+    series: List[TrendPoint] = []
+
+
 def user_weight_in(db: Session, weight: Weight, user_id: int):
     if weight.unit == MeasurementSys.imperial:
         weight.weight = weight.weight * 0.45359237
@@ -34,7 +51,10 @@ def user_weight_in(db: Session, weight: Weight, user_id: int):
     db_weight = DBWeight(**weight.dict(), user_id=user_id)
     db_weight.bmi = calculate_bmi(weight)
     db.add(db_weight)
+    stats.record_weight(db, db_weight)
+    versions.bump(db, [user_id])
     db.commit()
+    cache.invalidate_dashboard(user_id)
     db.refresh(db_weight)
     return db_weight
 
@@ -42,8 +62,200 @@ def user_weight_in(db: Session, weight: Weight, user_id: int):
 def calculate_bmi(weight: Weight):
     return weight.weight / 1.72 ** 2
 
-@router.post("/{user_id}/fasts/", response_model=Weight)
-def new_weight_for_user(user_id: int, weight: WeightBase, db: Session = Depends(get_db)):
+
+def export_weights_statement(user_id: int):
+    return select(DBWeight.id, DBWeight.weight_time, DBWeight.weight, DBWeight.unit,
+        DBWeight.bmi).where(DBWeight.user_id == user_id).order_by(DBWeight.weight_time, DBWeight.id)
+
+
+# Goals further away than this get no projected date.
+GOAL_HORIZON_DAYS = 10 * 365
+
+
+# numpy is imported where it is used, it only serves the trend route and would
+# add a good part of the app's import time to every worker start.
+def get_weight_series(db: Session, user_id: int):
+    import numpy as np
+    # Times as the stored ISO strings, like the fast calendar, numpy parses
+    # them without a datetime object per reading.
+    rows = db.execute(select(type_coerce(DBWeight.weight_time, String), DBWeight.weight).where(
+        DBWeight.user_id == user_id).order_by(DBWeight.weight_time)).all()
+    times, weights = zip(*rows) if rows else ((), ())
+    return (np.array(times, dtype='datetime64[us]').astype('datetime64[s]'),
+        np.array(weights, dtype=float))
+
+
+def weight_trend(times: 'np.ndarray', weights: 'np.ndarray', goal_weight: Optional[float] = None,
+        window_days: float = 7, rate_days: float = 28, points: int = 100):
+    '''
+    Smooth readings (sorted by time) with a trailing moving average over
+    `window_days`, fit the weekly rate of change over the last `rate_days` and
+    project when the goal is reached at that rate. The smoothed series is
+    averaged into at most `points` equal time buckets for charts.
+    '''
+    import numpy as np
+    if not len(weights):
+        return WeightTrend(readings=0, goal_weight=goal_weight)
+    seconds = times.astype('int64')
+    day = 86400
+
+    # Each reading's window starts at the first reading newer than window_days
+    # before it, the window sum is a difference of the cumulative sums.
+    cumulative = np.concatenate(([0.0], np.cumsum(weights)))
+    end = np.arange(1, len(weights) + 1)
+    start = np.searchsorted(seconds, seconds - window_days * day, side='right')
+    smoothed = (cumulative[end] - cumulative[start]) / (end - start)
+
+    trend = WeightTrend(readings=len(weights), weight=smoothed[-1], goal_weight=goal_weight)
+    recent = seconds >= seconds[-1] - rate_days * day
+    if np.ptp(seconds[recent]) > 0:
+        per_day = np.polyfit((seconds[recent] - seconds[-1]) / day, smoothed[recent], 1)[0]
+        trend.loss_per_week = -per_day * 7
+        if goal_weight is not None and per_day < 0 and smoothed[-1] > goal_weight:
+            days_left = (smoothed[-1] - goal_weight) / -per_day
+            # A nearly flat trend would reach the goal centuries away, or past
+            # what datetime and timedelta64 can hold.
+            if days_left <= GOAL_HORIZON_DAYS:
+                trend.goal_date = (times[-1] + np.timedelta64(int(days_left * day), 's')).item()
+
+    if len(smoothed) > points:
+        edges = np.linspace(seconds[0], seconds[-1], points + 1)
+        bucket = np.clip(np.searchsorted(edges, seconds, side='right') - 1, 0, points - 1)
+        counts = np.bincount(bucket, minlength=points)
+        filled = counts > 0
+        bucket_seconds = np.bincount(bucket, seconds, points)[filled] / counts[filled]
+        bucket_weights = np.bincount(bucket, smoothed, points)[filled] / counts[filled]
+        series_times = bucket_seconds.astype('int64').astype('datetime64[s]')
+    else:
+        series_times, bucket_weights = times, smoothed
+    trend.series = [TrendPoint(time=time, weight=weight)
+        for time, weight in zip(series_times.tolist(), bucket_weights.tolist())]
+    return trend
+
+
+def get_weight_trend(db: Session, user_id: int, **options):
+    goal_weight = db.query(DBUser.goal_weight).filter(DBUser.id == user_id).scalar()
+    times, weights = get_weight_series(db, user_id)
+    return weight_trend(times, weights, goal_weight, **options)
+
+
+class WeightImport(WeightBase):
+    weight_time: datetime
+
+
+def weight_row(weight: WeightBase):
+    # Table row of a reading, in kgs.
+    if weight.unit == MeasurementSys.imperial:
+        weight.weight = weight.weight * 0.45359237
+        weight.unit = 'kgs'
+    return dict(weight.dict(), bmi=calculate_bmi(weight))
+
+
+def weight_import_row(record: dict):
+    return weight_row(WeightImport(**record))
+
+
+def insert_weights(db: Session, rows: List[dict]):
+    '''
+    Insert readings of any number of users with one statement and update their
+    stats. Doesn't commit. Returns the ids of the users.
+    '''
+    db.execute(DBWeight.__table__.insert(), rows)
+    users_rows = {}
+    for row in rows:
+        users_rows.setdefault(row['user_id'], []).append(row)
+    for user_rows in users_rows.values():
+        # Only the earliest and the latest reading of a batch can change the stats.
+        first = min(user_rows, key=lambda row: row['weight_time'])
+        last = max(user_rows, key=lambda row: row['weight_time'])
+        for row in (first, last):
+            stats.record_weight(db, DBWeight(**row))
+    versions.bump(db, users_rows)
+    return list(users_rows)
+
+
+def import_weights(db: Session, user_id: int, rows: List[dict]):
+    for row in rows:
+        row['user_id'] = user_id
+    insert_weights(db, rows)
+    db.commit()
+    cache.invalidate_dashboard(user_id)
+
+
+def write_weights(db: Session, rows: List[dict]):
+    # One group commit of the write-behind queue.
+    user_ids = insert_weights(db, rows)
+    db.commit()
+    for user_id in user_ids:
+        cache.invalidate_dashboard(user_id)
+
+
+# Set at startup when settings.weight_write_behind is on.
+write_behind: Optional[ingest.WriteBehind] = None
+
+
+def start_write_behind(settings: config.Settings):
+    global write_behind
+    write_behind = ingest.WriteBehind('weight', write_weights, settings.write_behind_batch_size,
+        settings.write_behind_max_delay, settings.write_behind_max_queued)
+    write_behind.start()
+
+
+async def stop_write_behind():
+    # Writes what is still queued.
+    global write_behind
+    if write_behind is not None:
+        await write_behind.stop()
+        write_behind = None
+
+
+@router.post("/{user_id}/fasts/", response_model=Weight,
+    responses={202: {"model": Weight, "description": "Queued, it is written shortly after"}})
+async def new_weight_for_user(user_id: int, weight: WeightBase, response: Response,
+    db: Database = Depends(get_db)
+):
     ''' New weight entry for the user. Send metric for kgs and imperial for lbs.
+    When the server batches readings, it answers 202 before the reading is stored.
+    '''
+    if write_behind is not None:
+        row = dict(weight_row(weight), user_id=user_id)
+        await write_behind.put(row)
+        response.status_code = 202
+        # The stored row says 'kgs' for converted readings, which isn't a unit
+        # of the response model.
+        return dict(row, unit=MeasurementSys.metric)
+    return await db.run(user_weight_in, weight=weight, user_id=user_id)
+
+
+@router.post("/{user_id}/import", response_model=bulk.ImportReport)
+async def import_weights_for_user(
+    user_id: int, request: Request, format: bulk.FileFormat = bulk.FileFormat.ndjson,
+    db: Database = Depends(get_db)
+):
+    ''' Bulk import weight readings from a request body of NDJSON objects or CSV
+    with a header row, with weight, weight_time and optionally unit.
+    '''
+    return await bulk.import_stream(db, request.stream(), format, weight_import_row,
+        import_weights, user_id)
+
+
+@router.get("/{user_id}/trend", response_model=WeightTrend)
+async def weight_trend_for_user(user_id: int, window_days: float = 7, rate_days: float = 28,
+    points: int = 100, db: Database = Depends(get_read_db)
+):
+    ''' Smoothed weight (moving average over window_days), weekly loss rate over the
+    last rate_days, projected date for the goal weight and a series of at most
+    `points` values for charts. Weights are in kgs.
+    '''
+    if window_days <= 0 or rate_days <= 0 or points < 1:
+        raise HTTPException(status_code=400, detail="window_days, rate_days and points must be positive")
+    return await db.run(get_weight_trend, user_id=user_id, window_days=window_days,
+        rate_days=rate_days, points=points)
+
+
+@router.get("/{user_id}/export")
+def export_weights_for_user(user_id: int, format: bulk.FileFormat = bulk.FileFormat.ndjson):
+    ''' Download all weight readings as NDJSON or CSV, streamed as they are read.
     '''
-    return user_weight_in(db=db, weight=weight, user_id=user_id)
\ No newline at end of file
+    return bulk.export_response(export_weights_statement(user_id), format, f"weights-{user_id}",
+        read_engine(user_id))
@@ -0,0 +1,70 @@
+'''
+Production runner. Migrates the database once, then starts the workers:
+
+    python -m fastingapi.serve --workers 4 --port 9800
+
+SIGHUP restarts the workers one at a time with the new code, SIGTERM or
+ctrl + c stops them after the requests in flight are done.
+'''
+import argparse
+import copy
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import uvicorn
+from uvicorn.config import LOGGING_CONFIG
+
+from fastingapi import config
+from fastingapi.database import shards
+
+logger = logging.getLogger('fastingapi.serve')
+
+
+def migrate(settings: config.Settings):
+    started = time.perf_counter()
+    # Disposes its engines, no connection may be inherited by the workers.
+    applied = shards.upgrade(settings)
+    logger.info("Applied migrations %s in %.3f s", ", ".join(map(str, applied)) if any(applied) else "none",
+        time.perf_counter() - started)
+
+
+def log_config():
+    # uvicorn only configures its own loggers in the workers.
+    log_config = copy.deepcopy(LOGGING_CONFIG)
+    log_config['loggers']['fastingapi'] = {'handlers': ['default'], 'level': 'INFO', 'propagate': False}
+    return log_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API with several worker processes.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--reload', action='store_true',
+        help="one worker restarted on code changes, for development")
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+        help="seconds to finish requests in flight when stopping a worker")
+    parser.add_argument('--pid-file', help="write the pid to send SIGHUP to here")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+
+    migrate(config.settings)
+    # The workers read their settings from the environment, they only check
+    # the schema version.
+    os.environ['FASTINGAPI_AUTO_MIGRATE'] = 'false'
+    workers = 1 if args.reload else args.workers
+    if workers > 1 and 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = tempfile.mkdtemp(prefix='fastingapi-metrics-')
+    if args.pid_file:
+        Path(args.pid_file).write_text(str(os.getpid()))
+
+    uvicorn.run('fastingapi.main:create_app', factory=True, host=args.host, port=args.port,
+        workers=workers, reload=args.reload, timeout_graceful_shutdown=args.graceful_timeout,
+        log_config=log_config())
+
+
+if __name__ == '__main__':
+    main()
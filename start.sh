@@ -1,14 +1,13 @@
 #!/bin/bash
-PID=$(ps aux | grep 'uvicorn main:app' | grep -v grep | awk {'print $2'} | xargs)
-if [ "$PID" != "" ]
+# Start the API with one worker per core, or reload the running workers one at
+# a time when it is already up. Run from the fastingapi checkout.
+cd "$(dirname "$0")/.."
+PID_FILE=fastingapi/fastingapi.pid
+if [ -f "$PID_FILE" ] && kill -0 "$(cat "$PID_FILE")" 2>/dev/null
 then
-kill -9 $PID
-sleep 2
-echo "" > nohup.out
-echo "Restarting FastAPI server"
-echo "You can hit ctrl + c now."
+kill -HUP "$(cat "$PID_FILE")"
+echo "Reloading FastAPI workers"
 else
-echo "No such process. Starting new FastAPI server"
-echo "You can hit ctrl + c now."
+echo "Starting FastAPI server"
+nohup python -m fastingapi.serve --host '0.0.0.0' --port 9800 --pid-file "$PID_FILE" >> fastingapi/nohup.out 2>&1 &
 fi
-nohup uvicorn main:app --host '0.0.0.0' --port 9800 --reload &
\ No newline at end of file
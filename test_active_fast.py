@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from fastingapi.database import migrations
+from fastingapi.database.database import DBFast
+from fastingapi.modules import fasts
+
+
+def queries(method, route):
+    return REGISTRY.get_sample_value('fastingapi_request_queries_sum',
+        dict(method=method, route=route)) or 0
+
+
+def test_racing_creates_start_one_fast(db_sessionmaker):
+    start_time = datetime.utcnow() - timedelta(hours=2)
+    first, second = db_sessionmaker(), db_sessionmaker()
+    # Both would have passed a check for an active fast made beforehand.
+    assert fasts.get_active_fast(first, 1) is None and fasts.get_active_fast(second, 1) is None
+    created = fasts.create_user_fast(first, fasts.FastCreate(start_time=start_time), user_id=1)
+    assert fasts.create_user_fast(second, fasts.FastCreate(start_time=start_time), user_id=1) is None
+    assert second.query(DBFast).filter(DBFast.completed == False).one().id == created.id
+    # The other users are not held up.
+    assert fasts.create_user_fast(second, fasts.FastCreate(start_time=start_time), user_id=2) is not None
+    first.close()
+    second.close()
+
+
+def test_create_and_end_in_one_statement(client):
+    client.post('/users/', json={"email": "returning@example.com", "password": "secret"})
+    start_time = datetime.utcnow() - timedelta(hours=20, microseconds=1)
+    before = queries('POST', '/fast/{user_id}/fasts/')
+    created = client.post("/fast/1/fasts/", json={"start_time": start_time.isoformat()})
+    assert created.status_code == 200
+    # The INSERT and the version of the user.
+    assert queries('POST', '/fast/{user_id}/fasts/') - before == 2
+    response = client.post("/fast/1/fasts/", json={"start_time": start_time.isoformat()})
+    assert response.status_code == 400 and response.json()['detail'] == "Already a fast is in progress"
+
+    response = client.post("/fast/1/end_fast/", json={"end_time": (start_time - timedelta(hours=1)).isoformat()})
+    assert response.json()['detail'] == "End date cannnot be before start date."
+    end_time = start_time + timedelta(hours=16, microseconds=3)
+    ended = client.post("/fast/1/end_fast/", json={"end_time": end_time.isoformat()}).json()
+    assert ended['id'] == created.json()['id'] and ended['completed']
+    assert ended['duration'] == timedelta(hours=16, microseconds=3).total_seconds()
+    assert client.get("/fast/1/fasts/").json()[0]['duration'] == ended['duration']
+    assert client.get('/users/1').json()['user_stats']['number_of_fasts'] == 1
+    response = client.post("/fast/1/end_fast/", json={})
+    assert response.json()['detail'] == "There is no fast is in progress"
+
+
+def test_index_migration_deletes_extra_active_fasts(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.upgrade(engine, target=6)
+    start_time = datetime(2021, 5, 1, 20)
+    with engine.begin() as conn:
+        conn.execute(migrations.fasts_v1.insert(), [dict(user_id=user_id, start_time=start_time,
+            completed=False, deleted=False) for user_id in (1, 1, 1, 2)])
+
+    assert migrations.upgrade(engine, target=7) == [7]
+    db = sessionmaker(bind=engine)()
+    active = db.query(DBFast.id, DBFast.user_id).filter(DBFast.completed == False).order_by(DBFast.id).all()
+    assert [tuple(row) for row in active] == [(1, 1), (4, 2)]
+    assert db.query(DBFast).filter(DBFast.deleted == True).count() == 2
+    db.close()
@@ -0,0 +1,37 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+
+from fastapi.testclient import TestClient
+from fastingapi import config, main
+from fastingapi.database import database, migrations
+from fastingapi.modules import metrics
+
+
+@pytest.fixture
+def settings(tmp_path, monkeypatch):
+    # create_app() replaces the process settings.
+    monkeypatch.setattr(config, "settings", config.settings)
+    return config.Settings(database_url=f"sqlite:///{tmp_path / 'app.db'}")
+
+
+def test_database_is_only_touched_at_startup(tmp_path, settings):
+    app = main.create_app(settings)
+    assert not (tmp_path / 'app.db').exists()
+
+    with TestClient(app) as client:
+        assert database.engine.url == create_engine(settings.database_url).url
+        assert client.post('/users/', json={"email": "app@example.com", "password": "x"}).status_code == 200
+        assert 0 < metrics.STARTUP_SECONDS._value.get()
+    assert 'user_stats' in inspect(create_engine(settings.database_url)).get_table_names()
+
+
+def test_workers_only_check_the_schema(settings):
+    settings.auto_migrate = False
+    with pytest.raises(RuntimeError, match="schema is at version 0"):
+        with TestClient(main.create_app(settings)):
+            pass
+
+    engine = create_engine(settings.database_url)
+    migrations.upgrade(engine)
+    with TestClient(main.create_app(settings)) as client:
+        assert client.get('/').status_code == 200
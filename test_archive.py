@@ -0,0 +1,78 @@
+import json
+from datetime import datetime, timedelta
+
+from fastingapi.database.database import DBArchivedFast, DBFast
+from fastingapi.modules import archive, fasts, stats
+
+
+def import_fasts(client, days):
+    lines = [json.dumps({"start_time": f"2021-01-{day:02}T20:00:00", "end_time": f"2021-01-{day + 1:02}T12:00:00"})
+        for day in days]
+    client.post("/fast/1/import", content="\n".join(lines) + "\n")
+
+
+def test_compact_keeps_reads_and_stats(client, db):
+    client.post('/users/', json={"email": "archive@example.com", "password": "secret"})
+    import_fasts(client, range(1, 6))
+    client.post("/fast/1/fasts/", json={"start_time": (datetime.utcnow() - timedelta(hours=2)).isoformat()})
+    listed = client.get("/fast/1/fasts/").json()
+    client.get(f"/fast/1/delete_fast/{listed[4]['id']}")
+    before = client.get('/users/1').json()['user_stats']
+
+    assert archive.compact(db, datetime(2021, 1, 4), batch_size=2) == 3
+    assert db.query(DBFast).count() == 3
+    assert db.query(DBArchivedFast).filter(DBArchivedFast.deleted == False).count() == 2
+    assert not archive.needs_archive(db, 1, datetime(2021, 1, 5))
+
+    # Deleted fasts aren't listed, archived ones still are, in order.
+    assert [fast['id'] for fast in client.get("/fast/1/fasts/").json()] == [
+        fast['id'] for fast in listed[:4] + listed[5:]]
+    page = client.get("/fast/1/fasts/", params={"skip": 1, "limit": 2}).json()
+    assert [fast['id'] for fast in page] == [listed[1]['id'], listed[2]['id']]
+    cursor = client.get("/fast/1/fasts/", params={"limit": 1}).headers['x-next-cursor']
+    page = client.get("/fast/1/fasts/", params={"limit": 2, "cursor": cursor}).json()
+    assert [fast['id'] for fast in page] == [listed[1]['id'], listed[2]['id']]
+    calendar = client.get("/fast/1/calendar", params={"from": "2021-01-01", "to": "2021-01-06"}).json()
+    assert calendar['hours'] == [4, 16, 16, 16, 12, 0]
+    exported = db.execute(fasts.export_fasts_statement(1)).all()
+    assert [row.id for row in exported] == [fast['id'] for fast in listed[:4] + listed[5:]]
+
+    stats.rebuild_stats(db, 1)
+    db.commit()
+    assert client.get('/users/1').json()['user_stats'] == before
+    assert stats.get_user_stats(db, 1).archived_until == datetime(2021, 1, 3, 12)
+
+    # Deleting an archived fast takes it out of the stats as well.
+    client.get(f"/fast/1/delete_fast/{listed[0]['id']}")
+    after = client.get('/users/1').json()['user_stats']
+    assert after['number_of_fasts'] == before['number_of_fasts'] - 1
+    assert listed[0]['id'] not in [fast['id'] for fast in client.get("/fast/1/fasts/").json()]
+    assert client.get("/fast/1/delete_fast/1000").json() == {"detail": "Fast not found"}
+
+
+def test_incremental_vacuum_frees_compacted_pages(db, db_engine):
+    db.add_all(DBFast(user_id=1, start_time=datetime(2021, 1, 1), completed=True, deleted=True)
+        for _ in range(5000))
+    db.commit()
+    archive.compact(db)
+    db.query(DBArchivedFast).delete()
+    db.commit()
+    with db_engine.connect() as conn:
+        size = conn.exec_driver_sql("PRAGMA page_count").scalar()
+    freed = archive.incremental_vacuum(db_engine, pages=10)
+    assert freed > 10
+    with db_engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA freelist_count").scalar() == 0
+        assert conn.exec_driver_sql("PRAGMA page_count").scalar() == size - freed
+
+
+def test_new_fasts_never_take_the_id_of_an_archived_one(client, db):
+    client.post('/users/', json={"email": "archive@example.com", "password": "secret"})
+    start_time = (datetime.utcnow() - timedelta(hours=2)).isoformat()
+    ids = []
+    for _ in range(2):
+        ids.append(client.post("/fast/1/fasts/", json={"start_time": start_time}).json()['id'])
+        client.get(f"/fast/1/delete_fast/{ids[-1]}")
+        assert archive.compact(db) == 1
+    assert ids[1] > ids[0]
+    assert sorted(id for id, in db.query(DBArchivedFast.id)) == ids
@@ -0,0 +1,23 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from fastapi.testclient import TestClient
+from fastingapi import config, main
+from fastingapi.database import database, migrations
+
+
+def test_async_mode_serves_requests_through_get_db(tmp_path, monkeypatch):
+    url = f"sqlite:///{tmp_path / 'fastingapi.db'}"
+    migrations.upgrade(create_engine(url))
+    monkeypatch.setattr(config, "settings", config.settings)
+    app = main.create_app(config.Settings(async_db=True, database_url=url))
+
+    with TestClient(app) as client:
+        assert client.post('/users/', json={"email": "async@example.com", "password": "x"}).status_code == 200
+        start_time = (datetime.utcnow() - timedelta(hours=20)).isoformat()
+        assert client.post("/fast/1/fasts/", json={"start_time": start_time}).status_code == 200
+        assert client.post("/fast/1/end_fast/", json={}).status_code == 200
+        user = client.get("/users/1").json()
+        assert database.async_engine.url.drivername == "sqlite+aiosqlite"
+    assert user['user_stats']['number_of_fasts'] == 1
@@ -0,0 +1,50 @@
+from fastingapi.benchmarks import crud, dataset, ingest, load
+from fastingapi.database.database import DBFast, DBWeight
+from fastingapi.modules import stats
+
+
+def generated_history(path, data):
+    engine, sessions = dataset.create_database(path)
+    db = sessions()
+    try:
+        user_ids = dataset.generate(db, data)
+        assert db.query(DBFast).filter(DBFast.completed == False).count() == (len(user_ids) + 1) // 2
+        assert stats.get_user_stats(db, user_ids[0]).number_of_fasts == data.fasts_per_user
+        # Times are relative to now, durations and weights only depend on the seed.
+        return (db.query(DBFast.user_id, DBFast.duration, DBFast.planned_duration).filter(
+                DBFast.completed == True).order_by(DBFast.id).all(),
+            db.query(DBWeight.user_id, DBWeight.weight).order_by(DBWeight.id).all())
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def test_dataset_is_reproducible(tmp_path):
+    data = dataset.Dataset(users=3, fasts_per_user=4, weights_per_day=2, seed=7)
+    fasts, weights = generated_history(tmp_path / 'first.db', data)
+    assert (len(fasts), len(weights)) == (12, 24)
+    assert generated_history(tmp_path / 'second.db', data) == (fasts, weights)
+    assert generated_history(tmp_path / 'other.db', dataset.Dataset(users=3, fasts_per_user=4,
+        weights_per_day=2, seed=8)) != (fasts, weights)
+
+
+def test_suite_reports_latency(db_engine, db_sessionmaker, db):
+    user_ids = dataset.generate(db, dataset.Dataset(users=4, fasts_per_user=3, weights_per_day=1))
+    results = crud.run(db_sessionmaker, user_ids, iterations=5)
+    assert set(results) == {'get_active_fast', 'get_fasts', 'get_fasts_cursor', 'create_user_fast',
+        'end_user_fast', 'user_weight_in'}
+    assert all(result['count'] == 5 and result['p99_ms'] >= result['p50_ms'] > 0
+        for result in results.values())
+
+    with dataset.app_database(db_sessionmaker) as app:
+        results = load.run(app, user_ids, requests=40, concurrency=4)
+    assert results['errors'] == 0
+    assert results['latency']['count'] == 40
+    assert results['requests_per_second'] > 0
+
+
+def test_ingest_benchmark_stores_every_reading():
+    results = ingest.run(readings=40, concurrency=4, synchronous='NORMAL')
+    assert results['direct']['stored_per_second'] > 0
+    assert results['write_behind']['stored_per_second'] > 0
+    assert results['storage']['speedup'] > 0
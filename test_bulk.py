@@ -0,0 +1,75 @@
+import json
+from datetime import datetime, timedelta
+
+from fastingapi.database import database
+from fastingapi.database.database import DBFast, DBUser
+from fastingapi.modules import bulk, fasts, stats
+
+
+def test_import_fasts_reports_bad_rows(client):
+    client.post('/users/', json={"email": "import@example.com", "password": "secret"})
+    start_time = datetime(2020, 1, 1, 20)
+    lines = [json.dumps({"start_time": (start_time + timedelta(days=i)).isoformat(),
+        "end_time": (start_time + timedelta(days=i, hours=16 + i)).isoformat()}) for i in range(3)]
+    lines.insert(1, json.dumps({"start_time": "yesterday", "end_time": start_time.isoformat()}))
+    lines.insert(3, "not json")
+
+    response = client.post("/fast/1/import", content="\n".join(lines) + "\n")
+    assert response.status_code == 200
+    report = response.json()
+    assert (report['imported'], report['failed']) == (3, 2)
+    assert [error['line'] for error in report['errors']] == [2, 4]
+    assert "start_time" in report['errors'][0]['error']
+
+    user_stats = client.get("/users/1").json()['user_stats']
+    assert (user_stats['number_of_fasts'], user_stats['total_hours_fasted'], user_stats['longest_fast']) == (3, 51, 18)
+
+
+def test_import_weights_from_csv(client):
+    client.post('/users/', json={"email": "import@example.com", "password": "secret"})
+    body = "weight_time,weight,unit\r\n2021-01-02T08:00,180,imperial\r\n2021-01-01T08:00,82,\r\n2021-01-03T08:00,80,metric\r\n"
+    response = client.post("/weight/1/import", params={"format": "csv"}, content=body)
+    assert response.json() == {"imported": 3, "failed": 0, "errors": []}
+    user_stats = client.get("/users/1").json()['user_stats']
+    assert (user_stats['start_weight'], user_stats['weight']) == (82, 80)
+
+
+def test_import_lines_commits_in_batches(db, monkeypatch):
+    monkeypatch.setattr(bulk, 'BATCH_SIZE', 4)
+    db.add(DBUser(id=1, email="cli@example.com"))
+    db.commit()
+    start_time = datetime(2020, 1, 1, 20)
+    lines = (json.dumps({"start_time": (start_time + timedelta(days=i)).isoformat(),
+        "end_time": (start_time + timedelta(days=i, hours=16)).isoformat()}) for i in range(10))
+    batches = []
+
+    def insert(db, user_id, rows):
+        batches.append(len(rows))
+        fasts.import_fasts(db, user_id=user_id, rows=rows)
+
+    report = bulk.import_lines(db, lines, bulk.FileFormat.ndjson, fasts.fast_import_row, insert, 1)
+    assert report.imported == 10 and batches == [4, 4, 2]
+    assert db.query(DBFast).count() == 10
+    assert stats.get_user_stats(db, 1).number_of_fasts == 10
+
+
+def test_export_streams_history_that_imports_again(client, db_engine, monkeypatch):
+    monkeypatch.setattr(database, 'engine', db_engine)
+    monkeypatch.setattr(bulk, 'EXPORT_CHUNK_SIZE', 2)
+    client.post('/users/', json={"email": "export@example.com", "password": "secret"})
+    start_time = datetime(2020, 1, 1, 20)
+    body = "\n".join(json.dumps({"start_time": (start_time + timedelta(days=i)).isoformat(),
+        "end_time": (start_time + timedelta(days=i, hours=16)).isoformat()}) for i in range(5))
+    client.post("/fast/1/import", content=body)
+
+    response = client.get("/fast/1/export")
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row['duration'] for row in rows] == [16 * 3600] * 5
+    assert rows[0]['start_time'] == start_time.isoformat()
+
+    exported_csv = client.get("/fast/1/export", params={"format": "csv"}).text
+    assert exported_csv.splitlines()[0] == "id,start_time,end_time,completed,duration,planned_end_time,planned_duration"
+    client.post('/users/', json={"email": "copy@example.com", "password": "secret"})
+    report = client.post("/fast/2/import", params={"format": "csv"}, content=exported_csv).json()
+    assert (report['imported'], report['failed']) == (5, 0)
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+from fastingapi import config
+from fastingapi.modules import cache
+
+
+def test_ttl_cache_evicts_and_expires(monkeypatch):
+    dashboards = cache.TTLCache(size=2, ttl=10)
+    for key in (1, 2):
+        dashboards.set(key, str(key), dashboards.generation)
+    assert dashboards.get(1) == '1'
+    dashboards.set(3, '3', dashboards.generation)
+    assert dashboards.get(2) is None
+    assert dashboards.counters() == dict(hits=1, misses=1, evictions=1, invalidations=0, size=2)
+
+    now = cache.time.monotonic()
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now + 11)
+    assert dashboards.get(1) is None
+
+
+def test_ttl_cache_drops_values_read_before_an_invalidation():
+    dashboards = cache.TTLCache(size=2, ttl=10)
+    generation = dashboards.generation
+    dashboards.invalidate(1)
+    dashboards.set(1, 'stale', generation)
+    assert dashboards.get(1) is None
+
+
+def test_dashboard_is_cached_until_a_write(client):
+    client.post('/users/', json={"email": "cache@example.com", "password": "secret"})
+    misses = cache.dashboards.misses
+    assert client.get('/users/1').json()['active_fast'] is None
+    assert client.get('/users/1').json()['active_fast'] is None
+    assert cache.dashboards.misses == misses + 1
+
+    start_time = datetime.utcnow() - timedelta(hours=2)
+    client.post('/fast/1/fasts/', json={"start_time": start_time.isoformat()})
+    first = client.get('/users/1').json()['active_fast']
+    second = client.get('/users/1').json()['active_fast']
+    assert first['id'] == second['id']
+    assert second['duration'] >= first['duration'] > 7000
+
+    client.post('/weight/1/fasts/', json={"weight": 80})
+    assert client.get('/users/1').json()['user_stats']['weight'] == 80
+    client.post('/fast/1/end_fast/', json={})
+    assert client.get('/users/1').json()['active_fast'] is None
+    assert cache.dashboards.misses == misses + 4
+
+
+def test_dashboard_cache_can_be_disabled(client, monkeypatch):
+    monkeypatch.setattr(config.settings, 'dashboard_cache', False)
+    client.post('/users/', json={"email": "nocache@example.com", "password": "secret"})
+    client.get('/users/1')
+    client.get('/users/1')
+    assert cache.dashboards.counters()['size'] == 0
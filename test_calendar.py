@@ -0,0 +1,48 @@
+import json
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+from fastingapi.modules import fasts
+
+
+def test_hours_split_at_midnight():
+    boundaries = fasts.day_boundaries(date(2021, 1, 1), date(2021, 1, 4))
+    starts = np.array([datetime(2021, 1, 1, 20), datetime(2021, 1, 2, 12), datetime(2020, 12, 31, 12)],
+        dtype='datetime64[s]')
+    ends = np.array([datetime(2021, 1, 2, 12), datetime(2021, 1, 4, 6), datetime(2020, 12, 31, 22)],
+        dtype='datetime64[s]')
+    hours = fasts.hours_per_day(starts, ends, boundaries)
+    assert hours.tolist() == [4, 12 + 12, 24, 6]
+
+
+def test_days_around_dst_change():
+    # Clocks went forward in Berlin on 2021-03-28, that day has 23 hours.
+    boundaries = fasts.day_boundaries(date(2021, 3, 27), date(2021, 3, 29), ZoneInfo('Europe/Berlin'))
+    assert np.diff(boundaries).astype(int).tolist() == [86400, 82800, 86400]
+    hours = fasts.hours_per_day(boundaries[:1], boundaries[-1:], boundaries)
+    assert hours.tolist() == [24, 23, 24]
+
+
+def test_calendar_endpoint(client):
+    client.post('/users/', json={"email": "calendar@example.com", "password": "secret"})
+    lines = [json.dumps({"start_time": "2021-01-01T20:00:00", "end_time": "2021-01-02T12:00:00"}),
+        json.dumps({"start_time": "2021-01-02T20:00:00", "end_time": "2021-01-03T14:00:00"})]
+    client.post("/fast/1/import", content="\n".join(lines) + "\n")
+    deleted = client.get("/fast/1/fasts/").json()[1]['id']
+    client.get(f"/fast/1/delete_fast/{deleted}")
+
+    response = client.get("/fast/1/calendar", params={"from": "2021-01-01", "to": "2021-01-03"})
+    assert response.json() == {"start": "2021-01-01", "end": "2021-01-03", "tz": None,
+        "total_hours": 16, "hours": [4, 12, 0]}
+    assert client.get("/fast/1/calendar", params={"from": "2021-01-02", "to": "2021-01-01"}).status_code == 400
+    assert client.get("/fast/1/calendar", params={"tz": "Mars/Olympus"}).status_code == 400
+
+
+def test_calendar_counts_fast_in_progress(client):
+    client.post('/users/', json={"email": "calendar@example.com", "password": "secret"})
+    client.post("/fast/1/fasts/", json={"start_time": (datetime.now() - timedelta(hours=2)).isoformat()})
+    calendar = client.get("/fast/1/calendar", params={"from": (date.today() - timedelta(days=1)).isoformat(),
+        "to": date.today().isoformat()}).json()
+    assert 1.9 < calendar['total_hours'] < 2.1
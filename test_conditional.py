@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from prometheus_client import REGISTRY
+
+from fastingapi.database.database import DBFast
+from fastingapi.modules import versions
+
+
+def queries(route):
+    return REGISTRY.get_sample_value('fastingapi_request_queries_sum',
+        dict(method='GET', route=route)) or 0
+
+
+def test_user_not_modified_until_a_write(client):
+    client.post('/users/', json={"email": "etag@example.com", "password": "secret"})
+    response = client.get('/users/1')
+    etag = response.headers['etag']
+    assert etag == 'W/"1-0"' and 'last-modified' not in response.headers
+
+    before = queries('/users/{user_id}')
+    response = client.get('/users/1', headers={'If-None-Match': f'"other", {etag}'})
+    assert response.status_code == 304 and response.content == b''
+    assert response.headers['etag'] == etag
+    assert queries('/users/{user_id}') - before == 1
+
+    client.post("/weight/1/fasts/", json={"weight": 80})
+    response = client.get('/users/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['etag'] == 'W/"1-1"'
+    assert response.json()['user_stats']['weight'] == 80
+    last_modified = response.headers['last-modified']
+    assert client.get('/users/1', headers={'If-Modified-Since': last_modified}).status_code == 304
+    assert client.get('/users/2', headers={'If-None-Match': '*'}).status_code == 404
+
+
+def test_fast_history_not_modified_without_reading_fasts(client):
+    client.post('/users/', json={"email": "etag@example.com", "password": "secret"})
+    start_time = datetime.utcnow() - timedelta(hours=20)
+    client.post("/fast/1/fasts/", json={"start_time": start_time.isoformat()})
+    response = client.get('/fast/1/fasts/')
+    assert len(response.json()) == 1
+    etag = response.headers['etag']
+
+    before = queries('/fast/{user_id}/fasts/')
+    assert client.get('/fast/1/fasts/', headers={'If-None-Match': etag}).status_code == 304
+    assert queries('/fast/{user_id}/fasts/') - before == 1
+
+    client.post("/fast/1/end_fast/", json={})
+    response = client.get('/fast/1/fasts/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json()[0]['completed']
+    assert response.headers['etag'] != etag
+
+
+def test_dashboard_written_by_another_worker_is_not_served_from_cache(client, db):
+    client.post('/users/', json={"email": "etag@example.com", "password": "secret"})
+    assert client.get('/users/1').json()['active_fast'] is None
+
+    # A write in another worker doesn't invalidate this worker's cache.
+    start_time = datetime.utcnow() - timedelta(hours=2)
+    db.add(DBFast(user_id=1, start_time=start_time, planned_end_time=start_time + timedelta(hours=16),
+        completed=False, deleted=False))
+    versions.bump(db, [1])
+    db.commit()
+    response = client.get('/users/1')
+    assert response.headers['etag'] == 'W/"1-1"'
+    assert response.json()['active_fast'] is not None
+    assert client.get('/users/1', headers={'If-None-Match': 'W/"1-1"'}).status_code == 304
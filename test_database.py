@@ -0,0 +1,37 @@
+import asyncio
+
+from sqlalchemy.pool import QueuePool
+
+from fastingapi.config import Settings
+from fastingapi.database import database
+
+
+def test_sqlite_engine_is_tuned(db_engine):
+    with db_engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+        assert conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2  # INCREMENTAL
+    assert db_engine.pool.size() == Settings().db_pool_size
+
+
+def test_engine_options_follow_settings(monkeypatch):
+    monkeypatch.setenv("FASTINGAPI_DB_POOL_SIZE", "20")
+    monkeypatch.setenv("FASTINGAPI_DB_POOL_RECYCLE", "-1")
+    settings = Settings()
+    options = database.engine_options("postgresql://db/fastingapi", settings, QueuePool)
+    assert options == {"poolclass": QueuePool, "pool_pre_ping": True, "pool_recycle": -1,
+        "pool_size": 20, "max_overflow": 10}
+
+
+def test_async_sqlite_engine_is_tuned(tmp_path):
+    engine = database.make_async_engine(f"sqlite:///{tmp_path / 'async.db'}")
+
+    async def journal_mode():
+        async with engine.connect() as conn:
+            mode = (await conn.exec_driver_sql("PRAGMA journal_mode")).scalar()
+            timeout = (await conn.exec_driver_sql("PRAGMA busy_timeout")).scalar()
+        await engine.dispose()
+        return mode, timeout
+
+    assert asyncio.run(journal_mode()) == ("wal", 5000)
@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine
+
+from fastapi.testclient import TestClient
+from fastingapi import config, main
+from fastingapi.modules import weights
+
+
+def test_weights_are_written_behind_in_group_commits(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "settings", config.settings)
+    settings = config.Settings(database_url=f"sqlite:///{tmp_path / 'ingest.db'}",
+        weight_write_behind=True, write_behind_batch_size=3, write_behind_max_delay=10)
+    batches = REGISTRY.get_sample_value('fastingapi_write_behind_batch_rows_count', {'queue': 'weight'}) or 0
+
+    with TestClient(main.create_app(settings)) as client:
+        client.post('/users/', json={"email": "ingest@example.com", "password": "x"})
+        start_time = datetime(2021, 1, 1, 8)
+        for i, weight in enumerate([80, 79, 81, 78, 180]):
+            response = client.post("/weight/1/fasts/", json={"weight": weight,
+                "weight_time": (start_time + timedelta(days=i)).isoformat(),
+                "unit": "imperial" if weight > 100 else "metric"})
+            assert response.status_code == 202
+        assert response.json()['unit'] == 'metric'
+        assert round(response.json()['weight'], 3) == 81.647
+    # The last two readings are written at shutdown.
+    assert weights.write_behind is None
+    assert REGISTRY.get_sample_value('fastingapi_write_behind_batch_rows_count', {'queue': 'weight'}) == batches + 2
+
+    engine = create_engine(settings.database_url)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT count(*) FROM weight").scalar() == 5
+        start_weight, weight = conn.exec_driver_sql("SELECT start_weight, weight FROM user_stats").one()
+    assert (start_weight, round(weight, 3)) == (80, 81.647)
+
+
+def test_weights_are_written_right_away_by_default(client):
+    client.post('/users/', json={"email": "ingest@example.com", "password": "x"})
+    response = client.post("/weight/1/fasts/", json={"weight": 80})
+    assert response.status_code == 200
+    assert client.get('/users/1').json()['user_stats']['weight'] == 80
@@ -0,0 +1,86 @@
+import json
+import warnings
+from datetime import date, datetime, timedelta
+
+from sqlalchemy.exc import SAWarning
+
+from fastingapi.database.database import DBFastingRollup, DBUserStreak
+from fastingapi.modules import stats
+
+
+def import_fasts(client, user_id, fasts):
+    lines = [json.dumps({"start_time": start_time.isoformat(),
+        "end_time": (start_time + timedelta(hours=hours)).isoformat()}) for start_time, hours in fasts]
+    response = client.post(f"/fast/{user_id}/import", content="\n".join(lines) + "\n")
+    assert response.json()['imported'] == len(fasts)
+
+
+def test_fast_split_into_periods():
+    # Sunday evening to Monday noon, across a week and a month boundary.
+    rollups = stats.fast_rollups(datetime(2021, 2, 28, 20), datetime(2021, 3, 1, 12))
+    assert rollups == {
+        ('day', date(2021, 2, 28)): 4, ('week', date(2021, 2, 22)): 4, ('month', date(2021, 2, 1)): 4,
+        ('day', date(2021, 3, 1)): 12, ('week', date(2021, 3, 1)): 12, ('month', date(2021, 3, 1)): 12,
+    }
+
+
+def test_count_streaks():
+    days = [date(2021, 1, 1), date(2021, 1, 2), date(2021, 1, 4), date(2021, 1, 5), date(2021, 1, 6)]
+    assert stats.count_streaks(days) == (3, 3, date(2021, 1, 6))
+    assert stats.count_streaks([date(2021, 1, 6), date(2021, 1, 7)], 1, 5, date(2021, 1, 6)) == \
+        (2, 5, date(2021, 1, 7))
+
+
+def test_leaderboards(client):
+    for i in range(3):
+        client.post('/users/', json={"email": f"rank{i}@example.com", "password": "secret"})
+    monday = datetime(2021, 1, 4)
+    import_fasts(client, 1, [(monday + timedelta(days=day, hours=20), 16) for day in range(3)])
+    import_fasts(client, 2, [(monday + timedelta(hours=20), 20), (monday + timedelta(days=5, hours=20), 16)])
+    import_fasts(client, 3, [(monday + timedelta(days=8, hours=20), 30)])
+
+    weekly = client.get("/leaderboard/weekly", params={"week": "2021-01-06"}).json()
+    assert [(entry['rank'], entry['user_id'], entry['hours']) for entry in weekly] == [
+        (1, 1, 48), (2, 2, 36)]
+    streaks = client.get("/leaderboard/streaks", params={"limit": 2}).json()
+    assert [(entry['rank'], entry['user_id'], entry['longest_streak']) for entry in streaks] == [
+        (1, 1, 4), (2, 3, 3)]
+
+    ranking = client.get("/leaderboard/2/ranking", params={"month": "2021-01-20"}).json()
+    assert ranking['month'] == "2021-01-01"
+    assert (ranking['month_hours'], ranking['month_rank'], ranking['month_percentile']) == (36, 2, 100 / 3)
+    assert (ranking['longest_streak'], ranking['streak_rank'], ranking['current_streak']) == (2, 3, 0)
+
+
+def test_rollups_follow_ended_and_deleted_fasts(client, db):
+    client.post('/users/', json={"email": "rollup@example.com", "password": "secret"})
+    start_time = datetime.utcnow() - timedelta(hours=20)
+    client.post("/fast/1/fasts/", json={"start_time": start_time.isoformat()})
+    fast = client.post("/fast/1/end_fast/", json={"end_time": (start_time + timedelta(hours=16)).isoformat()}).json()
+    rows = db.query(DBFastingRollup.period, DBFastingRollup.period_start, DBFastingRollup.hours).all()
+    assert round(sum(hours for period, _, hours in rows if period == 'day'), 6) == 16
+    ranking = client.get("/leaderboard/1/ranking", params={"month": start_time.date().isoformat()}).json()
+    assert ranking['month_rank'] == ranking['streak_rank'] == 1
+    assert ranking['current_streak'] == ranking['longest_streak'] >= 1
+
+    stats.rebuild_stats(db)
+    assert sorted(db.query(DBFastingRollup.period, DBFastingRollup.period_start,
+        DBFastingRollup.hours).all()) == sorted(rows)
+
+    client.get(f"/fast/1/delete_fast/{fast['id']}")
+    db.expire_all()
+    assert db.query(DBFastingRollup).count() == 0
+    assert db.query(DBUserStreak).count() == 0
+    assert client.get("/leaderboard/1/ranking").json()['month_hours'] == 0
+
+
+def test_backdated_fasts_rebuild_the_streak(client, db):
+    client.post('/users/', json={"email": "backdated@example.com", "password": "secret"})
+    monday = datetime(2021, 1, 4)
+    import_fasts(client, 1, [(monday + timedelta(days=2, hours=20), 16)])
+    # Joins the streak from before, the row is updated rather than replaced.
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', SAWarning)
+        import_fasts(client, 1, [(monday + timedelta(days=day, hours=20), 16) for day in range(2)])
+    streak = db.query(DBUserStreak).get(1)
+    assert (streak.current_streak, streak.longest_streak, streak.last_day) == (4, 4, date(2021, 1, 7))
@@ -0,0 +1,91 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import httpx
+
+from fastingapi import main
+from fastingapi.modules import fasts, live
+
+
+def test_ticks_changes_and_slow_streams():
+    fast = fasts.Fast(id=1, user_id=1, start_time=datetime.now() - timedelta(hours=1),
+        planned_end_time=datetime.now(), completed=False, duration=None, planned_duration=1)
+
+    async def run():
+        live_fasts = live.LiveFasts(lambda db, user_ids: {}, tick_interval=0.01, sync_interval=0,
+            max_queued=2)
+
+        async def read_fast():
+            return fast
+
+        stream = live_fasts.stream(1, read_fast)
+        assert json.loads((await stream.__anext__()).split('data: ')[1])['id'] == 1
+        live_fasts.start()
+        tick = await stream.__anext__()
+        assert tick.startswith('event: tick')
+        assert 3599 < json.loads(tick.split('data: ')[1])['duration'] < 3700
+
+        # Changed through another worker.
+        live_fasts.update([1, 2], {})
+        assert live_fasts.active[1] is None
+        assert await stream.__anext__() == 'event: fast\ndata: null\n\n'
+
+        # A stream that isn't read falls behind and is closed.
+        await asyncio.sleep(0.1)
+        assert [message async for message in stream] == []
+        assert live_fasts.streams == {}
+        await live_fasts.stop()
+
+    asyncio.run(run())
+
+
+async def read_stream(user_id, messages: asyncio.Queue, disconnected: asyncio.Event):
+    # The test clients read whole responses, so the stream is called directly.
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': f'/fast/{user_id}/live', 'raw_path': f'/fast/{user_id}/live'.encode(),
+        'root_path': '', 'query_string': b'', 'headers': [], 'server': ('test', 80), 'client': ('test', 1)}
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            assert dict(message['headers'])[b'content-type'].startswith(b'text/event-stream')
+        elif message.get('body'):
+            await messages.put(message['body'].decode())
+
+    await main.app(scope, receive, send)
+
+
+def test_stream_follows_fast_routes(client):
+    client.post('/users/', json={"email": "live@example.com", "password": "secret"})
+
+    async def run():
+        messages, disconnected = asyncio.Queue(), asyncio.Event()
+        stream = asyncio.create_task(read_stream(1, messages, disconnected))
+        assert await messages.get() == 'event: fast\ndata: null\n\n'
+
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as http:
+            start_time = datetime.now() - timedelta(hours=2)
+            await http.post("/fast/1/fasts/", json={"start_time": start_time.isoformat()})
+            started = await messages.get()
+            assert started.startswith('event: started')
+            fast_id = json.loads(started.split('data: ')[1])['id']
+            await http.post("/fast/1/end_fast/", json={})
+            assert (await messages.get()).startswith('event: ended')
+            await http.get(f"/fast/1/delete_fast/{fast_id}")
+            assert (await messages.get()).startswith('event: deleted')
+
+        disconnected.set()
+        await stream
+        assert fasts.live_fasts.streams == {}
+
+    asyncio.run(run())
@@ -1,12 +1,21 @@
 import random, string
 from datetime import datetime, timedelta
 
+import pytest
+
 from fastapi.testclient import TestClient
 from fastingapi import main
 
 client = TestClient(main.app)
 
 
+@pytest.fixture(scope="module", autouse=True)
+def startup():
+    # Creates the engines and migrates the database.
+    with client:
+        yield
+
+
 def test_read_main():
     response = client.get("/")
     assert response.status_code == 200
@@ -0,0 +1,45 @@
+import logging
+
+from prometheus_client import REGISTRY
+
+from fastingapi import config
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_count_requests_and_queries(client):
+    route = dict(method='GET', route='/users/{user_id}')
+    requests = sample('fastingapi_requests_total', status='200', **route)
+    queries = sample('fastingapi_request_queries_sum', **route)
+    misses = sample('fastingapi_dashboard_cache_misses_total')
+
+    client.post('/users/', json={"email": "metrics@example.com", "password": "secret"})
+    assert client.get('/users/1').status_code == 200
+    assert client.get('/users/2').status_code == 404
+    assert client.get('/nowhere').status_code == 404
+
+    assert sample('fastingapi_requests_total', status='200', **route) == requests + 1
+    assert sample('fastingapi_requests_total', status='404', **route) >= 1
+    assert sample('fastingapi_requests_total', method='GET', route='unmatched', status='404') >= 1
+    # The version, the user, their active fast and their stats, then the
+    # version of the missing user.
+    assert sample('fastingapi_request_queries_sum', **route) - queries == 4 + 1
+    assert sample('fastingapi_dashboard_cache_misses_total') == misses + 1
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'fastingapi_request_duration_seconds_bucket{le="0.005",method="GET",route="/users/{user_id}"}' in response.text
+    assert 'fastingapi_requests_in_progress 1.0' in response.text
+
+
+def test_requests_over_query_budget_are_logged(client, monkeypatch, caplog):
+    monkeypatch.setattr(config.settings, 'query_budget', 1)
+    route = dict(method='POST', route='/users/')
+    over_budget = sample('fastingapi_requests_over_query_budget_total', **route)
+    with caplog.at_level(logging.WARNING, logger='fastingapi.modules.metrics'):
+        client.post('/users/', json={"email": "budget@example.com", "password": "secret"})
+    assert sample('fastingapi_requests_over_query_budget_total', **route) == over_budget + 1
+    assert "POST /users/ ran" in caplog.text
@@ -0,0 +1,86 @@
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+from fastingapi.database import database, migrations
+from fastingapi.database.database import DBFast
+from fastingapi.modules import fasts, leaderboards, stats
+
+
+def test_migrations_build_the_model_schema(db_engine):
+    inspector = inspect(db_engine)
+    for table in database.Base.metadata.sorted_tables:
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        assert columns == set(table.c.keys()), table.name
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        assert indexes == {index.name for index in table.indexes}, table.name
+
+
+def test_upgrade_adopts_databases_made_by_create_all(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.schema.create_all(bind=engine, tables=[migrations.users_v1, migrations.fasts_v1,
+        migrations.weight_v1])
+
+    assert migrations.upgrade(engine) == [1, 2, 3, 4, 5, 6, 7, 8]
+    assert migrations.upgrade(engine) == []
+
+
+def test_user_stats_migration_counts_existing_history(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.upgrade(engine, target=1)
+    start_time = datetime(2021, 5, 1, 20)
+    with engine.begin() as conn:
+        conn.execute(migrations.users_v1.insert().values(id=1, email="old@example.com"))
+        conn.execute(migrations.fasts_v1.insert(), [
+            dict(user_id=1, start_time=start_time, end_time=start_time + timedelta(hours=hours),
+                completed=True, deleted=deleted)
+            for hours, deleted in [(16, False), (20, False), (30, True)]])
+
+    migrations.upgrade(engine)
+    db = sessionmaker(bind=engine)()
+    row = stats.get_user_stats(db, 1)
+    assert (row.number_of_fasts, row.total_hours_fasted, row.longest_fast) == (2, 36, 20)
+
+    fast = db.query(DBFast).filter(DBFast.end_time == start_time + timedelta(hours=20)).one()
+    fasts.delete_user_fast(db, user_id=1, fast_id=fast.id)
+    db.refresh(row)
+    assert (row.number_of_fasts, row.total_hours_fasted, row.longest_fast) == (1, 16, 16)
+    db.close()
+
+
+def test_rollups_migration_counts_existing_history(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.upgrade(engine, target=3)
+    start_time = datetime(2021, 5, 1, 20)
+    with engine.begin() as conn:
+        conn.execute(migrations.users_v1.insert().values(id=1, email="old@example.com"))
+        conn.execute(migrations.fasts_v1.insert(), [
+            dict(user_id=1, start_time=start_time + timedelta(days=day), completed=True, deleted=False,
+                end_time=start_time + timedelta(days=day, hours=16)) for day in range(3)])
+
+    assert migrations.upgrade(engine) == [4, 5, 6, 7, 8]
+    db = sessionmaker(bind=engine)()
+    assert round(leaderboards.get_ranking(db, 1, date(2021, 5, 1)).month_hours, 6) == 48
+    assert leaderboards.get_top_streaks(db, limit=1)[0].longest_streak == 4
+    db.close()
+
+
+def test_fast_ids_stay_above_archived_ones_after_upgrade(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    migrations.upgrade(engine, target=7)
+    start_time = datetime(2021, 5, 1, 20)
+    with engine.begin() as conn:
+        conn.execute(migrations.users_v1.insert().values(id=1, email="old@example.com"))
+        conn.execute(migrations.fasts_v1.insert().values(id=1, user_id=1, start_time=start_time,
+            completed=False, deleted=False))
+        conn.execute(migrations.fasts_archive_v6.insert().values(id=2, user_id=1, start_time=start_time,
+            completed=True, deleted=True))
+
+    assert migrations.upgrade(engine) == [8]
+    with engine.begin() as conn:
+        assert conn.execute(migrations.fasts_v1.select()).one().id == 1
+        conn.execute(migrations.fasts_v1.delete())
+        new_id = conn.execute(migrations.fasts_v1.insert().values(user_id=1, start_time=start_time,
+            completed=False, deleted=False)).inserted_primary_key[0]
+    assert new_id == 3
@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+from fastingapi.database.database import DBFast, DBUser
+
+
+def walk(client, url, limit):
+    pages, cursor = [], None
+    while True:
+        params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+        response = client.get(url, params=params)
+        assert response.status_code == 200
+        pages.append(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return pages
+
+
+def test_fast_history_cursor_walks_in_start_time_order(client, db):
+    user = DBUser(email="pages@example.com", hashed_password="x")
+    db.add(user)
+    db.commit()
+    now = datetime(2022, 1, 1)
+    # Same start times on purpose, ties are broken by id.
+    for i in range(7):
+        db.add(DBFast(user_id=user.id, start_time=now - timedelta(days=i // 2),
+            planned_end_time=now, completed=True, deleted=False))
+    db.commit()
+
+    pages = walk(client, f"/fast/{user.id}/fasts/", limit=3)
+    rows = [fast for page in pages for fast in page]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert [(f['start_time'], f['id']) for f in rows] == sorted((f['start_time'], f['id']) for f in rows)
+    assert len({f['id'] for f in rows}) == 7
+    assert client.get(f"/fast/{user.id}/fasts/", params={"skip": 3, "limit": 3}).json() == pages[1]
+
+
+def test_user_list_cursor(client):
+    for i in range(5):
+        client.post('/users/', json={"email": f"user{i}@example.com", "password": "secret"})
+    pages = walk(client, "/users/", limit=2)
+    assert [user['id'] for page in pages for user in page] == [1, 2, 3, 4, 5]
+    assert client.get("/users/", params={"cursor": "garbage"}).status_code == 400
+    cursor = client.get("/users/", params={"limit": 2}).headers["X-Next-Cursor"]
+    assert client.get("/users/", params={"cursor": cursor, "skip": 2}).status_code == 400
+
+
+def test_next_cursor_header_is_documented(client):
+    paths = client.get("/openapi.json").json()["paths"]
+    for path in ("/users/", "/fast/{user_id}/fasts/"):
+        assert "X-Next-Cursor" in paths[path]["get"]["responses"]["200"]["headers"]
@@ -0,0 +1,46 @@
+from prometheus_client import REGISTRY
+
+from fastingapi import config
+from fastingapi.database.database import DBUser
+from fastingapi.modules import passwords
+
+
+def stored_hash(db, email):
+    db.expire_all()
+    return db.query(DBUser.hashed_password).filter(DBUser.email == email).scalar()
+
+
+def current_hash_prefix():
+    return (f"$argon2id$v=19$m={config.settings.password_memory_cost},"
+        f"t={config.settings.password_time_cost},p={config.settings.password_parallelism}$")
+
+
+def login(client, email, password):
+    return client.post('/users/login', json={"email": email, "password": password}).status_code
+
+
+def test_passwords_are_hashed_and_verified(client, db):
+    client.post('/users/', json={"email": "hash@example.com", "password": "secret"})
+    assert stored_hash(db, "hash@example.com").startswith(current_hash_prefix())
+    assert login(client, "hash@example.com", "secret") == 200
+    assert login(client, "hash@example.com", "wrong") == 401
+    assert login(client, "nobody@example.com", "secret") == 401
+    assert REGISTRY.get_sample_value('fastingapi_password_jobs_pending') == 0
+
+
+def test_old_and_weaker_hashes_are_replaced_on_login(client, db):
+    weak_hash = passwords.hash_in_worker("secret", dict(time_cost=1, memory_cost=512, parallelism=1))
+    db.add_all([
+        DBUser(email="legacy@example.com", hashed_password="secret" + passwords.LEGACY_SUFFIX, unit="metric"),
+        DBUser(email="weak@example.com", hashed_password=weak_hash, unit="metric"),
+    ])
+    db.commit()
+    rehashes = REGISTRY.get_sample_value('fastingapi_password_rehashes_total')
+
+    assert login(client, "legacy@example.com", "wrong") == 401
+    assert stored_hash(db, "legacy@example.com").endswith(passwords.LEGACY_SUFFIX)
+    for email in ("legacy@example.com", "weak@example.com"):
+        assert login(client, email, "secret") == 200
+        assert stored_hash(db, email).startswith(current_hash_prefix())
+        assert login(client, email, "secret") == 200
+    assert REGISTRY.get_sample_value('fastingapi_password_rehashes_total') == rehashes + 2
@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from fastapi.testclient import TestClient
+from fastingapi import main
+from fastingapi.database.database import DBUser
+from fastingapi.dependencies import SyncDatabase, get_db, get_read_db
+from fastingapi.modules import fasts, leaderboards, stats, users, weights
+
+# Listing users without a cursor reads the users table in id order up to the
+# page limit (and past `skip` rows for old clients). That walk is the listing
+# itself; every other query must be an index lookup.
+USER_LISTING_SCAN = 'SCAN users'
+
+
+@pytest.fixture
+def statements(db_engine):
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            captured.append((statement, parameters))
+
+    event.listen(db_engine, 'before_cursor_execute', capture)
+    yield captured
+    event.remove(db_engine, 'before_cursor_execute', capture)
+
+
+@pytest.fixture
+def user(db):
+    db_user = DBUser(email="plans@example.com", hashed_password="x", unit="metric")
+    db.add(db_user)
+    db.commit()
+    return db_user
+
+
+@pytest.fixture
+def sync_client(db_sessionmaker):
+    async def override_get_db():
+        session = db_sessionmaker()
+        try:
+            yield SyncDatabase(session)
+        finally:
+            session.close()
+
+    main.app.dependency_overrides[get_db] = main.app.dependency_overrides[get_read_db] = override_get_db
+    yield TestClient(main.app)
+    main.app.dependency_overrides.clear()
+
+
+def assert_no_table_scan(db_engine, statements, allowed=()):
+    assert statements
+    with db_engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            scans = [row.detail for row in plan
+                if row.detail.startswith('SCAN') and row.detail not in allowed]
+            assert not scans, f"{statement} falls back to {scans}"
+
+
+def test_fast_queries_use_indexes(db, db_engine, user, statements):
+    start_time = datetime.utcnow() - timedelta(hours=30)
+    fasts.create_user_fast(db, fasts.FastCreate(start_time=start_time), user_id=user.id)
+    fasts.get_active_fast(db, user_id=user.id)
+    ended = fasts.end_user_fast(db, fasts.FastEnd(end_time=start_time + timedelta(hours=20)), user_id=user.id)
+    fasts.get_fasts(db, user_id=user.id)
+    fasts.get_fasts(db, user_id=user.id, after=(ended.start_time, ended.id))
+    fasts.delete_user_fast(db, user_id=user.id, fast_id=ended.id)
+
+    assert_no_table_scan(db_engine, statements)
+
+
+def test_weight_and_user_queries_use_indexes(db, db_engine, user, statements):
+    weights.user_weight_in(db, weights.WeightBase(weight=80, weight_time=datetime.utcnow()), user_id=user.id)
+    users.get_user(db, user_id=user.id)
+    users.get_user_by_email(db, email=user.email)
+    users.get_users(db, after=user.id)
+    weights.get_weight_trend(db, user_id=user.id)
+
+    assert_no_table_scan(db_engine, statements)
+
+
+def test_user_list_query_count_does_not_grow_with_page(db, db_engine, statements):
+    start_time = datetime.utcnow() - timedelta(hours=2)
+    for i in range(10):
+        db_user = DBUser(email=f"page{i}@example.com", hashed_password="x")
+        db.add(db_user)
+        db.commit()
+        fasts.create_user_fast(db, fasts.FastCreate(start_time=start_time), user_id=db_user.id)
+        weights.user_weight_in(db, weights.WeightBase(weight=80, weight_time=start_time), user_id=db_user.id)
+
+    counts = []
+    for limit in (2, 10):
+        statements.clear()
+        page = users.get_users(db, limit=limit)
+        assert all(user.active_fast and user.user_stats.weight == 80 for user in page)
+        counts.append(len(statements))
+    assert counts[0] == counts[1] == 3
+    assert_no_table_scan(db_engine, statements, allowed={USER_LISTING_SCAN})
+
+
+def test_user_routes_use_indexes(db_engine, sync_client, statements):
+    response = sync_client.post('/users/', json={"email": "router@example.com", "password": "secret"})
+    assert response.status_code == 200
+    assert sync_client.post('/users/', json={"email": "router@example.com", "password": "x"}).status_code == 400
+    assert_no_table_scan(db_engine, statements)
+
+    statements.clear()
+    sync_client.get('/users/', params={"limit": 1})
+    sync_client.get('/users/', params={"skip": 1, "limit": 1})
+    assert_no_table_scan(db_engine, statements, allowed={USER_LISTING_SCAN})
+
+
+def test_dashboard_does_not_write_live_duration(db, user):
+    fasts.create_user_fast(db, fasts.FastCreate(start_time=datetime.utcnow() - timedelta(hours=3)),
+        user_id=user.id)
+    dashboard = users.get_user(db, user_id=user.id)
+    assert dashboard.active_fast.duration > timedelta(hours=2)
+    assert not db.dirty
+    db.commit()
+    assert fasts.get_active_fast(db, user_id=user.id).duration is None
+
+
+def test_leaderboard_queries_use_indexes(db, db_engine, user, statements):
+    start_time = datetime.utcnow() - timedelta(hours=30)
+    fasts.create_user_fast(db, fasts.FastCreate(start_time=start_time), user_id=user.id)
+    fasts.end_user_fast(db, fasts.FastEnd(end_time=start_time + timedelta(hours=20)), user_id=user.id)
+    today = datetime.utcnow().date()
+    leaderboards.get_top_hours(db, 'week', stats.period_starts(today)['week'], limit=10)
+    leaderboards.get_ranking(db, user.id, stats.period_starts(today)['month'])
+    leaderboards.get_top_streaks(db, limit=10)
+
+    # Walking the streak index from the top is the leaderboard itself.
+    assert_no_table_scan(db_engine, statements,
+        allowed={'SCAN user_streaks USING COVERING INDEX ix_user_streaks_longest_streak'})
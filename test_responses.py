@@ -0,0 +1,33 @@
+from datetime import datetime, timedelta
+
+from fastingapi import config
+
+
+def get_both(client, monkeypatch, url):
+    pages = []
+    for fast_json in (False, True):
+        monkeypatch.setattr(config.settings, 'fast_json', fast_json)
+        response = client.get(url)
+        assert response.status_code == 200
+        pages.append((response.json(), response.headers.get('X-Next-Cursor')))
+    return pages
+
+
+def test_fast_json_matches_response_models(client, monkeypatch):
+    start_time = datetime.utcnow() - timedelta(days=3)
+    for i in range(3):
+        client.post('/users/', json={"email": f"json{i}@example.com", "password": "secret", "weight": 80})
+    client.post('/fast/1/fasts/', json={"start_time": start_time.isoformat()})
+    client.post('/fast/1/end_fast/', json={"end_time": (start_time + timedelta(hours=16, microseconds=5)).isoformat()})
+    client.post('/fast/1/fasts/', json={"start_time": (start_time + timedelta(days=2)).isoformat()})
+    client.post('/weight/2/fasts/', json={"weight": 79.5})
+
+    (models, model_cursor), (rows, row_cursor) = get_both(client, monkeypatch, '/fast/1/fasts/?limit=2')
+    assert rows == models and row_cursor == model_cursor
+    assert rows[0]['duration'] == 16 * 3600 + 5e-6
+
+    (models, model_cursor), (rows, row_cursor) = get_both(client, monkeypatch, '/users/?limit=2')
+    assert row_cursor == model_cursor
+    # The live duration is measured at each request.
+    assert rows[0]['active_fast'].pop('duration') >= models[0]['active_fast'].pop('duration')
+    assert rows == models
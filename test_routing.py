@@ -0,0 +1,60 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from fastapi.testclient import TestClient
+from fastingapi import main
+from fastingapi.config import Settings
+from fastingapi.database import database, migrations
+from fastingapi.modules import cache, versions
+
+
+def test_read_database_url():
+    assert database.read_database_url(Settings(database_url="sqlite:////data/fastingapi.db")) == \
+        "sqlite:////data/fastingapi.db"
+    assert database.read_database_url(Settings(database_url="sqlite://")) is None
+    assert database.read_database_url(Settings(database_url="sqlite:////data/fastingapi.db",
+        sqlite_read_pool=False)) is None
+    assert database.read_database_url(Settings(database_url="postgresql://primary/fastingapi")) is None
+    assert database.read_database_url(Settings(database_url="postgresql://primary/fastingapi",
+        read_database_url="postgresql://replica/fastingapi")) == "postgresql://replica/fastingapi"
+
+
+def test_sqlite_read_engine_only_reads(db_engine):
+    read_engine = database.make_engine(str(db_engine.url), read_only=True)
+    with db_engine.begin() as conn:
+        conn.execute(migrations.users_v1.insert().values(id=1, email="wal@example.com"))
+    with read_engine.connect() as conn:
+        assert conn.execute(migrations.users_v1.select()).one().email == "wal@example.com"
+        with pytest.raises(OperationalError, match="readonly"):
+            conn.execute(migrations.users_v1.delete())
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+    read_engine.dispose()
+
+
+@pytest.fixture
+def replica_client(tmp_path, monkeypatch):
+    # A replica that never catches up shows where each read went.
+    primary = database.make_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replica = database.make_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    for engine in (primary, replica):
+        migrations.upgrade(engine)
+    monkeypatch.setattr(database, 'SessionLocal', sessionmaker(autoflush=False, bind=primary))
+    monkeypatch.setattr(database, 'ReadSessionLocal', sessionmaker(autoflush=False, bind=replica))
+    monkeypatch.setattr(versions, 'recent_writers', cache.TTLCache(10, 60))
+    yield TestClient(main.app)
+    primary.dispose()
+    replica.dispose()
+
+
+def test_reads_follow_the_users_own_writes(replica_client, monkeypatch):
+    replica_client.post('/users/', json={"email": "replica@example.com", "password": "secret"})
+    replica_client.post("/fast/1/fasts/", json={"start_time": "2021-01-01T20:00:00"})
+    assert replica_client.get('/users/1').status_code == 200
+    assert len(replica_client.get('/fast/1/fasts/').json()) == 1
+
+    # Everyone else, and the user once the window is over, read the replica.
+    assert replica_client.get('/users/').json() == []
+    monkeypatch.setattr(versions, 'recent_writers', cache.TTLCache(10, 0))
+    assert replica_client.get('/users/1').status_code == 404
+    assert replica_client.get('/fast/1/fasts/').json() == []
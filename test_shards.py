@@ -0,0 +1,182 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from fastapi.testclient import TestClient
+from fastingapi import main
+from fastingapi.config import Settings
+from fastingapi.database import database, migrations, shards
+from fastingapi.database.database import DBArchivedFast, DBFast, DBUser, DBWeight
+from fastingapi.modules import archive, cache, users, versions
+
+
+@pytest.fixture
+def sharding(tmp_path, monkeypatch):
+    settings = Settings(database_url=f"sqlite:///{tmp_path / 'directory.db'}",
+        shard_database_urls=[f"sqlite:///{tmp_path / f'shard{number}.db'}" for number in range(2)])
+    directory = database.make_engine(settings.database_url, settings)
+    shards.create_directory(directory)
+    sharding = shards.Shards(directory, settings.shard_database_urls, settings)
+    for shard in sharding.shards:
+        migrations.upgrade(shard.engine)
+    monkeypatch.setattr(shards, 'current', sharding)
+    monkeypatch.setattr(versions, 'recent_writers', cache.TTLCache(10, 60))
+    yield sharding
+    for shard in sharding.shards:
+        shard.engine.dispose()
+        shard.read_engine.dispose()
+    directory.dispose()
+
+
+@pytest.fixture
+def sharded_client(sharding):
+    return TestClient(main.app)
+
+
+def user_ids(sharding, number):
+    with sharding.shards[number].engine.connect() as conn:
+        return conn.execute(select(DBUser.id).order_by(DBUser.id)).scalars().all()
+
+
+def fast_user_ids(sharding, number):
+    with sharding.shards[number].engine.connect() as conn:
+        return conn.execute(select(DBFast.user_id)).scalars().all()
+
+
+def import_fasts(client, user_id, fasts):
+    lines = [json.dumps({"start_time": start_time.isoformat(),
+        "end_time": (start_time + timedelta(hours=hours)).isoformat()}) for start_time, hours in fasts]
+    response = client.post(f"/fast/{user_id}/import", content="\n".join(lines) + "\n")
+    assert response.json()['imported'] == len(fasts)
+
+
+def test_users_live_on_their_shard(sharding, sharded_client):
+    for i in range(4):
+        response = sharded_client.post('/users/', json={"email": f"shard{i}@example.com", "password": "secret"})
+        assert response.status_code == 200
+    assert sharded_client.post('/users/', json={"email": "shard0@example.com", "password": "other"}).json() == \
+        {"detail": "Email already registered"}
+    # Ids come from the directory, so they are unique across shards.
+    assert user_ids(sharding, 0) == [1, 4] and user_ids(sharding, 1) == [2, 3]
+    assert sharding.user_counts() == [2, 2]
+
+    start_time = datetime.utcnow() - timedelta(hours=20)
+    assert sharded_client.post("/fast/2/fasts/", json={"start_time": start_time.isoformat()}).status_code == 200
+    assert fast_user_ids(sharding, 0) == [] and fast_user_ids(sharding, 1) == [2]
+    assert sharded_client.get('/users/2').json()['active_fast']['start_time'] == start_time.isoformat()
+    assert sharded_client.post('/users/login', json={"email": "shard1@example.com",
+        "password": "secret"}).status_code == 200
+    assert sharded_client.post('/users/login', json={"email": "nobody@example.com",
+        "password": "secret"}).status_code == 401
+    assert sharded_client.get('/users/5').status_code == 404
+    assert sharded_client.post("/fast/5/fasts/", json={"start_time": start_time.isoformat()}).status_code == 404
+
+
+def test_failed_signup_gives_the_email_back(sharding, sharded_client, monkeypatch):
+    def failing_create_user_db(db, **kwargs):
+        raise RuntimeError("shard is down")
+
+    with monkeypatch.context() as patch, pytest.raises(RuntimeError):
+        patch.setattr(users, 'create_user_db', failing_create_user_db)
+        sharded_client.post('/users/', json={"email": "shard0@example.com", "password": "secret"})
+    assert sharding.user_id_of("shard0@example.com") is None
+    assert sharded_client.post('/users/', json={"email": "shard0@example.com",
+        "password": "secret"}).status_code == 200
+
+
+def test_lists_merge_the_shards(sharding, sharded_client):
+    for i in range(5):
+        sharded_client.post('/users/', json={"email": f"shard{i}@example.com", "password": "secret"})
+    assert [user['id'] for user in sharded_client.get('/users/').json()] == [1, 2, 3, 4, 5]
+    assert [user['id'] for user in sharded_client.get('/users/', params={"skip": 1, "limit": 3}).json()] == \
+        [2, 3, 4]
+    response = sharded_client.get('/users/', params={"limit": 2})
+    response = sharded_client.get('/users/', params={"limit": 2, "cursor": response.headers['x-next-cursor']})
+    assert [user['id'] for user in response.json()] == [3, 4]
+
+
+def test_leaderboards_across_shards(sharding, sharded_client):
+    # The scenario of test_leaderboards, with users 2 and 3 on one shard and 1 on the other.
+    for i in range(3):
+        sharded_client.post('/users/', json={"email": f"rank{i}@example.com", "password": "secret"})
+    assert sharding.user_counts() == [2, 1]
+    monday = datetime(2021, 1, 4)
+    import_fasts(sharded_client, 1, [(monday + timedelta(days=day, hours=20), 16) for day in range(3)])
+    import_fasts(sharded_client, 2, [(monday + timedelta(hours=20), 20), (monday + timedelta(days=5, hours=20), 16)])
+    import_fasts(sharded_client, 3, [(monday + timedelta(days=8, hours=20), 30)])
+
+    weekly = sharded_client.get("/leaderboard/weekly", params={"week": "2021-01-06"}).json()
+    assert [(entry['rank'], entry['user_id'], entry['hours']) for entry in weekly] == [
+        (1, 1, 48), (2, 2, 36)]
+    streaks = sharded_client.get("/leaderboard/streaks", params={"limit": 2}).json()
+    assert [(entry['rank'], entry['user_id'], entry['longest_streak']) for entry in streaks] == [
+        (1, 1, 4), (2, 3, 3)]
+    ranking = sharded_client.get("/leaderboard/2/ranking", params={"month": "2021-01-20"}).json()
+    assert (ranking['month_hours'], ranking['month_rank'], ranking['month_percentile']) == (36, 2, 100 / 3)
+    assert (ranking['longest_streak'], ranking['streak_rank'], ranking['current_streak']) == (2, 3, 0)
+
+
+def test_move_user(sharding, sharded_client):
+    sharded_client.post('/users/', json={"email": "shard1@example.com", "password": "secret"})
+    monday = datetime(2021, 1, 4)
+    import_fasts(sharded_client, 1, [(monday + timedelta(days=day, hours=20), 16) for day in range(3)])
+    dashboard = sharded_client.get('/users/1').json()
+    assert sharding.shard_of(1) == 1
+
+    assert sharding.move_user(1, 0)
+    assert not sharding.move_user(1, 0)
+    assert sharding.shard_of(1) == 0
+    assert user_ids(sharding, 0) == [1] and user_ids(sharding, 1) == []
+    assert len(fast_user_ids(sharding, 0)) == 3 and fast_user_ids(sharding, 1) == []
+    cache.dashboards.clear()
+    assert sharded_client.get('/users/1').json() == dashboard
+    assert sharded_client.post('/users/login', json={"email": "shard1@example.com",
+        "password": "secret"}).status_code == 200
+
+    # A write that still went to the old shard finds no user there.
+    with sharding.shards[1].engine.begin() as conn, pytest.raises(IntegrityError):
+        conn.execute(DBFast.__table__.insert().values(user_id=1, start_time=monday))
+
+
+def test_move_user_into_a_shard_with_history(sharding, sharded_client):
+    for email in ("shard0@example.com", "shard1@example.com"):
+        sharded_client.post('/users/', json={"email": email, "password": "secret"})
+    monday = datetime(2021, 1, 4)
+    for user_id in (1, 2):
+        import_fasts(sharded_client, user_id, [(monday + timedelta(days=day, hours=20), 16) for day in range(3)])
+        sharded_client.post(f"/weight/{user_id}/fasts/", json={"weight": 80 + user_id})
+    # Both shards have fasts 1 to 3, fasts 1 and 2 in the archive, and weight 1.
+    for shard in sharding.shards:
+        with shard.sessions() as db:
+            assert archive.compact(db, datetime(2021, 1, 7)) == 2
+    history = lambda user_id: [{key: value for key, value in fast.items() if key != 'id'}
+        for fast in sharded_client.get(f"/fast/{user_id}/fasts/").json()]
+    before = {user_id: (sharded_client.get(f'/users/{user_id}').json(), history(user_id)) for user_id in (1, 2)}
+
+    assert sharding.move_user(2, 0)
+    cache.dashboards.clear()
+    for user_id in (1, 2):
+        dashboard, fasts = before[user_id]
+        assert sharded_client.get(f'/users/{user_id}').json()['user_stats'] == dashboard['user_stats']
+        assert history(user_id) == fasts
+    with sharding.shards[0].engine.connect() as conn:
+        fast_ids = conn.execute(select(DBFast.id).union_all(select(DBArchivedFast.id))).scalars().all()
+        assert len(fast_ids) == len(set(fast_ids)) == 6
+        assert conn.execute(select(DBWeight.user_id, DBWeight.weight)).all() == [(1, 81), (2, 82)]
+    # Nor does a new fast take one of them.
+    response = sharded_client.post("/fast/2/fasts/", json={"start_time": datetime.utcnow().isoformat()})
+    assert response.json()['id'] not in fast_ids
+
+
+def test_rebalance(sharding, sharded_client):
+    # Added shards start empty, hashing only spreads the new users.
+    for i in (1, 2, 5):
+        sharded_client.post('/users/', json={"email": f"shard{i}@example.com", "password": "secret"})
+    assert sharding.user_counts() == [0, 3]
+    assert sharding.rebalance() == [(3, 1, 0)]
+    assert sharding.user_counts() == [1, 2]
+    assert sharding.rebalance() == []
+    assert [user['id'] for user in sharded_client.get('/users/').json()] == [1, 2, 3]
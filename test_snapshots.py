@@ -0,0 +1,51 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+
+from fastingapi.database.database import DBUser
+from fastingapi.modules import archive, snapshots, stats
+
+
+def test_snapshots_follow_writes(client, db, tmp_path):
+    for i in range(3):
+        client.post('/users/', json={"email": f"snapshot{i}@example.com", "password": "secret"})
+    lines = [json.dumps({"start_time": f"2021-01-0{day}T20:00:00", "end_time": f"2021-01-0{day + 1}T12:00:00"})
+        for day in (1, 2)]
+    for user_id in (1, 3):
+        client.post(f"/fast/{user_id}/import", content="\n".join(lines) + "\n")
+    client.post("/weight/2/fasts/", json={"weight": 80})
+
+    now = datetime.utcnow()
+    assert snapshots.snapshot(db, tmp_path, partition_users=2, now=now) == 2
+    assert sorted(path.name for path in (tmp_path / 'fasts').iterdir()) == ['part-000000.arrow',
+        'part-000001.arrow']
+    totals = snapshots.hours_per_user(snapshots.load('fasts', tmp_path))
+    assert totals.to_pylist() == [{'user_id': 1, 'number_of_fasts': 2, 'total_hours_fasted': 32.0},
+        {'user_id': 3, 'number_of_fasts': 2, 'total_hours_fasted': 32.0}]
+    assert snapshots.load('weights', tmp_path)['weight'].to_pylist() == [80]
+
+    # Only the partition of the user who wrote is rewritten, archived fasts stay in it.
+    db.query(DBUser).update({DBUser.modified_at: now - timedelta(hours=1)})
+    db.commit()
+    archive.compact(db, datetime(2021, 1, 3))
+    fast_id = client.get("/fast/3/fasts/").json()[1]['id']
+    client.get(f"/fast/3/delete_fast/{fast_id}")
+    assert snapshots.snapshot(db, tmp_path, partition_users=2, now=datetime.utcnow()) == 1
+    fasts = snapshots.load('fasts', tmp_path)
+    assert fasts.num_rows == 4 and fasts['deleted'].to_pylist().count(True) == 1
+    totals = snapshots.hours_per_user(fasts).to_pydict()
+    assert totals['number_of_fasts'] == [stats.get_user_stats(db, user_id).number_of_fasts
+        for user_id in (1, 3)]
+
+    # A new partition size starts over.
+    assert snapshots.snapshot(db, tmp_path, partition_users=10) == 1
+    assert [path.name for path in (tmp_path / 'fasts').iterdir()] == ['part-000000.arrow']
+    assert snapshots.load('fasts', tmp_path).num_rows == 4
+
+
+def test_load_without_snapshots(tmp_path):
+    assert snapshots.load('weights', tmp_path).schema == snapshots.SCHEMAS['weights']
+    assert snapshots.hours_per_user(snapshots.load('fasts', tmp_path)).num_rows == 0
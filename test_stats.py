@@ -0,0 +1,63 @@
+from datetime import datetime, timedelta
+
+from fastingapi.modules import stats
+
+
+def create_user(client, email="stats@example.com"):
+    response = client.post('/users/', json={"email": email, "password": "secret"})
+    assert response.status_code == 200
+    return client.get('/users/').json()[-1]['id']
+
+
+def complete_fast(client, user_id, hours_ago, hours):
+    start_time = datetime.utcnow() - timedelta(hours=hours_ago)
+    end_time = start_time + timedelta(hours=hours)
+    response = client.post(f"/fast/{user_id}/fasts/", json={"start_time": start_time.isoformat()})
+    assert response.status_code == 200
+    response = client.post(f"/fast/{user_id}/end_fast/", json={"end_time": end_time.isoformat()})
+    assert response.status_code == 200
+    return response.json()['id']
+
+
+def test_stats_follow_fasts_and_weights(client):
+    user_id = create_user(client)
+    complete_fast(client, user_id, hours_ago=100, hours=16)
+    longest_id = complete_fast(client, user_id, hours_ago=50, hours=20)
+    for weight, days_ago in [(80, 10), (78, 1), (82, 20)]:
+        weight_time = (datetime.utcnow() - timedelta(days=days_ago)).isoformat()
+        response = client.post(f"/weight/{user_id}/fasts/",
+            json={"weight": weight, "weight_time": weight_time})
+        assert response.status_code == 200
+
+    user_stats = client.get(f"/users/{user_id}").json()['user_stats']
+    assert user_stats['number_of_fasts'] == 2
+    assert round(user_stats['total_hours_fasted'], 6) == 36
+    assert round(user_stats['longest_fast'], 6) == 20
+    assert user_stats['start_weight'] == 82
+    assert user_stats['weight'] == 78
+    assert user_stats['weight_loss'] == 4
+
+    client.get(f"/fast/{user_id}/delete_fast/{longest_id}")
+    user_stats = client.get(f"/users/{user_id}").json()['user_stats']
+    assert user_stats['number_of_fasts'] == 1
+    assert round(user_stats['total_hours_fasted'], 6) == 16
+    assert round(user_stats['longest_fast'], 6) == 16
+
+
+def test_rebuild_matches_incremental_stats(client, db):
+    user_id = create_user(client)
+    complete_fast(client, user_id, hours_ago=100, hours=16)
+    complete_fast(client, user_id, hours_ago=50, hours=20)
+    before = client.get(f"/users/{user_id}").json()['user_stats']
+
+    assert stats.rebuild_stats(db) == 1
+    assert client.get(f"/users/{user_id}").json()['user_stats'] == before
+
+
+def test_fast_without_planned_duration_defaults_to_23_hours(client):
+    user_id = create_user(client)
+    start_time = datetime(2022, 3, 1, 18)
+    response = client.post(f"/fast/{user_id}/fasts/",
+        json={"start_time": start_time.isoformat(), "planned_duration": None})
+    assert response.status_code == 200
+    assert response.json()['planned_end_time'] == (start_time + timedelta(hours=23)).isoformat()
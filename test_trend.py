@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from fastingapi.modules import weights
+
+
+def test_trend_of_steady_loss():
+    start = datetime(2021, 1, 1)
+    # Three readings a day for 60 days, losing 0.1 kg a day.
+    times = np.array([start + timedelta(hours=8 * i) for i in range(180)], dtype='datetime64[s]')
+    values = 90 - 0.1 * np.arange(180) / 3
+
+    trend = weights.weight_trend(times, values, goal_weight=80, window_days=1, points=30)
+    assert trend.readings == 180
+    assert abs(trend.loss_per_week - 0.7) < 1e-6
+    expected_goal = times[-1].item() + timedelta(days=(trend.weight - 80) / 0.1)
+    assert abs(trend.goal_date - expected_goal) < timedelta(minutes=1)
+    assert len(trend.series) == 30
+    assert trend.series[0].time < trend.series[-1].time
+
+
+def test_trend_endpoint(client):
+    client.post('/users/', json={"email": "trend@example.com", "password": "secret"})
+    assert client.get("/weight/1/trend").json()['readings'] == 0
+    for days, weight in [(3, 82), (2, 81), (1, 80)]:
+        client.post("/weight/1/fasts/", json={"weight": weight,
+            "weight_time": (datetime(2021, 1, 10) - timedelta(days=days)).isoformat()})
+    trend = client.get("/weight/1/trend", params={"window_days": 0.5}).json()
+    assert trend['weight'] == 80
+    assert round(trend['loss_per_week'], 6) == 7
+    assert [point['weight'] for point in trend['series']] == [82, 81, 80]
+
+
+def test_no_goal_date_for_a_flat_trend():
+    times = np.array([datetime(2021, 1, 1) + timedelta(days=day) for day in range(4)], dtype='datetime64[s]')
+    # Flat readings fit a slope of about -1e-15 a day, the other one reaches
+    # the goal after year 9999.
+    for values in (np.full(4, 80.0), 80 - 1e-6 * np.arange(4)):
+        trend = weights.weight_trend(times, values, goal_weight=60, window_days=0.5)
+        assert trend.goal_date is None